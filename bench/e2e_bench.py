@@ -0,0 +1,255 @@
+""" End-to-end benchmarks of fileutils and logkeep on generated data.
+
+    Generates a seeded tree and log (see bench.treegen), then runs every
+    scenario in a process of its own, as the tools are run, recording the
+    median wall time, throughput and peak RSS over --repeat runs, and the
+    --stats-json phase times of the fastest run.  Run from the repository
+    root:
+
+      python -m bench.e2e_bench --json results.json
+      python -m bench.e2e_bench --save-baseline baseline.json
+      python -m bench.e2e_bench --baseline baseline.json
+
+    Against a baseline, scenarios slower or larger than it by more than the
+    thresholds are flagged as regressions, and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import treegen
+from toolbag.extsort import parse_size
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILEUTILS_PATH = os.path.join(REPO_ROOT, 'toolbag', 'fileutils.py')
+LOGKEEP_PATH = os.path.join(REPO_ROOT, 'toolbag', 'logkeep.py')
+# evac waits for mounts forever, so the scenario runs the copy of one mount.
+EVAC_SCRIPT = ('import sys\n'
+               'from toolbag import copyengine, stats\n'
+               'with stats.RunStats(json_path=sys.argv[4]):\n'
+               '  copyengine.copy_tree(sys.argv[1], sys.argv[2], int(sys.argv[3]))\n')
+# Above any line count the generated log reaches, so logkeep only counts,
+# every line of it on every run.
+LOGKEEP_LINE_LIMIT = 1 << 62
+
+BYTES_IN_MEGABYTE = 1000000
+# ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+DEFAULT_SCENARIOS = 'dupl,dupl-low-memory,repr,evac,logkeep'
+DEFAULT_REPEAT = 3
+DEFAULT_JOBS = 4
+DEFAULT_TIME_THRESHOLD = 0.15
+DEFAULT_MEMORY_THRESHOLD = 0.25
+
+class Scenario:
+  """ A command to benchmark.  command(context, stats_path) returns its
+      argv; work(context) returns the (items, bytes) it processes, for
+      throughput, items being files or log lines; prepare(context), if
+      given, runs before every run.
+  """
+  def __init__(self, command, work, prepare=None):
+    self.command = command
+    self.work = work
+    self.prepare = prepare
+
+
+def _fileutils_command(*args):
+  return lambda context, stats_path: [
+    sys.executable, FILEUTILS_PATH, *[arg.format(**context) for arg in args],
+    '--jobs', str(context['jobs']), '--no-cache', '--no-progress',
+    '--stats-json', stats_path]
+
+def _tree_work(context):
+  return context['tree']['files'], context['tree']['bytes']
+
+def _clear_evac_destination(context):
+  shutil.rmtree(context['evac_dir'], ignore_errors=True)
+
+SCENARIOS = {
+  'dupl': Scenario(_fileutils_command('dupl', '{tree_dir}'), _tree_work),
+  'dupl-low-memory': Scenario(
+    _fileutils_command('dupl', '{tree_dir}', '--low-memory', '--memory-budget', '1M'),
+    _tree_work),
+  'repr': Scenario(_fileutils_command('repr', '{tree_dir}', '{tree_dir}'),
+                   lambda context: (2 * context['tree']['files'],
+                                    2 * context['tree']['bytes'])),
+  'evac': Scenario(
+    lambda context, stats_path: [sys.executable, '-c', EVAC_SCRIPT, context['tree_dir'],
+                                 context['evac_dir'], str(context['jobs']), stats_path],
+    _tree_work, _clear_evac_destination),
+  'logkeep': Scenario(
+    lambda context, stats_path: [sys.executable, LOGKEEP_PATH, '--line_limit',
+                                 str(LOGKEEP_LINE_LIMIT), context['log']['path'],
+                                 '--stats-json', stats_path],
+    lambda context: (context['log']['lines'], context['log']['bytes'])),
+}
+
+def run_process(argv):
+  """ Runs argv from the repository root.  Returns the wall seconds and the
+      peak RSS of the largest process in it, or None where the platform
+      cannot tell.  Raises RuntimeError if it fails.
+  """
+  with tempfile.TemporaryFile() as stderr_file:
+    started = time.perf_counter()
+    process = subprocess.Popen(argv, cwd=REPO_ROOT, stdout=subprocess.DEVNULL,
+                               stderr=stderr_file)
+    peak_rss = None
+    if hasattr(os, 'wait4'):
+      pid, status, rusage = os.wait4(process.pid, 0)
+      process.returncode = os.waitstatus_to_exitcode(status)
+      peak_rss = rusage.ru_maxrss * MAXRSS_UNIT
+    else:
+      process.wait()
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+      stderr_file.seek(0)
+      raise RuntimeError(f'{" ".join(argv)} failed: '
+                         f'{stderr_file.read().decode(errors="replace")}')
+  return elapsed, peak_rss
+
+def run_scenario(scenario, context, repeat):
+  """ Runs the scenario repeat times.  Returns its median wall time,
+      throughput, peak RSS and the phase times of the fastest run.
+  """
+  runs = list()
+  for run_number in range(repeat):
+    if scenario.prepare:
+      scenario.prepare(context)
+    stats_path = os.path.join(context['work_dir'], 'stats.json')
+    elapsed, peak_rss = run_process(scenario.command(context, stats_path))
+    with open(stats_path) as stats_file:
+      runs.append((elapsed, peak_rss, json.load(stats_file)))
+
+  wall_seconds = statistics.median(run[0] for run in runs)
+  fastest = min(runs, key=lambda run: run[0])
+  items, size = scenario.work(context)
+  peak_rss_values = [run[1] for run in runs if run[1] is not None]
+  return dict(
+    wall_seconds=round(wall_seconds, 4),
+    best_wall_seconds=round(fastest[0], 4),
+    items_per_second=round(items / wall_seconds, 1),
+    mb_per_second=round(size / BYTES_IN_MEGABYTE / wall_seconds, 1),
+    peak_rss_bytes=max(peak_rss_values) if peak_rss_values else None,
+    phases={phase: round(phase_stats['seconds'], 4)
+            for phase, phase_stats in fastest[2]['phases'].items()
+            if phase_stats['calls']},
+    runs=repeat)
+
+def run_benchmarks(args):
+  work_dir = tempfile.mkdtemp(prefix='toolbag_e2e_', dir=args.work_dir)
+  try:
+    tree_dir = os.path.join(work_dir, 'tree')
+    tree = treegen.generate_tree_from_args(tree_dir, args)
+    log = treegen.generate_log(os.path.join(work_dir, 'bench.log'), args.log_size,
+                               args.seed)
+    context = dict(work_dir=work_dir, tree_dir=tree_dir, tree=tree, log=log,
+                   evac_dir=os.path.join(work_dir, 'evac'), jobs=args.jobs)
+
+    scenarios = dict()
+    for name in args.scenarios.split(','):
+      scenarios[name] = run_scenario(SCENARIOS[name], context, args.repeat)
+      if not args.quiet:
+        print(format_result_row(name, scenarios[name]), flush=True)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  tree_config = {key: value for key, value in tree.items() if key != 'root'}
+  log_config = {key: value for key, value in log.items() if key != 'path'}
+  return dict(machine=platform.node(), python=platform.python_version(),
+              measured=time.strftime('%Y-%m-%d %H:%M:%S'),
+              config=dict(tree=tree_config, log=log_config, jobs=args.jobs),
+              scenarios=scenarios)
+
+def compare_to_baseline(results, baseline, time_threshold=DEFAULT_TIME_THRESHOLD,
+                        memory_threshold=DEFAULT_MEMORY_THRESHOLD):
+  """ Returns (scenario, metric, baseline value, value) for every scenario
+      whose median wall time or peak RSS grew past its threshold, a
+      fraction of the baseline value.
+  """
+  regressions = list()
+  for name, result in results['scenarios'].items():
+    baseline_result = baseline['scenarios'].get(name)
+    if not baseline_result:
+      continue
+    for metric, threshold in (('wall_seconds', time_threshold),
+                              ('peak_rss_bytes', memory_threshold)):
+      value, baseline_value = result[metric], baseline_result.get(metric)
+      if value is not None and baseline_value and \
+         value > baseline_value * (1 + threshold):
+        regressions.append((name, metric, baseline_value, value))
+  return regressions
+
+def format_result_header():
+  return (f'{"scenario":<16} {"wall s":>9} {"items/s":>10} {"MB/s":>8} '
+          f'{"peak MB":>8}  phases')
+
+def format_result_row(name, result):
+  peak_rss = result['peak_rss_bytes']
+  peak_rss = f'{peak_rss / BYTES_IN_MEGABYTE:.1f}' if peak_rss else '?'
+  phases = ' '.join(f'{phase}={seconds:.2f}' for phase, seconds in result['phases'].items())
+  return (f'{name:<16} {result["wall_seconds"]:>9.3f} {result["items_per_second"]:>10.1f} '
+          f'{result["mb_per_second"]:>8.1f} {peak_rss:>8}  {phases}')
+
+def build_argument_parser():
+  parser = argparse.ArgumentParser(description='End-to-end fileutils and logkeep benchmark.')
+  parser.add_argument('--scenarios', help=f'Scenarios to run, of {", ".join(SCENARIOS)}.',
+                      default=DEFAULT_SCENARIOS)
+  parser.add_argument('--repeat', help='Runs per scenario; the median is kept.',
+                      type=int, default=DEFAULT_REPEAT)
+  parser.add_argument('--jobs', help='--jobs for the tools.', type=int, default=DEFAULT_JOBS)
+  parser.add_argument('--log-size', help='Generated log size (ex. 1G).', type=parse_size,
+                      default=treegen.DEFAULT_LOG_SIZE)
+  treegen.add_tree_arguments(parser)
+  parser.add_argument('--work-dir', help='Directory for the generated data.',
+                      default=tempfile.gettempdir())
+  parser.add_argument('--json', help='Write the results to this file.')
+  parser.add_argument('--baseline', help='Compare with results saved by --save-baseline.')
+  parser.add_argument('--save-baseline', help='Save the results as a baseline here.')
+  parser.add_argument('--time-threshold', help='Wall time growth flagged as a '
+                      'regression, as a fraction.', type=float,
+                      default=DEFAULT_TIME_THRESHOLD)
+  parser.add_argument('--memory-threshold', help='Peak RSS growth flagged as a '
+                      'regression, as a fraction.', type=float,
+                      default=DEFAULT_MEMORY_THRESHOLD)
+  parser.add_argument('--quiet', help='Only print the summary.', action='store_true')
+  return parser
+
+def main():
+  args = build_argument_parser().parse_args()
+  unknown_scenarios = set(args.scenarios.split(',')) - set(SCENARIOS)
+  if unknown_scenarios:
+    sys.exit(f'Unknown scenarios: {", ".join(sorted(unknown_scenarios))}')
+
+  if not args.quiet:
+    print(format_result_header())
+  results = run_benchmarks(args)
+
+  for path in (args.json, args.save_baseline):
+    if path:
+      with open(path, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+
+  if not args.baseline:
+    return
+  with open(args.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  if baseline['config'] != results['config']:
+    print('Warning: the baseline was measured on different data or jobs.')
+  regressions = compare_to_baseline(results, baseline, args.time_threshold,
+                                    args.memory_threshold)
+  for name, metric, baseline_value, value in regressions:
+    print(f'REGRESSION {name} {metric}: {baseline_value} -> {value} '
+          f'({100 * (value / baseline_value - 1):+.1f}%)')
+  if regressions:
+    sys.exit(1)
+  print(f'No regressions against {args.baseline}.')
+
+if __name__ == '__main__':
+  main()
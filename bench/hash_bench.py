@@ -0,0 +1,212 @@
+""" Hash throughput benchmark.
+
+    Generates synthetic files on tmpfs and on disk, then measures MB/s for
+    every algorithm in SUPPORTED_HASHES (plus some candidates) across chunk
+    sizes, read modes and concurrent worker counts.  Run from the repository
+    root:
+
+      python -m bench.hash_bench --sizes 1M,64M --json results.json
+      python -m bench.hash_bench --tune
+
+    --tune saves the fastest chunk size for this machine where
+    hash.DEFAULT_HASHING_CHUNK_SIZE picks it up.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from toolbag import hash
+from toolbag.extsort import parse_size
+
+CANDIDATE_HASHES = {
+  'sha512': hashlib.sha512,
+  'blake2b': hashlib.blake2b,
+  'blake2s': hashlib.blake2s,
+  'sha3_256': hashlib.sha3_256,
+}
+READ_MODE_LEGACY = 'legacy'
+TMPFS_DIR = '/dev/shm'
+BYTES_IN_MEGABYTE = 1000000
+GENERATION_BLOCK_SIZE = 1 << 20
+
+DEFAULT_SIZES = '1M,64M'
+DEFAULT_CHUNK_SIZES = ','.join(str(1 << shift) for shift in range(12, 23, 2))
+DEFAULT_READ_MODES = ','.join([READ_MODE_LEGACY, hash.READ_MODE_BUFFERED,
+                               hash.READ_MODE_MMAP])
+DEFAULT_WORKERS = '1,4'
+DEFAULT_MIN_SECONDS = 0.2
+TUNING_ALGORITHM = 'sha256'
+
+def get_hash_constructors(names=None):
+  constructors = {alg: hash._Application.get_hash_constructor(alg)
+                  for alg in hash._Application.SUPPORTED_HASHES}
+  constructors.update(CANDIDATE_HASHES)
+  if names:
+    constructors = {name: constructors[name] for name in names}
+  return constructors
+
+def generate_file(directory, size):
+  """ Writes a file of pseudo random bytes; random data keeps filesystems
+      from compressing or deduplicating it.
+  """
+  path = os.path.join(directory, f'bench_{size}.bin')
+  block = os.urandom(min(size, GENERATION_BLOCK_SIZE)) if size else b''
+  with open(path, 'wb') as file:
+    remaining = size
+    while remaining > 0:
+      file.write(block[:remaining])
+      remaining -= len(block)
+  return path
+
+def hash_with_legacy_loop(filename, hash_object, chunk_size):
+  """ The read loop hash_file_in_chunks_to_hex_str used before the chunk
+      reader, kept as the baseline.
+  """
+  with open(filename, 'rb') as file:
+    chunk = file.read(chunk_size)
+    while chunk:
+      hash_object.update(chunk)
+      chunk = file.read(chunk_size)
+  return hash_object.hexdigest()
+
+def hash_once(filename, hash_constructor, chunk_size, read_mode):
+  if read_mode == READ_MODE_LEGACY:
+    return hash_with_legacy_loop(filename, hash_constructor(), chunk_size)
+  return hash.hash_file_in_chunks_to_hex_str(filename, hash_constructor(),
+                                             chunk_size, read_mode)
+
+def drop_page_cache(filename):
+  if hasattr(os, 'posix_fadvise'):
+    with open(filename, 'rb') as file:
+      os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def measure(filename, hash_constructor, chunk_size, read_mode, workers,
+            min_seconds=DEFAULT_MIN_SECONDS, cold=False):
+  """ Hashes the file on `workers` threads at once, repeating until
+      min_seconds have passed.  Returns the best aggregate MB/s.
+  """
+  size = os.path.getsize(filename)
+  rates = list()
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    while not rates or time.perf_counter() - started < min_seconds:
+      if cold:
+        drop_page_cache(filename)
+      run_started = time.perf_counter()
+      list(executor.map(lambda i: hash_once(filename, hash_constructor,
+                                            chunk_size, read_mode), range(workers)))
+      elapsed = time.perf_counter() - run_started
+      rates.append(size * workers / BYTES_IN_MEGABYTE / max(elapsed, 1e-9))
+  return max(rates)
+
+def run_benchmarks(args):
+  locations = {'disk': args.disk_dir}
+  if os.path.isdir(TMPFS_DIR) and not args.no_tmpfs:
+    locations['tmpfs'] = TMPFS_DIR
+
+  constructors = get_hash_constructors(args.algs.split(',') if args.algs else None)
+  results = list()
+  for location, base_dir in locations.items():
+    work_dir = tempfile.mkdtemp(prefix='toolbag_bench_', dir=base_dir)
+    try:
+      for size in [parse_size(s) for s in args.sizes.split(',')]:
+        filename = generate_file(work_dir, size)
+        for alg, constructor in constructors.items():
+          for chunk_size in [int(c) for c in args.chunk_sizes.split(',')]:
+            for read_mode in args.read_modes.split(','):
+              for workers in [int(w) for w in args.workers.split(',')]:
+                rate = measure(filename, constructor, chunk_size, read_mode,
+                               workers, args.min_seconds, args.cold)
+                results.append({'location': location, 'size': size,
+                                'algorithm': alg, 'chunk_size': chunk_size,
+                                'read_mode': read_mode, 'workers': workers,
+                                'mb_per_s': round(rate, 1)})
+                if not args.quiet:
+                  print(format_result_row(results[-1]), flush=True)
+        os.remove(filename)
+    finally:
+      shutil.rmtree(work_dir, ignore_errors=True)
+  return results
+
+def format_result_row(result):
+  return (f'{result["location"]:<6} {result["size"]:>12} {result["algorithm"]:<9} '
+          f'{result["chunk_size"]:>9} {result["read_mode"]:<9} {result["workers"]:>3} '
+          f'{result["mb_per_s"]:>10.1f}')
+
+def format_result_header():
+  return (f'{"where":<6} {"size":>12} {"algorithm":<9} {"chunk":>9} '
+          f'{"mode":<9} {"wrk":>3} {"MB/s":>10}')
+
+def select_best_chunk_size(results, algorithm=TUNING_ALGORITHM):
+  """ Picks the chunk size with the highest median throughput over every
+      measured location, size, read mode and worker count for algorithm.
+  """
+  rates_by_chunk_size = dict()
+  for result in results:
+    if result['algorithm'] == algorithm and result['read_mode'] != READ_MODE_LEGACY:
+      rates_by_chunk_size.setdefault(result['chunk_size'], []).append(result['mb_per_s'])
+  if not rates_by_chunk_size:
+    return None
+  return max(rates_by_chunk_size,
+             key=lambda chunk_size: statistics.median(rates_by_chunk_size[chunk_size]))
+
+def save_tuning(chunk_size, results, path=None):
+  path = path or hash.get_tuning_path()
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  with open(path, 'w') as tuning_file:
+    json.dump({'chunk_size': chunk_size, 'machine': platform.node(),
+               'measured': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'results': results}, tuning_file, indent=2)
+  return path
+
+def build_argument_parser():
+  parser = argparse.ArgumentParser(description='Hash throughput benchmark.')
+  parser.add_argument('--sizes', help='File sizes (ex. 4K,1M,1G).', default=DEFAULT_SIZES)
+  parser.add_argument('--algs', help='Algorithms to measure (default: all).')
+  parser.add_argument('--chunk-sizes', help='Chunk sizes in bytes.',
+                      default=DEFAULT_CHUNK_SIZES)
+  parser.add_argument('--read-modes', help='Read modes, including the legacy loop.',
+                      default=DEFAULT_READ_MODES)
+  parser.add_argument('--workers', help='Concurrent hashing threads.',
+                      default=DEFAULT_WORKERS)
+  parser.add_argument('--disk-dir', help='Directory on disk for test files.',
+                      default=tempfile.gettempdir())
+  parser.add_argument('--no-tmpfs', help=f'Skip {TMPFS_DIR}.', action='store_true')
+  parser.add_argument('--cold', help='Drop the page cache before each run.',
+                      action='store_true')
+  parser.add_argument('--min-seconds', help='Minimum time per measurement.',
+                      type=float, default=DEFAULT_MIN_SECONDS)
+  parser.add_argument('--json', help='Write the results to this file.')
+  parser.add_argument('--tune', help=f'Save the best {TUNING_ALGORITHM} chunk size '
+                      'for hash to use.', action='store_true')
+  parser.add_argument('--quiet', help='Only print the summary.', action='store_true')
+  return parser
+
+def main():
+  args = build_argument_parser().parse_args()
+  if args.tune and not args.algs:
+    args.algs = TUNING_ALGORITHM
+
+  if not args.quiet:
+    print(format_result_header())
+  results = run_benchmarks(args)
+
+  if args.json:
+    with open(args.json, 'w') as json_file:
+      json.dump(results, json_file, indent=2)
+
+  best_chunk_size = select_best_chunk_size(results)
+  if best_chunk_size:
+    print(f'Best {TUNING_ALGORITHM} chunk size: {best_chunk_size}')
+  if args.tune and best_chunk_size:
+    print(f'Saved tuning to {save_tuning(best_chunk_size, results)}')
+
+if __name__ == '__main__':
+  main()
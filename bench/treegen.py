@@ -0,0 +1,196 @@
+""" Seeded generators of synthetic directory trees and log files.
+
+    The same seed and options always produce the same names, sizes,
+    contents, duplicates and hard links, so benchmark runs on different
+    days or machines measure the same work.  Run from the repository root:
+
+      python -m bench.treegen tree /tmp/tree --files 10000 --sizes lognormal:16K:1.5
+      python -m bench.treegen log /tmp/big.log --size 1G
+"""
+import argparse
+import json
+import math
+import os
+import random
+
+from toolbag.extsort import parse_size
+
+DISTRIBUTION_FIXED = 'fixed'
+DISTRIBUTION_UNIFORM = 'uniform'
+DISTRIBUTION_LOGNORMAL = 'lognormal'
+DEFAULT_SEED = 1
+DEFAULT_FILE_COUNT = 2000
+DEFAULT_SIZES = 'lognormal:16K:1.5'
+DEFAULT_DUPLICATE_RATIO = 0.2
+DEFAULT_HARDLINK_RATIO = 0.02
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 4
+DEFAULT_MAX_FILE_SIZE = 1 << 30
+DEFAULT_LOG_SIZE = '64M'
+# Files and logs are written in blocks of about this size.
+WRITE_BLOCK_SIZE = 1 << 20
+LOG_LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')
+LOG_WORDS = ('request', 'served', 'cache', 'miss', 'user', 'session', 'timeout',
+             'retry', 'connection', 'closed', 'opened', 'disk', 'queue', 'job',
+             'started', 'finished', 'failed', 'ok', 'slow', 'backup')
+
+class SizeDistribution:
+  """ File sizes drawn from 'fixed:SIZE', 'uniform:MIN:MAX' or
+      'lognormal:MEDIAN:SIGMA' (ex. lognormal:16K:2), capped at max_size.
+  """
+  def __init__(self, spec, max_size=DEFAULT_MAX_FILE_SIZE):
+    self.spec = spec
+    self.kind, *parameters = spec.split(':')
+    self._max_size = max_size
+    if self.kind == DISTRIBUTION_FIXED and len(parameters) == 1:
+      self._parameters = (parse_size(parameters[0]),)
+    elif self.kind == DISTRIBUTION_UNIFORM and len(parameters) == 2:
+      self._parameters = (parse_size(parameters[0]), parse_size(parameters[1]))
+    elif self.kind == DISTRIBUTION_LOGNORMAL and len(parameters) == 2:
+      self._parameters = (math.log(max(parse_size(parameters[0]), 1)),
+                          float(parameters[1]))
+    else:
+      raise ValueError(f'Unknown size distribution \'{spec}\'.')
+
+  def draw(self, rng):
+    if self.kind == DISTRIBUTION_FIXED:
+      size = self._parameters[0]
+    elif self.kind == DISTRIBUTION_UNIFORM:
+      size = rng.randint(*self._parameters)
+    else:
+      size = int(rng.lognormvariate(*self._parameters))
+    return min(size, self._max_size)
+
+
+def generate_tree(root, seed=DEFAULT_SEED, file_count=DEFAULT_FILE_COUNT,
+                  sizes=None, duplicate_ratio=DEFAULT_DUPLICATE_RATIO,
+                  hardlink_ratio=DEFAULT_HARDLINK_RATIO, depth=DEFAULT_DEPTH,
+                  fanout=DEFAULT_FANOUT):
+  """ Writes file_count files under root, spread over directories fanout
+      wide and depth deep.  About duplicate_ratio of them copy an earlier
+      file's contents and hardlink_ratio of them are hard links to one.
+      The rest hold seeded random bytes.  Returns a description of the
+      tree, with its file, byte, duplicate and link counts.
+  """
+  rng = random.Random(seed)
+  sizes = sizes or SizeDistribution(DEFAULT_SIZES)
+  directories = _generate_directories(root, depth, fanout)
+  for directory in directories:
+    os.makedirs(directory, exist_ok=True)
+
+  originals = list()
+  counts = dict(files=0, bytes=0, duplicates=0, links=0)
+  for index in range(file_count):
+    path = os.path.join(rng.choice(directories), f'file_{index:07d}.bin')
+    kind = rng.random()
+    if originals and kind < hardlink_ratio:
+      original_path, size = rng.choice(originals)
+      os.link(original_path, path)
+      counts['links'] += 1
+    elif originals and kind < hardlink_ratio + duplicate_ratio:
+      original_path, size = rng.choice(originals)
+      _copy_file(original_path, path)
+      counts['duplicates'] += 1
+      counts['bytes'] += size
+    else:
+      size = sizes.draw(rng)
+      _write_random_file(path, size, random.Random(rng.getrandbits(64)))
+      originals.append((path, size))
+      counts['bytes'] += size
+    counts['files'] += 1
+
+  return dict(root=root, seed=seed, sizes=sizes.spec, duplicate_ratio=duplicate_ratio,
+              hardlink_ratio=hardlink_ratio, depth=depth, fanout=fanout,
+              directories=len(directories), **counts)
+
+def generate_log(path, size, seed=DEFAULT_SEED):
+  """ Writes a log file of about size bytes, of timestamped lines with a
+      level and a random message.  Returns its size and line count.
+  """
+  rng = random.Random(seed)
+  line_count = 0
+  written = 0
+  with open(path, 'wb') as log_file:
+    while written < size:
+      lines = list()
+      block_size = 0
+      while block_size < WRITE_BLOCK_SIZE and written + block_size < size:
+        words = ' '.join(rng.choices(LOG_WORDS, k=rng.randint(3, 20)))
+        line = (f'2024-01-01T00:00:{line_count % 60:02d}.{line_count % 1000000:06d} '
+                f'{rng.choice(LOG_LEVELS)} {words}\n').encode()
+        lines.append(line)
+        block_size += len(line)
+        line_count += 1
+      log_file.write(b''.join(lines))
+      written += block_size
+  return dict(path=path, seed=seed, bytes=written, lines=line_count)
+
+def _generate_directories(root, depth, fanout):
+  directories = [root]
+  level = [root]
+  for level_number in range(depth):
+    level = [os.path.join(parent, f'dir_{level_number}_{child}')
+             for parent in level for child in range(fanout)]
+    directories.extend(level)
+  return directories
+
+def _write_random_file(path, size, rng):
+  with open(path, 'wb') as file:
+    remaining = size
+    while remaining > 0:
+      block = rng.randbytes(min(remaining, WRITE_BLOCK_SIZE))
+      file.write(block)
+      remaining -= len(block)
+
+def _copy_file(source, destination):
+  with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+    for block in iter(lambda: source_file.read(WRITE_BLOCK_SIZE), b''):
+      destination_file.write(block)
+
+def add_tree_arguments(parser):
+  parser.add_argument('--seed', help='Seed for every random choice.', type=int,
+                      default=DEFAULT_SEED)
+  parser.add_argument('--files', help='Number of files.', type=int,
+                      default=DEFAULT_FILE_COUNT)
+  parser.add_argument('--sizes', help='File size distribution: fixed:SIZE, '
+                      'uniform:MIN:MAX or lognormal:MEDIAN:SIGMA.', default=DEFAULT_SIZES)
+  parser.add_argument('--max-size', help='Largest file size.', type=parse_size,
+                      default=DEFAULT_MAX_FILE_SIZE)
+  parser.add_argument('--duplicate-ratio', help='Share of files copying another.',
+                      type=float, default=DEFAULT_DUPLICATE_RATIO)
+  parser.add_argument('--hardlink-ratio', help='Share of files hard linked to another.',
+                      type=float, default=DEFAULT_HARDLINK_RATIO)
+  parser.add_argument('--depth', help='Directory levels below the root.', type=int,
+                      default=DEFAULT_DEPTH)
+  parser.add_argument('--fanout', help='Subdirectories per directory.', type=int,
+                      default=DEFAULT_FANOUT)
+
+def generate_tree_from_args(root, args):
+  return generate_tree(root, args.seed, args.files,
+                       SizeDistribution(args.sizes, args.max_size),
+                       args.duplicate_ratio, args.hardlink_ratio, args.depth, args.fanout)
+
+def build_argument_parser():
+  parser = argparse.ArgumentParser(description='Synthetic tree and log generator.')
+  subparsers = parser.add_subparsers(dest='kind', required=True)
+  tree_parser = subparsers.add_parser('tree', help='Generate a directory tree.')
+  tree_parser.add_argument('root', help='The directory to fill.')
+  add_tree_arguments(tree_parser)
+  log_parser = subparsers.add_parser('log', help='Generate a log file.')
+  log_parser.add_argument('path', help='The log file to write.')
+  log_parser.add_argument('--size', help='Log size (ex. 512M).', type=parse_size,
+                          default=DEFAULT_LOG_SIZE)
+  log_parser.add_argument('--seed', help='Seed for every random choice.', type=int,
+                          default=DEFAULT_SEED)
+  return parser
+
+def main():
+  args = build_argument_parser().parse_args()
+  if args.kind == 'tree':
+    description = generate_tree_from_args(args.root, args)
+  else:
+    description = generate_log(args.path, args.size, args.seed)
+  print(json.dumps(description, indent=2))
+
+if __name__ == '__main__':
+  main()
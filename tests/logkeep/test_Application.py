@@ -1,4 +1,6 @@
+import json
 import os
+import tempfile
 import unittest
 from unittest import skip
 from unittest.mock import MagicMock, mock_open, patch
@@ -13,6 +15,9 @@ TEST_LIMIT_VALUE_C = 0.5
 TEST_LIMIT_GREATER = 12
 TEST_LIMIT_GREATER_FLOAT = 0.6
 TEST_ARGS = ['app', TEST_LOG_PATH]
+TEST_CHECKPOINT_PATH = '/some/path/to/log.count'
+TEST_CHECKPOINT_ARGS = ['app', '--checkpoint', TEST_LOG_PATH]
+TEST_CHECKPOINT_PATH_ARGS = ['app', '--checkpoint_path', TEST_CHECKPOINT_PATH, TEST_LOG_PATH]
 TEST_SIZE_ARGS = ['app', '--size_limit', f'{TEST_LIMIT_VALUE_A}', TEST_LOG_PATH]
 TEST_SIZE_FLOAT_ARGS = ['app', '--size_limit', f'{TEST_LIMIT_VALUE_C}', TEST_LOG_PATH]
 TEST_SIZE_ARGS = ['app', '--size_limit', f'{TEST_LIMIT_VALUE_A}', TEST_LOG_PATH]
@@ -62,7 +67,19 @@ class Application_TestCase(unittest.TestCase):
   @patch('toolbag.logkeep.Log')  
   def test_work_log_creation(self, log_mock):
     app = _Application()
-    log_mock.assert_called_with(TEST_LOG_PATH)
+    log_mock.assert_called_with(TEST_LOG_PATH, None)
+
+  @patch('sys.argv', TEST_CHECKPOINT_ARGS)
+  @patch('toolbag.logkeep.Log')
+  def test_work_log_creation_with_checkpoint(self, log_mock):
+    app = _Application()
+    log_mock.assert_called_with(TEST_LOG_PATH, TEST_LOG_PATH+'.lines')
+
+  @patch('sys.argv', TEST_CHECKPOINT_PATH_ARGS)
+  @patch('toolbag.logkeep.Log')
+  def test_work_log_creation_with_checkpoint_path(self, log_mock):
+    app = _Application()
+    log_mock.assert_called_with(TEST_LOG_PATH, TEST_CHECKPOINT_PATH)
 
   @patch('sys.argv', TEST_ARGS)
   @patch('toolbag.logkeep.Log')  
@@ -110,6 +127,7 @@ class Application_TestCase(unittest.TestCase):
     app = _Application()
     app.run()
     
+    handle.get_line_count.assert_called_with(TEST_LIMIT_VALUE_B)
     handle.clone_to_a_backup.assert_called_with()
     
   @patch('sys.argv', TEST_SIZE_AND_LINE_ARGS)
@@ -135,6 +153,16 @@ class Application_TestCase(unittest.TestCase):
     with self.assertRaises(RuntimeError) as e:
       _Application()
   
+  @patch('toolbag.logkeep.Log', side_effect=FileNotFoundError(TEST_ERROR_RETURN))
+  def test_constructor_errors_still_write_stats(self, *args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+      stats_path = os.path.join(temp_dir, 'stats.json')
+      with patch('sys.argv', ['app', '--stats-json', stats_path, TEST_LOG_PATH]), \
+           self.assertRaises(RuntimeError):
+        _Application()
+      with open(stats_path) as stats_file:
+        self.assertIn('phases', json.load(stats_file))
+
   @patch('sys.argv', TEST_SIZE_ARGS)
   @patch('toolbag.logkeep.Log')
   def test_run_raises_runtimeerror_on_bad_permissions(self, log_mock, *args):
@@ -1,19 +1,18 @@
+import io
+import json
 import os
+import tempfile
 import unittest
 from unittest import skip
 from unittest.mock import MagicMock, mock_open, patch
 
-def fix_iteration_in_mock_open(open_mock):
-  """ A test utility function to help with file open mocking.
-  """
-  open_mock.return_value.__iter__ = lambda self : iter(self.readline, '')
-
 from toolbag.logkeep import Log
 
 BYTES_IN_MEGABYTE = 1000000
 TEST_LOG_PATH = '/some/path/to/log.log'
 TEST_LOG_DATA = f'line 0{os.linesep}line 1{os.linesep} line 2'
-TEST_LOG_DATA_SIZE = len(TEST_LOG_DATA.encode('utf-8'))
+TEST_LOG_BYTES = TEST_LOG_DATA.encode('utf-8')
+TEST_LOG_DATA_SIZE = len(TEST_LOG_BYTES)
 TEST_LOG_DATA_LINE_CNT = 3
 TEST_USER_DEFINED_CLONE_PATH = '/user/path/to/log.bak'
 
@@ -36,20 +35,36 @@ class Log_TestCase(unittest.TestCase):
     
   @patch('os.path.getsize', return_value=TEST_LOG_DATA_SIZE)
   @patch('toolbag.logkeep.Log._raise_if_not_a_file')
-  @patch('builtins.open', new_callable=mock_open, read_data=TEST_LOG_DATA)
-  def test_constructor_counts_lines(self, open_, *stubs):
-    fix_iteration_in_mock_open(open_)
-    
+  @patch('builtins.open', new_callable=mock_open, read_data=TEST_LOG_BYTES)
+  def test_constructor_does_not_count_lines(self, open_, *stubs):
+    log = Log(TEST_LOG_PATH)
+    open_.assert_not_called()
+
+  @patch('os.path.getsize', return_value=TEST_LOG_DATA_SIZE)
+  @patch('toolbag.logkeep.Log._raise_if_not_a_file')
+  @patch('builtins.open', new_callable=mock_open, read_data=TEST_LOG_BYTES)
+  def test_get_line_count_counts_lines_once(self, open_, *stubs):
     log = Log(TEST_LOG_PATH)
     self.assertEqual(TEST_LOG_DATA_LINE_CNT, log.get_line_count())
+    self.assertEqual(TEST_LOG_DATA_LINE_CNT, log.get_line_count())
+    open_.assert_called_once()
 
-  @patch('builtins.open', new_callable=mock_open, read_data=TEST_LOG_DATA)
+  @patch('builtins.open', new_callable=mock_open, read_data=TEST_LOG_BYTES)
   def test__count_lines_in_file_counts_lines(self, open_):
-    fix_iteration_in_mock_open(open_)
-  
     line_count = Log._count_lines_in_file(TEST_LOG_PATH)
-    open_.assert_called_with(TEST_LOG_PATH, 'r')
+    open_.assert_called_with(TEST_LOG_PATH, 'rb')
     self.assertEqual(line_count, TEST_LOG_DATA_LINE_CNT)
+
+  @patch('builtins.open', new_callable=mock_open, read_data=b'\xff\xfe\n\x80\n')
+  def test__count_lines_in_file_counts_undecodable_lines(self, open_):
+    self.assertEqual(Log._count_lines_in_file(TEST_LOG_PATH), 2)
+
+  @patch('toolbag.logkeep.Log.COUNT_CHUNK_SIZE', 4)
+  @patch('builtins.open', new_callable=mock_open, read_data=b'a\n' * 100)
+  def test__count_lines_in_file_stops_past_the_limit(self, open_):
+    line_count = Log._count_lines_in_file(TEST_LOG_PATH, 3)
+    self.assertEqual(line_count, 4)
+    self.assertLess(open_().read.call_count, 10)
     
   @patch('os.path.isfile', return_value=False)
   def test__count_lines_in_file_raises_if_file_does_not_exist(self, *stubs):
@@ -132,4 +147,71 @@ class Log_TestCase(unittest.TestCase):
       Log._clear_file_contents('file.log')
     
     open_.assert_not_called()
-    
\ No newline at end of file
+    
+
+class Log_checkpoint_TestCase(unittest.TestCase):
+  def setUp(self):
+    self._temp_dir = tempfile.TemporaryDirectory()
+    self._log_path = os.path.join(self._temp_dir.name, 'log.log')
+    self._checkpoint_path = self._log_path + '.lines'
+    self._write(b'line 0\nline 1\npartial', 'wb')
+
+  def tearDown(self):
+    self._temp_dir.cleanup()
+
+  def _write(self, data, mode='ab'):
+    with open(self._log_path, mode) as log_file:
+      log_file.write(data)
+
+  def _count(self):
+    return Log(self._log_path, self._checkpoint_path).get_line_count()
+
+  def test_counts_only_appended_lines(self):
+    self.assertEqual(self._count(), 3)
+    self._write(b' line 2\nline 3\n')
+    with patch('toolbag.logkeep.Log._scan_lines', wraps=Log._scan_lines) as scan_mock:
+      self.assertEqual(self._count(), 4)
+    self.assertEqual(scan_mock.call_args.args[2:], (14, 2))
+
+  def test_counts_again_after_truncation(self):
+    self.assertEqual(self._count(), 3)
+    self._write(b'line 0\n', 'wb')
+    self.assertEqual(self._count(), 1)
+
+  def test_counts_again_after_rotation(self):
+    self.assertEqual(self._count(), 3)
+    rotated_path = self._log_path + '.1'
+    os.rename(self._log_path, rotated_path)
+    with open(self._log_path, 'wb') as log_file:
+      log_file.write(b'new 0\nnew 1\nnew 2\nnew 3\nnew 4\n')
+    self.assertEqual(self._count(), 5)
+
+  def test_clearing_resets_the_checkpoint(self):
+    log = Log(self._log_path, self._checkpoint_path)
+    log.get_line_count()
+    log.clear_original_file()
+    self._write(b'line 0\n')
+    self.assertEqual(self._count(), 1)
+
+  def test_stopping_at_the_limit_saves_no_checkpoint(self):
+    Log(self._log_path, self._checkpoint_path).get_line_count(limit=0)
+    self.assertFalse(os.path.exists(self._checkpoint_path))
+
+  def test_malformed_checkpoints_are_ignored(self):
+    checkpoints = ['[]', '"text"', '{}', '{"version": 1}',
+                   json.dumps(dict(version=1, device=None, inode=None, size='1',
+                                   offset=0, lines=0))]
+    for checkpoint in checkpoints:
+      with self.subTest(checkpoint=checkpoint):
+        with open(self._checkpoint_path, 'w') as checkpoint_file:
+          checkpoint_file.write(checkpoint)
+        self.assertEqual(self._count(), 3)
+
+  def test_counts_when_the_checkpoint_cannot_be_saved(self):
+    checkpoint_path = os.path.join(self._temp_dir.name, 'missing', 'log.lines')
+    log = Log(self._log_path, checkpoint_path)
+    with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+      self.assertEqual(log.get_line_count(), 3)
+      log.clear_original_file()
+    self.assertIn('Warning', stderr.getvalue())
+    self.assertEqual(os.path.getsize(self._log_path), 0)
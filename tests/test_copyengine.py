@@ -0,0 +1,169 @@
+import errno
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from toolbag import copyengine
+from toolbag.hash import parse_checksum_line
+
+TEST_FILES = {
+  'a.bin': os.urandom(5000),
+  'empty': b'',
+  os.path.join('sub', 'b.txt'): b'b' * 100,
+  os.path.join('sub', 'deeper', 'c.txt'): b'c' * 3,
+}
+
+class copy_tree_TestCase(unittest.TestCase):
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.source = os.path.join(temp_dir.name, 'source')
+    self.destination = os.path.join(temp_dir.name, 'destination')
+    for name, data in TEST_FILES.items():
+      path = os.path.join(self.source, name)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'wb') as file:
+        file.write(data)
+    os.chmod(os.path.join(self.source, 'a.bin'), 0o640)
+
+  def read_manifest(self):
+    with open(os.path.join(self.destination, copyengine.MANIFEST_NAME)) as manifest:
+      entries = [parse_checksum_line(line) for line in manifest]
+    return {filename: hash_str for alg, hash_str, filename in entries}
+
+  def assert_copied(self):
+    for name, data in TEST_FILES.items():
+      with open(os.path.join(self.destination, name), 'rb') as file:
+        self.assertEqual(file.read(), data)
+    self.assertEqual(os.stat(os.path.join(self.destination, 'a.bin')).st_mode & 0o777, 0o640)
+    self.assertEqual(self.read_manifest(),
+                     {name.replace(os.sep, '/'): hashlib.sha256(data).hexdigest()
+                      for name, data in TEST_FILES.items()})
+
+  def test_stream_copy(self):
+    counts = copyengine.copy_tree(self.source, self.destination, jobs=3, chunk_size=1024)
+    self.assert_copied()
+    self.assertEqual(counts, dict(copied=4, linked=0, resumed=0,
+                                  bytes=sum(map(len, TEST_FILES.values()))))
+
+  def test_kernel_copy(self):
+    copyengine.copy_tree(self.source, self.destination, jobs=3,
+                         copy_mode=copyengine.COPY_MODE_KERNEL)
+    self.assert_copied()
+
+  @patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+  def test_kernel_copy_falls_back(self, copy_file_range):
+    copyengine.copy_tree(self.source, self.destination,
+                         copy_mode=copyengine.COPY_MODE_KERNEL)
+    self.assert_copied()
+
+  def test_resumes_failed_copy(self):
+    copy_file = copyengine.copy_file
+    def fail_for_b(source, *args):
+      if source.endswith('b.txt'):
+        raise OSError(errno.EIO, 'Input/output error')
+      return copy_file(source, *args)
+
+    with patch.object(copyengine, 'copy_file', side_effect=fail_for_b):
+      with self.assertRaises(copyengine.CopyFailed) as context:
+        copyengine.copy_tree(self.source, self.destination)
+    self.assertEqual(context.exception.failures,
+                     [(os.path.join('sub', 'b.txt'), 'Input/output error')])
+    self.assertEqual(copyengine.find_incomplete_copy(os.path.dirname(self.destination),
+                                                     self.source),
+                     self.destination)
+    self.assertEqual([name for name in os.listdir(os.path.join(self.destination, 'sub'))
+                      if name.endswith(copyengine.PARTIAL_FILE_SUFFIX)], [])
+
+    counts = copyengine.copy_tree(self.source, self.destination)
+    self.assertEqual((counts['copied'], counts['resumed']), (1, 3))
+    self.assert_copied()
+    self.assertIsNone(copyengine.find_incomplete_copy(os.path.dirname(self.destination),
+                                                     self.source))
+
+  def fail_copying_b(self):
+    copy_file = copyengine.copy_file
+    def fail_for_b(source, *args):
+      if source.endswith('b.txt'):
+        raise OSError(errno.EIO, 'Input/output error')
+      return copy_file(source, *args)
+
+    with patch.object(copyengine, 'copy_file', side_effect=fail_for_b):
+      with self.assertRaises(copyengine.CopyFailed):
+        copyengine.copy_tree(self.source, self.destination)
+
+  def test_does_not_resume_a_copy_of_another_volume(self):
+    with patch.object(copyengine, '_find_volume_uuid', return_value='card-1'):
+      self.fail_copying_b()
+    for name in TEST_FILES:
+      os.remove(os.path.join(self.source, name))
+    with open(os.path.join(self.source, 'a.bin'), 'wb') as file:
+      file.write(b'other a')
+
+    with patch.object(copyengine, '_find_volume_uuid', return_value='card-2'):
+      self.assertIsNone(copyengine.find_incomplete_copy(os.path.dirname(self.destination),
+                                                        self.source))
+      counts = copyengine.copy_tree(self.source, self.destination)
+    self.assertEqual(counts['resumed'], 0)
+    self.assertEqual(self.read_manifest(), {'a.bin': hashlib.sha256(b'other a').hexdigest()})
+
+  def test_recopies_files_modified_since_on_resume(self):
+    self.fail_copying_b()
+    a_path = os.path.join(self.source, 'a.bin')
+    modified = bytes(reversed(TEST_FILES['a.bin']))
+    with open(a_path, 'wb') as file:
+      file.write(modified)
+
+    with patch.dict(TEST_FILES, {'a.bin': modified}):
+      counts = copyengine.copy_tree(self.source, self.destination)
+      self.assert_copied()
+    self.assertEqual((counts['copied'], counts['resumed']), (2, 2))
+
+  @patch('toolbag.copyengine._copy_in_kernel', return_value=10)
+  def test_kernel_copy_checks_the_copied_size(self, copy_mock):
+    with self.assertRaises(OSError):
+      copyengine.copy_file(os.path.join(self.source, 'a.bin'),
+                           os.path.join(self.source, 'a.copy'), copyengine.COPY_MODE_KERNEL)
+    self.assertFalse(os.path.exists(os.path.join(self.source, 'a.copy')))
+
+  def test_recopies_changed_files_on_resume(self):
+    os.makedirs(self.destination)
+    with open(os.path.join(self.destination, copyengine.PARTIAL_MANIFEST_NAME), 'w') as manifest:
+      manifest.write(f'{"0" * 64}  empty\n')
+    with open(os.path.join(self.destination, 'empty'), 'wb') as file:
+      file.write(b'stale')
+
+    counts = copyengine.copy_tree(self.source, self.destination)
+    self.assertEqual((counts['copied'], counts['resumed']), (4, 0))
+    self.assert_copied()
+
+  def test_incremental_copy_links_unchanged_files(self):
+    previous = self.destination + '_previous'
+    previous_files = dict()
+    copyengine.copy_tree(self.source, previous, files=previous_files)
+    with open(os.path.join(self.source, 'empty'), 'wb') as file:
+      file.write(b'changed')
+    TEST_FILES_CHANGED = dict(TEST_FILES, empty=b'changed')
+
+    files = dict()
+    with patch.dict(TEST_FILES, TEST_FILES_CHANGED):
+      counts = copyengine.copy_tree(self.source, self.destination,
+                                    previous_snapshot=previous,
+                                    previous_files=previous_files, files=files)
+      self.assert_copied()
+    self.assertEqual((counts['copied'], counts['linked']), (1, 3))
+    self.assertTrue(os.path.samefile(os.path.join(previous, 'a.bin'),
+                                     os.path.join(self.destination, 'a.bin')))
+    self.assertFalse(os.path.samefile(os.path.join(previous, 'empty'),
+                                      os.path.join(self.destination, 'empty')))
+    self.assertEqual(files['empty'][2], hashlib.sha256(b'changed').hexdigest())
+
+  def test_snapshot_state_round_trip(self):
+    files = dict()
+    copyengine.copy_tree(self.source, self.destination, files=files)
+    state_path = self.destination + '.json'
+    copyengine.save_snapshot_state(state_path, self.destination, files)
+    self.assertEqual(copyengine.load_snapshot_state(state_path), (self.destination, files))
+    self.assertEqual(copyengine.load_snapshot_state(state_path + '.missing'), (None, {}))
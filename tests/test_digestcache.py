@@ -0,0 +1,92 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from toolbag import digestcache
+from toolbag.digestcache import DigestCache
+from toolbag.stats import RunStats
+
+TEST_MD5 = '1e50210a0202497fb79bc38b6ade6c34'
+TEST_SHA1 = 'baf34551fecb48acc3da868eb85e1b6dac9de356'
+OLD_MTIME_NS = 1000000000 * 1000000000
+
+def make_stat(inode=1, size=10, mtime_ns=OLD_MTIME_NS):
+  return MagicMock(st_dev=42, st_ino=inode, st_size=size, st_mtime_ns=mtime_ns)
+
+class DigestCache_TestCase(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.cache = DigestCache(os.path.join(self.temp_dir.name, 'sub', 'cache.db'))
+    self.addCleanup(self.cache.close)
+
+  def test_lookup_misses_empty_cache(self):
+    with RunStats(json_path=os.devnull) as run_stats:
+      self.assertIsNone(self.cache.lookup(make_stat(), 'md5'))
+      self.assertEqual(run_stats.get_summary()['counters']['cache_misses'], 1)
+
+  def test_lookup_returns_stored_digest(self):
+    self.cache.store(make_stat(), {'md5': TEST_MD5, 'sha1': TEST_SHA1})
+    with RunStats(json_path=os.devnull) as run_stats:
+      self.assertEqual(self.cache.lookup(make_stat(), 'md5'), TEST_MD5)
+      self.assertEqual(self.cache.lookup(make_stat(), 'sha1'), TEST_SHA1)
+      self.assertEqual(run_stats.get_summary()['counters']['cache_hits'], 2)
+
+  def test_lookup_misses_changed_file(self):
+    self.cache.store(make_stat(), {'md5': TEST_MD5})
+    self.assertIsNone(self.cache.lookup(make_stat(size=11), 'md5'))
+    self.assertIsNone(self.cache.lookup(make_stat(mtime_ns=OLD_MTIME_NS + 1), 'md5'))
+    self.assertIsNone(self.cache.lookup(make_stat(inode=2), 'md5'))
+    self.assertIsNone(self.cache.lookup(make_stat(), 'sha1'))
+
+  def test_store_replaces_previous_version(self):
+    self.cache.store(make_stat(), {'md5': TEST_MD5})
+    self.cache.store(make_stat(size=11), {'md5': TEST_SHA1})
+    self.assertEqual(self.cache.lookup(make_stat(size=11), 'md5'), TEST_SHA1)
+    self.assertEqual(self.cache.evict(max_entries=0), 1)
+
+  def test_store_skips_recently_modified_files(self):
+    self.cache.store(make_stat(mtime_ns=time.time_ns()), {'md5': TEST_MD5})
+    self.assertIsNone(self.cache.lookup(make_stat(mtime_ns=time.time_ns()), 'md5'))
+
+  def test_evict_by_age(self):
+    self.cache.store(make_stat(), {'md5': TEST_MD5})
+    self.assertEqual(self.cache.evict(max_age_seconds=60), 0)
+    with patch('time.time', return_value=time.time() + 120):
+      self.assertEqual(self.cache.evict(max_age_seconds=60), 1)
+    self.assertIsNone(self.cache.lookup(make_stat(), 'md5'))
+
+  def test_evict_by_entry_count(self):
+    for inode in range(5):
+      self.cache.store(make_stat(inode=inode), {'md5': TEST_MD5})
+    self.assertEqual(self.cache.evict(max_entries=3), 2)
+
+  def test_clear(self):
+    self.cache.store(make_stat(), {'md5': TEST_MD5})
+    self.cache.clear()
+    self.assertIsNone(self.cache.lookup(make_stat(), 'md5'))
+
+class CachePathFromArgs_TestCase(unittest.TestCase):
+  def make_args(self, cache=False, no_cache=False, rebuild_cache=False, cache_path=None):
+    return MagicMock(cache=cache, no_cache=no_cache, rebuild_cache=rebuild_cache,
+                     cache_path=cache_path)
+
+  @patch.dict('os.environ', {}, clear=True)
+  def test_cache_is_opt_in(self):
+    self.assertIsNone(digestcache.get_cache_path_from_args(self.make_args()))
+    self.assertEqual(digestcache.get_cache_path_from_args(self.make_args(cache=True)),
+                     digestcache.get_default_cache_path())
+    self.assertEqual(digestcache.get_cache_path_from_args(self.make_args(rebuild_cache=True)),
+                     digestcache.get_default_cache_path())
+
+  @patch.dict('os.environ', {digestcache.CACHE_ENV_VAR: '1'})
+  def test_no_cache_overrides_environment(self):
+    self.assertIsNotNone(digestcache.get_cache_path_from_args(self.make_args()))
+    self.assertIsNone(digestcache.get_cache_path_from_args(self.make_args(no_cache=True)))
+
+  @patch.dict('os.environ', {'XDG_CACHE_HOME': '/xdg'})
+  def test_default_path_honours_xdg_cache_home(self):
+    self.assertEqual(digestcache.get_default_cache_path(),
+                     os.path.join('/xdg', 'toolbag', 'digests.sqlite3'))
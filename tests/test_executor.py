@@ -0,0 +1,125 @@
+import os
+import unittest
+
+from toolbag import executor as executor_module
+from toolbag import telemetry
+from toolbag.executor import (BACKEND_INLINE, BACKEND_PROCESS, BACKEND_THREAD,
+                              Executor, choose_backend)
+from toolbag.telemetry import ProgressCounters
+
+_initialized_with = None
+
+def record_initializer(value):
+  global _initialized_with
+  _initialized_with = value
+
+def get_initialized_with(item):
+  return _initialized_with
+
+def fail_on_negative(item):
+  if item < 0:
+    raise ValueError(item)
+  return item
+
+def get_pid(item):
+  return os.getpid()
+
+def count_item(item):
+  telemetry.count(1, item)
+
+class choose_backend_TestCase(unittest.TestCase):
+  def test_single_job_is_inline(self):
+    self.assertEqual(choose_backend(1, [1] * 1000), BACKEND_INLINE)
+
+  def test_several_jobs_are_never_inline(self):
+    self.assertEqual(choose_backend(4, [1000]), BACKEND_PROCESS)
+    self.assertEqual(choose_backend(4, []), BACKEND_PROCESS)
+
+  def test_large_files_use_threads(self):
+    sizes = [executor_module.THREAD_MEDIAN_FILE_SIZE] * 10
+    self.assertEqual(choose_backend(4, sizes), BACKEND_THREAD)
+
+  def test_small_files_use_processes(self):
+    self.assertEqual(choose_backend(4, [1000] * 10), BACKEND_PROCESS)
+
+class Executor_TestCase(unittest.TestCase):
+  def test_backends_map_every_item(self):
+    for backend in (BACKEND_INLINE, BACKEND_THREAD, BACKEND_PROCESS):
+      with self.subTest(backend=backend), Executor(2, backend) as executor:
+        results = {item: future.result() for item, future in
+                   executor.map_unordered(abs, range(-10, 0), 3)}
+        self.assertEqual(results, {i: -i for i in range(-10, 0)})
+
+  def test_imap_feeds_from_a_thread(self):
+    with Executor(2, BACKEND_THREAD) as executor:
+      results = executor.imap_unordered(abs, range(-10, 0))
+      self.assertEqual(sorted(future.result() for item, future in results),
+                       list(range(1, 11)))
+
+  def test_errors_stay_with_their_item(self):
+    with Executor(2, BACKEND_PROCESS) as executor:
+      for item, future in executor.map_unordered(fail_on_negative, [1, -1]):
+        if item < 0:
+          self.assertRaises(ValueError, future.result)
+        else:
+          self.assertEqual(future.result(), 1)
+
+  def test_imap_raises_item_errors(self):
+    def items():
+      yield 1
+      raise OSError('walk failed')
+
+    with Executor(2, BACKEND_THREAD) as executor:
+      with self.assertRaises(OSError):
+        list(executor.imap_unordered(abs, items()))
+
+  def test_resolves_auto_backend_for_each_phase(self):
+    executor = Executor(4)
+    backend, items = executor.resolve_from(iter([10, 20]), lambda item: item)
+    self.assertEqual((backend, list(items)), (BACKEND_PROCESS, [10, 20]))
+    large_size = executor_module.THREAD_MEDIAN_FILE_SIZE
+    backend, items = executor.resolve_from([large_size], lambda item: item)
+    self.assertEqual(backend, BACKEND_THREAD)
+    items = [large_size]
+    self.assertEqual(Executor(4, BACKEND_INLINE).resolve_from(items, None),
+                     (BACKEND_INLINE, items))
+
+  def test_imap_resolves_from_the_feeder(self):
+    def resolve(items):
+      self.assertEqual(next(items), 1)
+      return BACKEND_PROCESS, items
+
+    with Executor(2) as executor:
+      results = executor.imap_unordered(get_pid, iter([1, 2, 3]), resolve=resolve)
+      self.assertNotIn(os.getpid(), {future.result() for item, future in results})
+
+  def test_keeps_workers_warm_between_phases(self):
+    with Executor(2, BACKEND_PROCESS) as executor:
+      phases = [{future.result() for item, future in
+                 executor.map_unordered(get_pid, range(20))} for phase in range(2)]
+    self.assertLessEqual(len(phases[0] | phases[1]), 2)
+    self.assertNotIn(os.getpid(), phases[0])
+
+  def test_initializer_runs_in_workers(self):
+    for backend in (BACKEND_INLINE, BACKEND_PROCESS):
+      with self.subTest(backend=backend), \
+           Executor(2, backend, record_initializer, ('ready',)) as executor:
+        results = [future.result() for item, future in
+                   executor.map_unordered(get_initialized_with, range(4))]
+        self.assertEqual(results, ['ready'] * 4)
+
+  def test_terminates_when_interrupted(self):
+    executor = Executor(2, BACKEND_PROCESS)
+    with self.assertRaises(KeyboardInterrupt):
+      with executor:
+        executor.submit(abs, 1).result()
+        raise KeyboardInterrupt()
+    self.assertFalse(executor._pools)
+    self.assertRaises(ValueError, executor.submit, abs, 1)
+
+  def test_thread_backend_counts(self):
+    counters = ProgressCounters()
+    with Executor(3, BACKEND_THREAD, telemetry.install_counters, (counters,)) as executor:
+      list(executor.map_unordered(count_item, range(100)))
+    telemetry.install_counters(None)
+    self.assertEqual(counters.get_totals(), (100, sum(range(100))))
@@ -0,0 +1,57 @@
+import random
+import unittest
+from unittest.mock import patch
+
+from toolbag import extsort
+from toolbag.extsort import ExternalSorter
+
+def build_test_records(count):
+  rng = random.Random(count)
+  return [(rng.randrange(100), bytes([rng.randrange(256)]) * 16, index, f'/dir/file{index}')
+          for index in range(count)]
+
+class ExternalSorter_TestCase(unittest.TestCase):
+  def test_sorts_in_memory_within_budget(self):
+    records = build_test_records(100)
+    with ExternalSorter() as sorter:
+      sorter.extend(records)
+      self.assertEqual(sorter.get_run_count(), 0)
+      self.assertEqual(list(sorter), sorted(records))
+
+  def test_spills_runs_past_budget(self):
+    records = build_test_records(1000)
+    with ExternalSorter(memory_budget=4096) as sorter:
+      sorter.extend(records)
+      self.assertGreater(sorter.get_run_count(), 1)
+      self.assertEqual(len(sorter), len(records))
+      self.assertEqual(list(sorter), sorted(records))
+
+  @patch.object(extsort, 'MAX_MERGE_WIDTH', 3)
+  @patch.object(extsort, 'RUN_BLOCK_RECORDS', 7)
+  def test_merges_many_runs_in_passes(self):
+    records = build_test_records(1000)
+    with ExternalSorter(memory_budget=2048) as sorter:
+      sorter.extend(records)
+      self.assertGreater(sorter.get_run_count(), 3)
+      self.assertEqual(list(sorter), sorted(records))
+
+  def test_sorts_records_holding_lists(self):
+    records = [(2, ['b', 'c']), (1, ['a']), (3, [])]
+    with ExternalSorter(memory_budget=1) as sorter:
+      sorter.extend(records)
+      self.assertEqual(list(sorter), sorted(records))
+
+  def test_empty(self):
+    with ExternalSorter() as sorter:
+      self.assertEqual(list(sorter), [])
+
+class parse_size_TestCase(unittest.TestCase):
+  def test_parses_suffixes(self):
+    self.assertEqual(extsort.parse_size('4096'), 4096)
+    self.assertEqual(extsort.parse_size('512K'), 512 * 1024)
+    self.assertEqual(extsort.parse_size('256m'), 256 * 1024 * 1024)
+    self.assertEqual(extsort.parse_size('1.5G'), 3 * 1024 * 1024 * 1024 // 2)
+
+  def test_rejects_empty_sizes(self):
+    with self.assertRaises(ValueError):
+      extsort.parse_size('')
@@ -0,0 +1,175 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from toolbag import executor as executor_module
+from toolbag import extsort, fileutils, report, stats
+from toolbag.executor import Executor
+
+FILEUTILS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'toolbag', 'fileutils.py')
+
+class imports_TestCase(unittest.TestCase):
+  def test_shares_modules_with_the_package(self):
+    self.assertIs(fileutils.stats, stats)
+
+class find_duplicate_files_TestCase(unittest.TestCase):
+  def setUp(self):
+    self._temp_dir = tempfile.TemporaryDirectory()
+    self.root = self._temp_dir.name
+
+  def tearDown(self):
+    self._temp_dir.cleanup()
+
+  def write(self, name, data):
+    path = os.path.join(self.root, name)
+    with open(path, 'wb') as file:
+      file.write(data)
+    return path
+
+  def find_groups(self, low_memory=False, memory_budget=extsort.DEFAULT_MEMORY_BUDGET,
+                  file_stats=None):
+    """ Returns the (hex digest, size, [(filename, aliases)]) groups dupl
+        finds under the root, in the order it reports them.
+    """
+    file_stats = file_stats or fileutils._iterate_files_recursively(self.root)
+    with Executor(2) as executor:
+      if low_memory:
+        with fileutils._find_duplicate_files_low_memory(
+            file_stats, executor, memory_budget=memory_budget) as groups:
+          return [tuple(group[1:]) for group in groups]
+
+      aliases = dict()
+      file_sizes = dict()
+      hash_dict = fileutils._find_duplicate_files(file_stats, executor, aliases=aliases,
+                                                  file_sizes=file_sizes)
+    return [(k, file_sizes[v[0]], [(f, aliases.get(f, [])) for f in v])
+            for k, v in hash_dict.items() if len(v) > 1]
+
+  def write_mixed_tree(self):
+    end = b'e' * fileutils.PARTIAL_HASH_SIZE
+    os.mkdir(os.path.join(self.root, 'sub'))
+    for index in range(40):
+      self.write(f'sub/small{index}', str(index % 7).encode())
+      self.write(f'large{index}', end + str(index % 5).encode() * 100 + end)
+    os.link(os.path.join(self.root, 'large0'), os.path.join(self.root, 'sub', 'link'))
+    self.write('empty1', b'')
+    self.write('sub/empty2', b'')
+    self.write('unique', b'u' * 12345)
+
+  def test_low_memory_finds_the_same_groups(self):
+    self.write_mixed_tree()
+    groups = self.find_groups()
+    self.assertEqual(len(groups), 13)
+    with patch('toolbag.extsort.ExternalSorter', wraps=extsort.ExternalSorter) as sorter_mock:
+      self.assertEqual(self.find_groups(low_memory=True, memory_budget=4096), groups)
+    self.assertEqual({call.args[0] for call in sorter_mock.call_args_list}, {2048})
+
+  def assert_groups(self, expected):
+    """ Checks the groups both modes find, as sorted lists of the names of
+        each member and its aliases; the walk order is the filesystem's.
+    """
+    for low_memory in (False, True):
+      groups = [sorted(sorted(os.path.relpath(path, self.root) for path in [f, *aliases])
+                       for f, aliases in members)
+                for k, size, members in self.find_groups(low_memory)]
+      self.assertEqual(sorted(groups), expected)
+
+  def test_same_ends_with_different_middles_are_not_duplicates(self):
+    end = b'e' * fileutils.PARTIAL_HASH_SIZE
+    self.write('a', end + b'1' * 100 + end)
+    self.write('b', end + b'2' * 100 + end)
+    self.write('c', end + b'1' * 100 + end)
+    self.assertEqual(fileutils.hash_file_ends_to_hex_str(os.path.join(self.root, 'a')),
+                     fileutils.hash_file_ends_to_hex_str(os.path.join(self.root, 'b')))
+    self.assert_groups([[['a'], ['c']]])
+
+  def test_hard_links_are_aliases_not_duplicates(self):
+    self.write('a', b'data')
+    os.link(os.path.join(self.root, 'a'), os.path.join(self.root, 'b'))
+    self.assert_groups([])
+
+    self.write('c', b'data')
+    self.assert_groups([[['a', 'b'], ['c']]])
+
+  def test_empty_files_are_duplicates_of_each_other(self):
+    self.write('a', b'')
+    self.write('b', b'x')
+    self.write('c', b'')
+    self.assert_groups([[['a'], ['c']]])
+
+  def walk_and_remove(self, removed_name):
+    """ Walks the root, removing removed_name once the walk has found it. """
+    for filename, stat_result in fileutils._iterate_files_recursively(self.root):
+      if os.path.basename(filename) == removed_name:
+        os.remove(filename)
+      yield filename, stat_result
+
+  def test_files_removed_after_the_walk_are_skipped(self):
+    end = b'e' * fileutils.PARTIAL_HASH_SIZE
+    # Whichever file goes, first, middle or last in walk order, the others
+    # are still found.
+    for removed_name in ('a', 'b', 'c', 'large_a', 'large_b', 'large_c'):
+      for low_memory in (False, True):
+        with self.subTest(removed=removed_name, low_memory=low_memory):
+          for name in ('a', 'b', 'c'):
+            self.write(name, b'small')
+            self.write('large_' + name, end + b'middle' + end)
+          output = io.StringIO()
+          with redirect_stdout(output):
+            groups = self.find_groups(low_memory, file_stats=self.walk_and_remove(removed_name))
+          self.assertEqual(
+            sorted(sorted(os.path.basename(f) for f, aliases in members)
+                   for k, size, members in groups),
+            [[name for name in ('a', 'b', 'c') if name != removed_name],
+             [f'large_{name}' for name in ('a', 'b', 'c') if f'large_{name}' != removed_name]])
+          self.assertIn(f'Skipping [{os.path.join(self.root, removed_name)}]',
+                        output.getvalue())
+
+  def test_chooses_full_hash_backend_from_real_sizes(self):
+    size = executor_module.THREAD_MEDIAN_FILE_SIZE + 1
+    for name in ('a', 'b', 'c'):
+      self.write(name, b'x' * size)
+    with patch('toolbag.executor.choose_backend',
+               wraps=executor_module.choose_backend) as choose_mock, \
+         Executor(2) as executor:
+      hash_dict = fileutils._find_duplicate_files(
+        fileutils._iterate_files_recursively(self.root), executor)
+    self.assertEqual([len(files) for files in hash_dict.values()], [3])
+    sampled_sizes = [call.args[1] for call in choose_mock.call_args_list]
+    self.assertIn([2 * fileutils.PARTIAL_HASH_SIZE] * 3, sampled_sizes)
+    self.assertIn([size] * 3, sampled_sizes)
+
+
+class report_TestCase(unittest.TestCase):
+  def setUp(self):
+    self._temp_dir = tempfile.TemporaryDirectory()
+    self.root = self._temp_dir.name
+    for name in ('a', 'b'):
+      with open(os.path.join(self.root, name), 'wb') as file:
+        file.write(b'same')
+
+  def tearDown(self):
+    self._temp_dir.cleanup()
+
+  def run_dupl(self, *args):
+    return subprocess.run([sys.executable, FILEUTILS_PATH, 'dupl', self.root, '--report',
+                           report.STDOUT_PATH, *args], capture_output=True,
+                          check=True).stdout
+
+  def test_report_on_stdout_holds_only_records(self):
+    records = [json.loads(line) for line in self.run_dupl().decode().splitlines()]
+    self.assertEqual(sorted(record['path'] for record in records),
+                     [os.path.join(self.root, 'a'), os.path.join(self.root, 'b')])
+
+  def test_binary_report_on_stdout(self):
+    output = self.run_dupl('--report-format', report.FORMAT_BINARY)
+    records = list(report.read_binary_report(io.BytesIO(output)))
+    self.assertEqual(len(records), 2)
+    self.assertEqual({record['group'] for record in records}, {0})
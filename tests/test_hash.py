@@ -2,17 +2,22 @@ import unittest
 from unittest.mock import MagicMock, mock_open, patch
 
 import hashlib
+import os
+import tempfile
+import threading
 
 from toolbag import hash
 
 TEST_DATA_RAW = 'some data'.encode()
 TEST_DATA_MD5 = '1e50210a0202497fb79bc38b6ade6c34'
+TEST_DATA_SHA1 = 'baf34551fecb48acc3da868eb85e1b6dac9de356'
 TEST_DATA_SHA256 = '1307990e6ba5ca145eb35e99182a9bec46531bc54ddf656a602c780fa0240dee'
 TEST_FILE_PATH = '/path/to/file'
 TEST_STRING = 'THIS IS A TEST STRING'
 TEST_SIMPLE_ARGS = ['app', TEST_FILE_PATH]
 TEST_HASH_CHOICE_ARGS = ['app', '--algs=md5,sha1', TEST_FILE_PATH]
 TEST_ARG_SELECTED_ALGS = ['md5', 'sha1']
+TEST_BATCH_ARGS = ['app', '--algs=md5', '--jobs=2', '--pool=thread', TEST_FILE_PATH, TEST_FILE_PATH + '2']
 
 class FileHash_Class_TestCase(unittest.TestCase):
     @patch('toolbag.hash.hash_file_in_chunks_to_hex_str', return_value=TEST_STRING)
@@ -35,6 +40,14 @@ class FileHash_Class_TestCase(unittest.TestCase):
         fn = hash._FileHash(TEST_HASH_NAME, mock_hash_object, TEST_FILENAME)
         self.assertEqual(str(fn), f'{TEST_HASH_NAME:<10}{TEST_STRING}')
 
+    @patch('toolbag.hash.hash_file_in_chunks_to_hex_str')
+    def test_from_hash_str_does_not_hash_file(self, hash_func_mock):
+        TEST_HASH_NAME = 'MD5'
+
+        fn = hash._FileHash.from_hash_str(TEST_HASH_NAME, TEST_STRING)
+        self.assertEqual(str(fn), f'{TEST_HASH_NAME:<10}{TEST_STRING}')
+        hash_func_mock.assert_not_called()
+
 class HashApplication_Class_TestCase(unittest.TestCase):
     @patch('sys.argv', TEST_SIMPLE_ARGS)
     @patch('os.path.isfile', return_value=False)
@@ -84,38 +97,505 @@ class HashApplication_Class_TestCase(unittest.TestCase):
         for hash_name in supported_hashes:
             self.assertTrue(hash_name in hash._Application.SUPPORTED_HASHES)
     
+    @patch('sys.argv', TEST_HASH_CHOICE_ARGS)
+    @patch('toolbag.hash.hash_file_in_chunks_to_hex_strs',
+           return_value=[TEST_DATA_MD5, TEST_DATA_SHA1])
+    def test_compute_hashes_reads_file_once_for_all_algorithms(self, hash_func_mock):
+        app = hash._Application()
+        hashes = app.compute_hashes()
+        hash_func_mock.assert_called_once()
+        self.assertEqual([str(h) for h in hashes],
+                         [f'{"MD5":<10}{TEST_DATA_MD5}', f'{"SHA1":<10}{TEST_DATA_SHA1}'])
+
+    @patch('sys.argv', TEST_SIMPLE_ARGS)
+    @patch('os.path.isdir', return_value=False)
+    def test_single_file_is_not_batch_mode(self, isdir_mock):
+        app = hash._Application()
+        self.assertFalse(app.is_batch_mode())
+
+    @patch('sys.argv', TEST_SIMPLE_ARGS)
+    @patch('os.path.isdir', return_value=True)
+    def test_directory_is_batch_mode(self, isdir_mock):
+        app = hash._Application()
+        self.assertTrue(app.is_batch_mode())
+
+    @patch('sys.argv', ['app', '-'])
+    def test_stdin_is_batch_mode(self):
+        app = hash._Application()
+        self.assertTrue(app.is_batch_mode())
+
+    @patch('sys.argv', TEST_BATCH_ARGS)
+    @patch('toolbag.hash.hash_file_with_algorithms', return_value=[TEST_DATA_MD5])
+    @patch('builtins.print')
+    def test_run_batch_prints_sum_lines(self, print_mock, hash_func_mock):
+        app = hash._Application()
+        self.assertTrue(app.is_batch_mode())
+        self.assertEqual(app.run_batch(), 0)
+        printed = sorted(call.args[0] for call in print_mock.call_args_list)
+        self.assertEqual(printed, [f'{TEST_DATA_MD5}  {TEST_FILE_PATH}',
+                                   f'{TEST_DATA_MD5}  {TEST_FILE_PATH}2'])
+
+    @patch('sys.argv', TEST_BATCH_ARGS)
+    @patch('toolbag.hash.hash_file_with_algorithms',
+           side_effect=FileNotFoundError(2, 'No such file or directory'))
+    @patch('builtins.print')
+    def test_run_batch_counts_failures(self, print_mock, hash_func_mock):
+        app = hash._Application()
+        self.assertEqual(app.run_batch(), 2)
+
     #TODO def test_build_argument_parser_contains_required_arguments(self, add_arg_mock):
         
-class HashFileInChunksToHexStr_Func_TestCase(unittest.TestCase):
-    @patch('builtins.open', new_callable=mock_open, read_data=TEST_DATA_RAW)
-    def test_returns_hash_strings(self, open_):
+class _TempFile_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.file_path = self.write_file('data.bin', TEST_DATA_RAW)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+class HashFileInChunksToHexStr_Func_TestCase(_TempFile_TestCase):
+    def test_returns_hash_strings(self):
         hash_object = hashlib.md5()
         self.assertEqual(
-            hash.hash_file_in_chunks_to_hex_str(TEST_FILE_PATH, hash_object),
+            hash.hash_file_in_chunks_to_hex_str(self.file_path, hash_object),
             TEST_DATA_MD5)
             
         hash_object = hashlib.sha256()
         self.assertEqual(
-            hash.hash_file_in_chunks_to_hex_str(TEST_FILE_PATH, hash_object),
+            hash.hash_file_in_chunks_to_hex_str(self.file_path, hash_object),
             TEST_DATA_SHA256)
         
-    @patch('builtins.open', new_callable=mock_open, read_data=TEST_DATA_RAW)
+    @patch('builtins.open', wraps=open)
     def test_opens_file_rb_mode(self, open_):
         mock_hash_object = MagicMock()
-        hash.hash_file_in_chunks_to_hex_str(TEST_FILE_PATH, mock_hash_object)
-        open_.assert_called_with(TEST_FILE_PATH, 'rb')
+        hash.hash_file_in_chunks_to_hex_str(self.file_path, mock_hash_object)
+        open_.assert_called_with(self.file_path, 'rb', buffering=0)
     
-    @patch('builtins.open', new_callable=mock_open, read_data=TEST_DATA_RAW)
-    def test_uses_default_buffer_size(self, open_):
+    @patch('toolbag.hash.iterate_file_chunks', return_value=[TEST_DATA_RAW])
+    def test_uses_default_buffer_size(self, iterate_mock):
         mock_hash_object = MagicMock()
         hash.hash_file_in_chunks_to_hex_str(TEST_FILE_PATH, mock_hash_object)
-        handle = open_()
-        handle.read.assert_called_with(hash.DEFAULT_HASHING_CHUNK_SIZE)
+        iterate_mock.assert_called_with(TEST_FILE_PATH, hash.DEFAULT_HASHING_CHUNK_SIZE,
+                                        hash.READ_MODE_AUTO)
         
-    @patch('builtins.open', new_callable=mock_open, read_data=TEST_DATA_RAW)
-    def test_setting_chunk_size_set(self, open_):
+    @patch('toolbag.hash.iterate_file_chunks', return_value=[TEST_DATA_RAW])
+    def test_setting_chunk_size_set(self, iterate_mock):
         TEST_BUFFER_SIZE_VALUE = 123456789
         mock_hash_object = MagicMock()
         hash.hash_file_in_chunks_to_hex_str(TEST_FILE_PATH, mock_hash_object, TEST_BUFFER_SIZE_VALUE)
-        handle = open_()
-        handle.read.assert_called_with(TEST_BUFFER_SIZE_VALUE)
+        iterate_mock.assert_called_with(TEST_FILE_PATH, TEST_BUFFER_SIZE_VALUE,
+                                        hash.READ_MODE_AUTO)
+
+    def test_read_modes_agree(self):
+        data = os.urandom(100000)
+        path = self.write_file('random.bin', data)
+        for read_mode in hash.READ_MODES:
+            self.assertEqual(
+                hash.hash_file_in_chunks_to_hex_str(path, hashlib.sha256(), 4096, read_mode),
+                hashlib.sha256(data).hexdigest())
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'Needs named pipes.')
+    def test_hashes_pipes(self):
+        fifo_path = os.path.join(self.temp_dir.name, 'fifo')
+        os.mkfifo(fifo_path)
+        data = os.urandom(100000)
+
+        def write_fifo():
+            with open(fifo_path, 'wb') as fifo:
+                fifo.write(data)
+
+        for read_mode in hash.READ_MODES:
+            writer = threading.Thread(target=write_fifo)
+            writer.start()
+            self.assertEqual(
+                hash.hash_file_in_chunks_to_hex_str(fifo_path, hashlib.sha256(), 4096, read_mode),
+                hashlib.sha256(data).hexdigest())
+            writer.join()
+
+    @patch('toolbag.hash._iterate_mmap_chunks')
+    def test_auto_mode_does_not_map_large_files(self, mmap_chunks_mock):
+        path = os.path.join(self.temp_dir.name, 'large.bin')
+        with open(path, 'wb') as file:
+            file.truncate(1 << 27)
+        hash.hash_file_in_chunks_to_hex_str(path, hashlib.md5(), read_mode=hash.READ_MODE_AUTO)
+        mmap_chunks_mock.assert_not_called()
+
+    def test_empty_file_in_mmap_mode(self):
+        path = self.write_file('empty.bin', b'')
+        self.assertEqual(
+            hash.hash_file_in_chunks_to_hex_str(path, hashlib.md5(), read_mode=hash.READ_MODE_MMAP),
+            hashlib.md5().hexdigest())
+
+    def test_sparse_file_holes_hash_as_zeros(self):
+        HOLE_SIZE = 1 << 20
+        path = os.path.join(self.temp_dir.name, 'sparse.bin')
+        with open(path, 'wb') as file:
+            file.write(TEST_DATA_RAW)
+            file.seek(HOLE_SIZE, os.SEEK_CUR)
+            file.write(TEST_DATA_RAW)
+            file.truncate(file.tell() + HOLE_SIZE)
+        expected_data = TEST_DATA_RAW + bytes(HOLE_SIZE) + TEST_DATA_RAW + bytes(HOLE_SIZE)
+
+        self.assertEqual(
+            hash.hash_file_in_chunks_to_hex_str(path, hashlib.md5(), 4096, hash.READ_MODE_BUFFERED),
+            hashlib.md5(expected_data).hexdigest())
+
+    def test_rejects_unknown_read_mode(self):
+        with self.assertRaises(ValueError):
+            hash.hash_file_in_chunks_to_hex_str(self.file_path, hashlib.md5(), read_mode='bogus')
+
+class FindFileHoles_Func_TestCase(unittest.TestCase):
+    @patch('os.lseek', side_effect=OSError)
+    def test_returns_no_holes_when_unsupported(self, lseek_mock):
+        self.assertEqual(hash._find_file_holes(0, 100), [])
+
+class HashFileInChunksToHexStrs_Func_TestCase(_TempFile_TestCase):
+    def test_returns_hash_strings_for_every_hash_object(self):
+        hash_objects = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+        self.assertEqual(
+            hash.hash_file_in_chunks_to_hex_strs(self.file_path, hash_objects),
+            [TEST_DATA_MD5, TEST_DATA_SHA1, TEST_DATA_SHA256])
+
+    @patch('toolbag.hash.iterate_file_chunks', return_value=iter([TEST_DATA_RAW]))
+    def test_reads_file_once(self, iterate_mock):
+        hash_objects = [hashlib.md5(), hashlib.sha1()]
+        hash.hash_file_in_chunks_to_hex_strs(TEST_FILE_PATH, hash_objects)
+        iterate_mock.assert_called_once()
+
+    def test_single_hash_object(self):
+        self.assertEqual(
+            hash.hash_file_in_chunks_to_hex_strs(self.file_path, [hashlib.md5()]),
+            [TEST_DATA_MD5])
+
+    def test_multiple_chunks_with_every_read_mode(self):
+        data = os.urandom(50000)
+        path = self.write_file('random.bin', data)
+        for read_mode in hash.READ_MODES:
+            self.assertEqual(
+                hash.hash_file_in_chunks_to_hex_strs(
+                    path, [hashlib.md5(), hashlib.sha1()], 1000, read_mode),
+                [hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest()])
+
+    def test_small_files_are_hashed_without_threads(self):
+        with patch('toolbag.hash._get_digest_pool') as pool_mock:
+            self.assertEqual(
+                hash.hash_file_in_chunks_to_hex_strs(self.file_path, [hashlib.md5(), hashlib.sha1()]),
+                [TEST_DATA_MD5, TEST_DATA_SHA1])
+            pool_mock.assert_not_called()
+
+    def test_large_files_share_one_pool(self):
+        data = os.urandom((hash.PARALLEL_DIGEST_MIN_CHUNKS + 4) * 1000)
+        path = self.write_file('random.bin', data)
+        with patch('toolbag.hash._get_digest_pool', wraps=hash._get_digest_pool) as pool_mock:
+            for i in range(2):
+                self.assertEqual(
+                    hash.hash_file_in_chunks_to_hex_strs(path, [hashlib.md5(), hashlib.sha1()], 1000),
+                    [hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest()])
+        self.assertEqual(pool_mock.call_count, 2)
+        self.assertIs(hash._get_digest_pool(), hash._get_digest_pool())
+
+class FormatChecksumLine_Func_TestCase(unittest.TestCase):
+    def test_untagged_line(self):
+        self.assertEqual(hash.format_checksum_line(TEST_DATA_MD5, 'a b'),
+                         f'{TEST_DATA_MD5}  a b')
+
+    def test_tagged_line(self):
+        self.assertEqual(hash.format_checksum_line(TEST_DATA_MD5, 'a', 'MD5'),
+                         f'MD5 (a) = {TEST_DATA_MD5}')
+
+    def test_escapes_backslash_and_newline(self):
+        self.assertEqual(hash.format_checksum_line(TEST_DATA_MD5, 'a\\b\nc'),
+                         f'\\{TEST_DATA_MD5}  a\\\\b\\nc')
+
+class IterateFilenamesRecursively_Func_TestCase(_TempFile_TestCase):
+    def test_descends_into_directories(self):
+        os.makedirs(os.path.join(self.temp_dir.name, 'sub'))
+        nested_path = self.write_file(os.path.join('sub', 'nested.bin'), TEST_DATA_RAW)
+        self.assertEqual(
+            list(hash.iterate_filenames_recursively([self.temp_dir.name, TEST_FILE_PATH])),
+            [self.file_path, nested_path, TEST_FILE_PATH])
+
+    @patch('sys.stdin')
+    def test_reads_nul_separated_stdin(self, stdin_mock):
+        stdin_mock.buffer.read.side_effect = [b'a\0b', b'\0c\n', b'']
+        self.assertEqual(list(hash.iterate_filenames_recursively(['-'])),
+                         ['a', 'b', 'c'])
+
+class ParseChecksumLine_Func_TestCase(unittest.TestCase):
+    def test_untagged_line_infers_algorithm_from_length(self):
+        self.assertEqual(hash.parse_checksum_line(f'{TEST_DATA_SHA1}  a b\n'),
+                         ('sha1', TEST_DATA_SHA1, 'a b'))
+
+    def test_untagged_binary_marker(self):
+        self.assertEqual(hash.parse_checksum_line(f'{TEST_DATA_MD5} *a'),
+                         ('md5', TEST_DATA_MD5, 'a'))
+
+    def test_untagged_line_uses_default_algorithm(self):
+        self.assertEqual(hash.parse_checksum_line(f'{TEST_DATA_MD5}  a', 'sha256'),
+                         ('sha256', TEST_DATA_MD5, 'a'))
+
+    def test_tagged_line(self):
+        self.assertEqual(hash.parse_checksum_line(f'SHA256 (a (1)) = {TEST_DATA_SHA256}'),
+                         ('sha256', TEST_DATA_SHA256, 'a (1)'))
+
+    def test_round_trips_escaped_filenames(self):
+        filename = 'a\\b\nc'
+        line = hash.format_checksum_line(TEST_DATA_MD5, filename)
+        self.assertEqual(hash.parse_checksum_line(line), ('md5', TEST_DATA_MD5, filename))
+
+    def test_malformed_lines(self):
+        self.assertIsNone(hash.parse_checksum_line('garbage'))
+        self.assertIsNone(hash.parse_checksum_line(f'WHIRLPOOL (a) = {TEST_DATA_MD5}'))
+        self.assertIsNone(hash.parse_checksum_line('abc  a'))
+
+class VerifyChecksum_Func_TestCase(_TempFile_TestCase):
+    def test_statuses(self):
+        self.assertEqual(hash.verify_checksum('md5', TEST_DATA_MD5, self.file_path),
+                         hash.CHECK_OK)
+        self.assertEqual(hash.verify_checksum('md5', TEST_DATA_MD5[::-1], self.file_path),
+                         hash.CHECK_FAILED)
+        self.assertEqual(hash.verify_checksum('md5', TEST_DATA_MD5, TEST_FILE_PATH),
+                         hash.CHECK_MISSING)
+
+class HashApplicationCheck_TestCase(_TempFile_TestCase):
+    def run_check(self, *extra_args):
+        manifest = self.write_file('manifest', (
+            f'{TEST_DATA_MD5}  {self.file_path}\n'
+            f'SHA1 ({self.file_path}) = {TEST_DATA_SHA1[::-1]}\n'
+            f'{TEST_DATA_SHA256}  {TEST_FILE_PATH}\n'
+            'garbage\n').encode())
+        with patch('sys.argv', ['app', '--jobs=2', '--check', manifest, *extra_args]), \
+             patch('builtins.print') as print_mock:
+            app = hash._Application()
+            return app.run_check(), print_mock
+
+    def test_counts_results(self):
+        counts, print_mock = self.run_check()
+        self.assertEqual(counts, {hash.CHECK_OK: 1, hash.CHECK_FAILED: 1,
+                                  hash.CHECK_MISSING: 1})
+        print_mock.assert_called_with('OK: 1  FAILED: 1  MISSING: 1  MALFORMED: 1')
+
+    def test_fail_fast_stops_checking(self):
+        counts, print_mock = self.run_check('--fail-fast')
+        self.assertEqual(counts[hash.CHECK_FAILED] + counts[hash.CHECK_MISSING], 1)
+
+    @patch('sys.argv', ['app'])
+    @patch('sys.stderr')
+    def test_requires_file_or_manifest(self, stderr_mock):
+        with self.assertRaises(SystemExit):
+            hash._Application()
+
+class HashFileWithAlgorithms_Func_TestCase(_TempFile_TestCase):
+    def setUp(self):
+        super().setUp()
+        os.utime(self.file_path, ns=(0, 0))
+        self.cache_path = os.path.join(self.temp_dir.name, 'cache.db')
+
+    def test_hashes_without_cache(self):
+        self.assertEqual(hash.hash_file_with_algorithms(self.file_path, ['md5', 'sha1']),
+                         [TEST_DATA_MD5, TEST_DATA_SHA1])
+
+    def test_cache_hit_does_not_read_file(self):
+        hash.hash_file_with_algorithms(self.file_path, ['md5'], cache_path=self.cache_path)
+        with patch('toolbag.hash.hash_file_in_chunks_to_hex_strs') as hash_func_mock:
+            self.assertEqual(
+                hash.hash_file_with_algorithms(self.file_path, ['md5'], cache_path=self.cache_path),
+                [TEST_DATA_MD5])
+            hash_func_mock.assert_not_called()
+
+    def test_only_missing_algorithms_are_computed(self):
+        hash.hash_file_with_algorithms(self.file_path, ['md5'], cache_path=self.cache_path)
+        with patch('toolbag.hash.hash_file_in_chunks_to_hex_strs',
+                   return_value=[TEST_DATA_SHA1]) as hash_func_mock:
+            self.assertEqual(
+                hash.hash_file_with_algorithms(self.file_path, ['md5', 'sha1'],
+                                               cache_path=self.cache_path),
+                [TEST_DATA_MD5, TEST_DATA_SHA1])
+            self.assertEqual(len(hash_func_mock.call_args.args[1]), 1)
+
+class TreeHash_Class_TestCase(_TempFile_TestCase):
+    LEAF_SIZE = 1024
+
+    def setUp(self):
+        super().setUp()
+        self.data = bytearray(os.urandom(self.LEAF_SIZE * 5 + 100))
+        self.path = self.write_file('tree.bin', self.data)
+        self.leaves_path = os.path.join(self.temp_dir.name, 'tree.leaves')
+
+    def tree_hash(self, jobs=1, leaves_path=None, changed_ranges=None):
+        return hash.hash_file_tree_to_hex_str(self.path, hashlib.sha256, self.LEAF_SIZE,
+                                              jobs, leaves_path, changed_ranges)
+
+    def test_matches_reference_tree(self):
+        def h(*parts):
+            return hashlib.sha256(b''.join(parts)).digest()
+        leaves = [h(b'\x00', self.data[i:i + self.LEAF_SIZE])
+                  for i in range(0, len(self.data), self.LEAF_SIZE)]
+        level_1 = [h(b'\x01', leaves[0], leaves[1]), h(b'\x01', leaves[2], leaves[3]),
+                   h(b'\x01', leaves[4], leaves[5])]
+        level_2 = [h(b'\x01', level_1[0], level_1[1]), level_1[2]]
+        self.assertEqual(self.tree_hash(), h(b'\x01', *level_2).hex())
+
+    def test_empty_file(self):
+        path = self.write_file('empty.bin', b'')
+        self.assertEqual(hash.hash_file_tree_to_hex_str(path, hashlib.sha256),
+                         hashlib.sha256(b'\x00').hexdigest())
+
+    def test_job_count_does_not_change_digest(self):
+        self.assertEqual(self.tree_hash(jobs=1), self.tree_hash(jobs=4))
+
+    def test_saved_leaves_are_reused_for_unchanged_file(self):
+        root = self.tree_hash(leaves_path=self.leaves_path)
+        with patch('toolbag.hash.TreeHash._hash_leaf') as hash_leaf_mock:
+            self.assertEqual(self.tree_hash(leaves_path=self.leaves_path), root)
+            hash_leaf_mock.assert_not_called()
+
+    def test_only_changed_leaves_are_rehashed(self):
+        self.tree_hash(leaves_path=self.leaves_path)
+        self.data[self.LEAF_SIZE * 2 + 5] ^= 0xff
+        with open(self.path, 'r+b') as file:
+            file.seek(self.LEAF_SIZE * 2 + 5)
+            file.write(self.data[self.LEAF_SIZE * 2 + 5:self.LEAF_SIZE * 2 + 6])
+        expected = hash.hash_file_tree_to_hex_str(
+            self.write_file('copy.bin', self.data), hashlib.sha256, self.LEAF_SIZE)
+
+        with patch('toolbag.hash.TreeHash._hash_leaf',
+                   side_effect=hash.TreeHash._hash_leaf, autospec=True) as hash_leaf_mock:
+            changed = [(self.LEAF_SIZE * 2 + 5, self.LEAF_SIZE * 2 + 6)]
+            self.assertEqual(self.tree_hash(leaves_path=self.leaves_path,
+                                            changed_ranges=changed), expected)
+            self.assertEqual([c.args[2] for c in hash_leaf_mock.call_args_list], [2])
+
+    def test_growth_rehashes_tail_leaves(self):
+        self.tree_hash(leaves_path=self.leaves_path)
+        with open(self.path, 'ab') as file:
+            file.write(TEST_DATA_RAW * 500)
+        expected = hash.hash_file_tree_to_hex_str(
+            self.write_file('copy.bin', bytes(self.data) + TEST_DATA_RAW * 500),
+            hashlib.sha256, self.LEAF_SIZE)
+        self.assertEqual(self.tree_hash(leaves_path=self.leaves_path, changed_ranges=[]),
+                         expected)
+
+    def test_changed_ranges_are_rehashed_when_size_and_time_match(self):
+        self.tree_hash(leaves_path=self.leaves_path)
+        stat_result = os.stat(self.path)
+        with open(self.path, 'r+b') as file:
+            file.write(b'\xff')
+        os.utime(self.path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        self.data[0:1] = b'\xff'
+        expected = hash.hash_file_tree_to_hex_str(
+            self.write_file('copy.bin', self.data), hashlib.sha256, self.LEAF_SIZE)
+        self.assertEqual(self.tree_hash(leaves_path=self.leaves_path, changed_ranges=[(0, 1)]),
+                         expected)
+
+    @patch('sys.stderr')
+    def test_leaves_are_rejected_in_batch_mode(self, stderr_mock):
+        with patch('sys.argv', ['app', '--tree-leaves', self.leaves_path, self.path, self.path]), \
+             self.assertRaises(SystemExit):
+            hash._Application()
+
+    def test_leaves_with_other_leaf_size_are_ignored(self):
+        self.tree_hash(leaves_path=self.leaves_path)
+        tree_hash = hash.TreeHash(hashlib.sha256, self.LEAF_SIZE * 2)
+        self.assertFalse(tree_hash.load_leaves(self.leaves_path))
+
+    def test_parse_byte_ranges(self):
+        self.assertEqual(hash.parse_byte_ranges('0:10,20:30'), [(0, 10), (20, 30)])
+
+    def test_file_hash_label_wider_than_column(self):
+        fn = hash._FileHash.from_hash_str('TREE-SHA256', TEST_STRING)
+        self.assertEqual(str(fn), f'TREE-SHA256 {TEST_STRING}')
+
+    def test_leaf_size_is_part_of_the_algorithm_name(self):
+        self.assertEqual(hash.format_tree_algorithm('tree-sha256', hash.DEFAULT_TREE_LEAF_SIZE),
+                         'tree-sha256')
+        self.assertEqual(hash.format_tree_algorithm('tree-sha256', self.LEAF_SIZE),
+                         'tree-sha256-1K')
+        self.assertEqual(hash.format_tree_algorithm('tree-sha256', 1000), 'tree-sha256-1000')
+        self.assertEqual(hash._Application.get_hash_alg('tree-sha256-1K')[0], 'TREE-SHA256-1K')
+        self.assertEqual(hash.get_tree_leaf_size('tree-sha256-1K'), self.LEAF_SIZE)
+        self.assertFalse(hash.is_tree_algorithm('sha256'))
+
+    def test_parses_labels_with_leaf_size(self):
+        digest = self.tree_hash()
+        alg, hash_str, filename = hash.parse_checksum_line(
+            hash.format_checksum_line(digest, self.path, 'TREE-SHA256-1K'))
+        self.assertEqual(alg, 'tree-sha256-1K')
+        self.assertEqual(hash.verify_checksum(alg, hash_str, filename), hash.CHECK_OK)
+        self.assertEqual(hash.verify_checksum('tree-sha256', hash_str, filename),
+                         hash.CHECK_FAILED)
+
+    def test_batch_hashes_use_the_leaf_size(self):
+        cache_path = os.path.join(self.temp_dir.name, 'cache.db')
+        args = ['app', '--algs=tree-sha256', f'--tree-leaf-size={self.LEAF_SIZE}',
+                '--jobs=2', '--pool=thread', self.path, self.path]
+        with patch('sys.argv', args), patch('builtins.print') as print_mock:
+            app = hash._Application()
+            app.cache_path = cache_path
+            app.run_batch()
+        self.assertEqual(print_mock.call_args.args[0],
+                         hash.format_checksum_line(self.tree_hash(), self.path))
+        self.assertEqual(hash.hash_file_with_algorithms(self.path, ['tree-sha256'],
+                                                        cache_path=cache_path),
+                         [hash.hash_file_tree_to_hex_str(self.path, hashlib.sha256)])
+
+class HashDirectoryTree_Func_TestCase(_TempFile_TestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.temp_dir.name, 'a', 'b'))
+        os.makedirs(os.path.join(self.temp_dir.name, 'empty'))
+        for i, name in enumerate(['a/1', 'a/2', 'a/b/3', 'a/b/4', 'z']):
+            self.write_file(name, str(i).encode())
+
+    def digests(self, jobs=1):
+        return hash.hash_directory_tree(self.temp_dir.name, jobs=jobs)
+
+    def test_returns_root_and_subdirectory_digests(self):
+        self.assertEqual(sorted(self.digests()), ['.', 'a', 'a/b', 'empty'])
+
+    def test_independent_of_job_count(self):
+        self.assertEqual(self.digests(jobs=1), self.digests(jobs=4))
+
+    def test_independent_of_enumeration_order(self):
+        walk = os.walk
+        def reversed_walk(*args, **kwargs):
+            for root, directories, filenames in walk(*args, **kwargs):
+                directories.reverse()
+                yield root, directories, filenames[::-1]
+        expected = self.digests()
+        with patch('os.walk', side_effect=reversed_walk):
+            self.assertEqual(self.digests(), expected)
+
+    def test_content_change_only_changes_ancestors(self):
+        before = self.digests()
+        self.write_file('a/b/3', b'changed')
+        after = self.digests()
+        for directory in ['.', 'a', 'a/b']:
+            self.assertNotEqual(before[directory], after[directory])
+        self.assertEqual(before['empty'], after['empty'])
+
+    def test_mode_and_name_changes_change_digest(self):
+        before = self.digests()['.']
+        os.chmod(os.path.join(self.temp_dir.name, 'z'), 0o600)
+        after_chmod = self.digests()['.']
+        os.rename(os.path.join(self.temp_dir.name, 'z'), os.path.join(self.temp_dir.name, 'y'))
+        self.assertEqual(len({before, after_chmod, self.digests()['.']}), 3)
+
+class LoadTunedChunkSize_Func_TestCase(_TempFile_TestCase):
+    def test_reads_saved_chunk_size(self):
+        path = self.write_file('tuning.json', b'{"chunk_size": 1048576}')
+        self.assertEqual(hash.load_tuned_chunk_size(path), 1048576)
+
+    def test_ignores_missing_or_invalid_tuning(self):
+        self.assertIsNone(hash.load_tuned_chunk_size(TEST_FILE_PATH))
+        self.assertIsNone(hash.load_tuned_chunk_size(self.file_path))
+        path = self.write_file('tuning.json', b'{"chunk_size": 0}')
+        self.assertIsNone(hash.load_tuned_chunk_size(path))
+
+    @patch.dict('os.environ', {hash.TUNING_ENV_VAR: TEST_FILE_PATH})
+    def test_tuning_path_environment_override(self):
+        self.assertEqual(hash.get_tuning_path(), TEST_FILE_PATH)
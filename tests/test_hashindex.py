@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import unittest
+
+from toolbag import hashindex
+from toolbag.hashindex import DigestIndex, HashIndexFile
+
+TEST_DIGESTS = [hashlib.md5(str(i).encode()).digest() for i in range(100)]
+TEST_MISSING_DIGEST = hashlib.md5(b'missing').digest()
+
+class DigestIndex_TestCase(unittest.TestCase):
+  def setUp(self):
+    self.index = DigestIndex(b''.join(sorted(TEST_DIGESTS)))
+
+  def test_contains_every_digest(self):
+    for digest in TEST_DIGESTS:
+      self.assertIn(digest, self.index)
+
+  def test_does_not_contain_other_digests(self):
+    self.assertNotIn(TEST_MISSING_DIGEST, self.index)
+    self.assertNotIn(b'\x00' * 16, self.index)
+    self.assertNotIn(b'\xff' * 16, self.index)
+
+  def test_iterates_sorted_digests(self):
+    self.assertEqual(len(self.index), len(TEST_DIGESTS))
+    self.assertEqual(list(self.index), sorted(TEST_DIGESTS))
+
+  def test_empty_index(self):
+    self.assertNotIn(TEST_MISSING_DIGEST, DigestIndex())
+
+  def test_pickles_compactly(self):
+    self.assertLess(len(pickle.dumps(self.index)), 16 * len(TEST_DIGESTS) + 200)
+    self.assertIn(TEST_DIGESTS[0], pickle.loads(pickle.dumps(self.index)))
+
+  def test_rejects_partial_digests(self):
+    with self.assertRaises(ValueError):
+      DigestIndex(b'\x00' * 17)
+
+  def test_indexing(self):
+    self.assertEqual(self.index[-1], max(TEST_DIGESTS))
+    with self.assertRaises(IndexError):
+      self.index[len(TEST_DIGESTS)]
+
+class HashIndexFile_TestCase(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.records = [(digest, i * 10, f'dir/file {i}') for i, digest in enumerate(TEST_DIGESTS)]
+    self.path = self.build('a.idx', self.records)
+
+  def build(self, name, records, root=None):
+    path = os.path.join(self.temp_dir.name, name)
+    hashindex.build_index_file(path, records, root=root)
+    return path
+
+  def test_round_trips_sorted_records(self):
+    with HashIndexFile(self.path) as index_file:
+      self.assertEqual(len(index_file), len(self.records))
+      self.assertEqual(list(index_file.iterate_records()), sorted(self.records))
+
+  def test_lookups(self):
+    with HashIndexFile(self.path) as index_file:
+      self.assertIn(TEST_DIGESTS[42], index_file)
+      self.assertNotIn(TEST_MISSING_DIGEST, index_file)
+      self.assertEqual(index_file.find(TEST_DIGESTS[42]), [(420, 'dir/file 42')])
+      self.assertEqual(index_file.find(TEST_MISSING_DIGEST), [])
+
+  def test_paths_are_relative_to_the_root(self):
+    records = [(TEST_DIGESTS[0], 1, os.path.join('/mnt/archive', 'a', 'b')),
+               (TEST_DIGESTS[1], 2, os.path.join('/mnt/archive', 'c'))]
+    other_records = [(digest, size, filename.replace('/mnt/archive', 'archive'))
+                     for digest, size, filename in records]
+    with HashIndexFile(self.build('a.idx', records, '/mnt/archive')) as index_file, \
+         HashIndexFile(self.build('b.idx', other_records, 'archive'), '/media/usb') as other_file:
+      self.assertEqual(list(index_file.iterate_records()), list(other_file.iterate_records()))
+      self.assertEqual(index_file.find(TEST_DIGESTS[0]), [(1, 'a/b')])
+      self.assertEqual(other_file.find(TEST_DIGESTS[0]),
+                       [(1, os.path.join('/media/usb', 'a', 'b'))])
+
+  def test_merge_keeps_every_record(self):
+    other_records = [(TEST_DIGESTS[0], 7, 'other/copy'), (TEST_MISSING_DIGEST, 1, 'other/new')]
+    other_path = self.build('b.idx', other_records)
+    merged_path = os.path.join(self.temp_dir.name, 'merged.idx')
+    hashindex.merge_index_files(merged_path, [self.path, other_path])
+
+    with HashIndexFile(merged_path) as index_file:
+      self.assertEqual(list(index_file.iterate_records()),
+                       sorted(self.records + other_records))
+      self.assertEqual(sorted(index_file.find(TEST_DIGESTS[0])),
+                       [(0, 'dir/file 0'), (7, 'other/copy')])
+
+  def test_empty_index(self):
+    with HashIndexFile(self.build('empty.idx', [])) as index_file:
+      self.assertEqual(len(index_file), 0)
+      self.assertNotIn(TEST_MISSING_DIGEST, index_file)
+
+  def test_rejects_other_files(self):
+    path = os.path.join(self.temp_dir.name, 'bogus.idx')
+    with open(path, 'wb') as file:
+      file.write(b'x' * 100)
+    with self.assertRaises(hashindex.InvalidIndexFile):
+      HashIndexFile(path)
+
+  def test_rejects_empty_files(self):
+    path = os.path.join(self.temp_dir.name, 'empty.idx')
+    open(path, 'wb').close()
+    with self.assertRaises(hashindex.InvalidIndexFile):
+      HashIndexFile(path)
+
+  def test_rejects_truncated_files(self):
+    with open(self.path, 'r+b') as file:
+      file.truncate(hashindex.INDEX_HEADER.size + 10)
+    with self.assertRaises(hashindex.InvalidIndexFile):
+      HashIndexFile(self.path)
+
+  def test_is_index_file(self):
+    self.assertTrue(hashindex.is_index_file(self.path))
+    self.assertFalse(hashindex.is_index_file(self.temp_dir.name))
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from toolbag import mountwatch
+from toolbag.mountwatch import MountWatcher
+
+TEST_SETTLE_SECONDS = 0.05
+TEST_DELAY_SECONDS = 0.1
+
+class MountWatcher_TestCase(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+    self.path = os.path.join(self.temp_dir.name, 'mount')
+
+  def later(self, func, *args):
+    timer = threading.Timer(TEST_DELAY_SECONDS, func, args)
+    timer.start()
+    self.addCleanup(timer.join)
+
+  def test_returns_when_already_available(self):
+    os.mkdir(self.path)
+    with MountWatcher(self.path) as watcher:
+      watcher.wait_until_available(TEST_SETTLE_SECONDS)
+
+  def test_wakes_when_directory_appears(self):
+    with MountWatcher(self.path, poll_interval=60) as watcher:
+      if not watcher.is_event_driven():
+        self.skipTest('inotify is unavailable')
+      self.later(os.mkdir, self.path)
+      started = time.monotonic()
+      watcher.wait_until_available(TEST_SETTLE_SECONDS)
+      self.assertLess(time.monotonic() - started, 5)
+
+  def test_wakes_when_directory_disappears(self):
+    os.mkdir(self.path)
+    with MountWatcher(self.path, poll_interval=60) as watcher:
+      if not watcher.is_event_driven():
+        self.skipTest('inotify is unavailable')
+      self.later(os.rmdir, self.path)
+      started = time.monotonic()
+      watcher.wait_until_gone()
+      self.assertLess(time.monotonic() - started, 5)
+
+  def test_waits_for_directory_to_settle(self):
+    os.mkdir(self.path)
+    with MountWatcher(self.path) as watcher:
+      if not watcher.is_event_driven():
+        self.skipTest('inotify is unavailable')
+      self.later(os.mkdir, os.path.join(self.temp_dir.name, 'sibling'))
+      started = time.monotonic()
+      watcher.wait_until_available(2 * TEST_DELAY_SECONDS)
+      self.assertGreaterEqual(time.monotonic() - started, 3 * TEST_DELAY_SECONDS)
+
+  @patch.object(mountwatch, '_load_libc', return_value=None)
+  def test_falls_back_to_polling(self, load_libc):
+    with MountWatcher(self.path, poll_interval=TEST_SETTLE_SECONDS) as watcher:
+      self.assertFalse(watcher.is_event_driven())
+      self.later(os.mkdir, self.path)
+      watcher.wait_until_available(TEST_SETTLE_SECONDS)
+      self.assertTrue(os.path.isdir(self.path))
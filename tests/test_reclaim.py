@@ -0,0 +1,93 @@
+import errno
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from toolbag import reclaim
+
+class _TempDir_TestCase(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.temp_dir.cleanup)
+
+  def write_file(self, name, data):
+    path = os.path.join(self.temp_dir.name, name)
+    with open(path, 'wb') as file:
+      file.write(data)
+    return path
+
+class files_have_same_contents_TestCase(_TempDir_TestCase):
+  def test_same_contents(self):
+    data = os.urandom(3000)
+    self.assertTrue(reclaim.files_have_same_contents(self.write_file('a', data),
+                                                     self.write_file('b', data), 1024))
+
+  def test_different_contents(self):
+    self.assertFalse(reclaim.files_have_same_contents(
+      self.write_file('a', b'x' * 3000), self.write_file('b', b'x' * 2999 + b'y'), 1024))
+
+  def test_different_sizes(self):
+    self.assertFalse(reclaim.files_have_same_contents(self.write_file('a', b'x'),
+                                                      self.write_file('b', b'xx')))
+
+class reclaim_duplicates_TestCase(_TempDir_TestCase):
+  def setUp(self):
+    super().setUp()
+    self.original = self.write_file('original', b'data' * 100)
+    self.duplicate = self.write_file('duplicate', b'data' * 100)
+    self.alias = os.path.join(self.temp_dir.name, 'alias')
+    os.link(self.duplicate, self.alias)
+    self.groups = [[(self.original, []), (self.duplicate, [self.alias])]]
+
+  def test_dry_run_changes_nothing(self):
+    results = list(reclaim.reclaim_duplicates(self.groups, reclaim.METHOD_LINK,
+                                              dry_run=True))
+    self.assertEqual(results, [(self.duplicate, self.original, 400, None)])
+    self.assertFalse(os.path.samefile(self.original, self.duplicate))
+
+  def test_link_replaces_duplicate_and_aliases(self):
+    results = list(reclaim.reclaim_duplicates(self.groups, reclaim.METHOD_LINK))
+    self.assertEqual(results, [(self.duplicate, self.original, 400, None)])
+    self.assertTrue(os.path.samefile(self.original, self.duplicate))
+    self.assertTrue(os.path.samefile(self.original, self.alias))
+    self.assertEqual(sorted(os.listdir(self.temp_dir.name)),
+                     ['alias', 'duplicate', 'original'])
+
+  def test_links_outside_the_group_are_not_reclaimable(self):
+    groups = [[(self.original, []), (self.duplicate, [])]]
+    results = list(reclaim.reclaim_duplicates(groups, dry_run=True))
+    self.assertEqual(results, [(self.duplicate, self.original, 0, None)])
+
+  def test_skips_different_contents(self):
+    different = self.write_file('different', b'atad' * 100)
+    groups = [[(self.original, []), (different, [])]]
+    results = list(reclaim.reclaim_duplicates(groups, reclaim.METHOD_LINK))
+    self.assertEqual(results, [(different, self.original, 0, 'contents differ')])
+    self.assertFalse(os.path.samefile(self.original, different))
+
+  def test_skips_files_already_linked(self):
+    groups = [[(self.duplicate, []), (self.alias, [])]]
+    results = list(reclaim.reclaim_duplicates(groups, reclaim.METHOD_LINK))
+    self.assertEqual(results, [(self.alias, self.duplicate, 0, 'already linked')])
+
+  @patch.object(reclaim, 'reflink_file',
+                side_effect=OSError(errno.EOPNOTSUPP, 'Operation not supported'))
+  def test_unsupported_reflink_leaves_duplicate(self, reflink_file):
+    results = list(reclaim.reclaim_duplicates(self.groups, reclaim.METHOD_REFLINK))
+    self.assertEqual(results, [(self.duplicate, self.original, 0,
+                                'Operation not supported')])
+    self.assertEqual(sorted(os.listdir(self.temp_dir.name)),
+                     ['alias', 'duplicate', 'original'])
+
+  def test_leaves_existing_temporary_files_alone(self):
+    stale = self.write_file('.duplicate' + reclaim.TEMP_SUFFIX, b'stale')
+    with patch.object(reclaim, 'reflink_file',
+                      side_effect=OSError(errno.EOPNOTSUPP, 'Operation not supported')):
+      list(reclaim.reclaim_duplicates(self.groups, reclaim.METHOD_REFLINK))
+    with patch('os.replace', side_effect=OSError(errno.EACCES, 'Permission denied')):
+      list(reclaim.reclaim_duplicates(self.groups, reclaim.METHOD_LINK))
+    self.assertEqual(sorted(os.listdir(self.temp_dir.name)),
+                     ['.duplicate' + reclaim.TEMP_SUFFIX, 'alias', 'duplicate', 'original'])
+    with open(stale, 'rb') as stale_file:
+      self.assertEqual(stale_file.read(), b'stale')
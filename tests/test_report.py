@@ -0,0 +1,76 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from toolbag import report
+
+TEST_RECORDS = [
+  dict(type=report.TYPE_DUPLICATE, group=0, path='/a/one', size=100, digest='00ff' * 4),
+  dict(type=report.TYPE_DUPLICATE, group=0, path='/b/ünï,"code"', size=100,
+       digest='00ff' * 4),
+  dict(type=report.TYPE_UNREPRESENTED, group=None, path='/c/three', size=0,
+       digest='12' * 16),
+]
+
+class report_TestCase(unittest.TestCase):
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.temp_dir = temp_dir.name
+
+  def write_report(self, name, report_format=None):
+    path = os.path.join(self.temp_dir, name)
+    with report.open_report(path, report_format) as report_writer:
+      for record in TEST_RECORDS:
+        report_writer.write(record['type'], record['path'], record['size'],
+                            record['digest'], record['group'])
+    return path
+
+  def test_json_lines(self):
+    with open(self.write_report('report.jsonl')) as report_file:
+      self.assertEqual([json.loads(line) for line in report_file], TEST_RECORDS)
+
+  def test_csv(self):
+    with open(self.write_report('report.csv'), newline='') as report_file:
+      rows = list(csv.DictReader(report_file))
+    self.assertEqual([row['path'] for row in rows], [r['path'] for r in TEST_RECORDS])
+    self.assertEqual(rows[2], dict(type=report.TYPE_UNREPRESENTED, group='',
+                                   path='/c/three', size='0', digest='12' * 16))
+
+  def test_binary(self):
+    with open(self.write_report('report.bin'), 'rb') as report_file:
+      self.assertEqual(list(report.read_binary_report(report_file)), TEST_RECORDS)
+
+  def test_format_overrides_extension(self):
+    with open(self.write_report('report.csv', report.FORMAT_JSONL)) as report_file:
+      self.assertEqual(json.loads(report_file.readline()), TEST_RECORDS[0])
+
+  def test_rejects_truncated_binary(self):
+    with open(self.write_report('report.bin'), 'rb') as report_file:
+      data = report_file.read()
+    with self.assertRaises(ValueError):
+      list(report.read_binary_report(io.BytesIO(data[:-1])))
+
+  @patch.object(report, 'FLUSH_RECORDS', 2)
+  def test_flushes_after_enough_records(self):
+    report_file = io.StringIO()
+    report_writer = report.open_report(report.STDOUT_PATH, stdout=report_file)
+    with patch.object(report_file, 'flush') as flush:
+      report_writer.write(report.TYPE_UNREPRESENTED, '/a')
+      flush.assert_not_called()
+      report_writer.write(report.TYPE_UNREPRESENTED, '/b')
+      flush.assert_called_once()
+
+  @patch.object(report, 'FLUSH_SECONDS', 0.01)
+  def test_flushes_after_a_while(self):
+    report_file = io.StringIO()
+    report_writer = report.open_report(report.STDOUT_PATH, stdout=report_file)
+    with patch.object(report_file, 'flush') as flush:
+      report_writer.write(report.TYPE_UNREPRESENTED, '/a')
+      time.sleep(0.2)
+      flush.assert_called_once()
@@ -0,0 +1,75 @@
+import argparse
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from toolbag import stats
+from toolbag.executor import BACKEND_PROCESS, Executor
+from toolbag.stats import RunStats
+
+def hash_in_worker(size):
+  with stats.timed(stats.PHASE_HASH):
+    stats.add(stats.BYTES_HASHED, size)
+
+class stats_TestCase(unittest.TestCase):
+  def tearDown(self):
+    stats.install_counters(None)
+
+  def test_does_nothing_when_disabled(self):
+    self.assertIsNone(stats.get_counters())
+    with stats.timed(stats.PHASE_HASH):
+      stats.add(stats.FILES_HASHED)
+    self.assertIs(stats.timed(stats.PHASE_WALK), stats.timed(stats.PHASE_HASH))
+
+  def test_nested_phases_are_not_charged_twice(self):
+    with RunStats(json_path=os.devnull) as run_stats:
+      with stats.timed(stats.PHASE_WALK):
+        time.sleep(0.02)
+        with stats.timed(stats.PHASE_STAT):
+          time.sleep(0.05)
+      summary = run_stats.get_summary()
+    walk, stat = summary['phases']['walk'], summary['phases']['stat']
+    self.assertEqual((walk['calls'], stat['calls']), (1, 1))
+    self.assertGreaterEqual(stat['seconds'], 0.05)
+    self.assertLess(walk['seconds'], 0.05)
+
+  def test_collects_from_worker_processes(self):
+    with RunStats(json_path=os.devnull) as run_stats:
+      with Executor(2, BACKEND_PROCESS, stats.install_counters,
+                    (stats.get_counters(),)) as executor:
+        list(executor.map_unordered(hash_in_worker, range(10)))
+      summary = run_stats.get_summary()
+    self.assertEqual(summary['phases']['hash']['calls'], 10)
+    self.assertEqual(summary['counters']['bytes_hashed'], sum(range(10)))
+
+  def test_cache_hit_rate(self):
+    with RunStats(json_path=os.devnull) as run_stats:
+      stats.add(stats.CACHE_HITS, 3)
+      stats.add(stats.CACHE_MISSES)
+      self.assertEqual(run_stats.get_summary()['cache_hit_rate'], 0.75)
+
+  def test_writes_table_and_json(self):
+    stream = io.StringIO()
+    with tempfile.TemporaryDirectory() as temp_dir:
+      json_path = os.path.join(temp_dir, 'stats.json')
+      with RunStats(table=True, json_path=json_path, stream=stream):
+        with stats.timed(stats.PHASE_COPY):
+          stats.add(stats.FILES_COPIED)
+          stats.add(stats.BYTES_COPIED, 2000000)
+      with open(json_path) as json_file:
+        summary = json.load(json_file)
+    self.assertEqual(summary['counters']['files_copied'], 1)
+    self.assertIn('\ncopy ', stream.getvalue())
+    self.assertIn('Copied 1 files, 2.0 MB', stream.getvalue())
+    self.assertIsNone(stats.get_counters())
+
+  def test_arguments(self):
+    parser = argparse.ArgumentParser()
+    stats.add_stats_arguments(parser)
+    run_stats = stats.open_stats_from_args(parser.parse_args([]))
+    self.assertIsNone(run_stats.counters)
+    run_stats = stats.open_stats_from_args(parser.parse_args(['--stats-json', '-']))
+    self.assertIsNotNone(run_stats.counters)
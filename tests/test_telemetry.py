@@ -0,0 +1,84 @@
+import io
+import multiprocessing
+import threading
+import unittest
+from unittest.mock import patch
+
+from toolbag import telemetry
+from toolbag.progressbar import ProgressBar
+from toolbag.telemetry import ProgressCounters, ProgressReporter
+
+def count_file(size):
+  telemetry.count(1, size)
+
+class ProgressCounters_TestCase(unittest.TestCase):
+  def test_counts_in_this_process(self):
+    counters = ProgressCounters()
+    counters.add(1, 100)
+    counters.add(2, 50)
+    self.assertEqual(counters.get_totals(), (3, 150))
+
+  def test_counts_in_pool_workers(self):
+    counters = ProgressCounters()
+    with multiprocessing.Pool(processes=3, initializer=telemetry.install_counters,
+                              initargs=(counters,)) as pool:
+      pool.map(count_file, range(100), chunksize=1)
+    self.assertEqual(counters.get_totals(), (100, sum(range(100))))
+
+  def test_threads_count_in_slots_of_their_own(self):
+    counters = ProgressCounters()
+    def count():
+      for i in range(1000):
+        counters.add(1, 2)
+    threads = [threading.Thread(target=count) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(counters.get_totals(), (4000, 8000))
+
+  @patch.object(telemetry, 'MAX_COUNTER_SLOTS', 2)
+  def test_shares_a_slot_when_out_of_slots(self):
+    counters = ProgressCounters()
+    counters.add(1, 10)
+    with patch('os.getpid', return_value=-1):
+      counters.add(1, 10)
+    self.assertEqual(counters.get_totals(), (2, 20))
+
+class ProgressReporter_TestCase(unittest.TestCase):
+  def test_status(self):
+    reporter = ProgressReporter(enabled=False)
+    reporter.start()
+    submitted = reporter.iterate_submitted([('a', 300), ('b', 100)])
+    next(submitted)
+    reporter.counters.add(1, 100)
+    fraction, status = reporter.get_status()
+    self.assertEqual(fraction, 100 / 300)
+    self.assertIn(' 1/1 files ', status)
+    self.assertIn('ETA ?', status)
+
+    list(submitted)
+    fraction, status = reporter.get_status()
+    self.assertEqual(fraction, 0.25)
+    self.assertNotIn('ETA ?', status)
+
+  def test_renders_when_enabled(self):
+    stream = io.StringIO()
+    with ProgressReporter(enabled=True, stream=stream) as reporter:
+      reporter.counters.add(1, 0)
+    self.assertIn('files', stream.getvalue())
+
+  def test_silent_when_disabled(self):
+    stream = io.StringIO()
+    with ProgressReporter(enabled=False, stream=stream):
+      pass
+    self.assertEqual(stream.getvalue(), '')
+
+class ProgressBar_TestCase(unittest.TestCase):
+  def test_clears_longer_status(self):
+    stream = io.StringIO()
+    progress_bar = ProgressBar(20, stream)
+    progress_bar.render(0.5, ' long status')
+    progress_bar.render(1.0, ' short')
+    last_render = stream.getvalue().split('\r')[-1]
+    self.assertTrue(last_render.endswith(' short      '))
@@ -0,0 +1,34 @@
+import os
+import random
+import tempfile
+import unittest
+
+from bench import treegen
+from bench.treegen import SizeDistribution
+
+def read_tree(root):
+  contents = dict()
+  for directory, subdirectories, files in os.walk(root):
+    for name in files:
+      path = os.path.join(directory, name)
+      with open(path, 'rb') as file:
+        contents[os.path.relpath(path, root)] = file.read()
+  return contents
+
+class treegen_TestCase(unittest.TestCase):
+  def test_same_seed_makes_same_tree(self):
+    sizes = SizeDistribution('uniform:0:4K')
+    with tempfile.TemporaryDirectory() as temp_dir:
+      trees = [treegen.generate_tree(os.path.join(temp_dir, name), 7, 100, sizes,
+                                     0.3, 0.1, 2, 3) for name in ('a', 'b')]
+      self.assertEqual(read_tree(trees[0]['root']), read_tree(trees[1]['root']))
+      self.assertEqual(trees[0]['files'], 100)
+      self.assertGreater(trees[0]['duplicates'], 0)
+      self.assertGreater(trees[0]['links'], 0)
+
+  def test_size_distributions(self):
+    rng = random.Random(1)
+    self.assertEqual(SizeDistribution('fixed:2K').draw(rng), 2048)
+    self.assertLessEqual(SizeDistribution('uniform:1:10').draw(rng), 10)
+    self.assertEqual(SizeDistribution('lognormal:1G:3', 100).draw(rng), 100)
+    self.assertRaises(ValueError, SizeDistribution, 'normal:1K')
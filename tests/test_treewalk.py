@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from toolbag import treewalk
+from toolbag.treewalk import WalkFilter
+
+TEST_FILES = {
+  'a.txt': 10,
+  'b.jpg': 2000,
+  'one/c.txt': 30,
+  'one/d.jpg': 4000,
+  'one/two/e.jpg': 5000,
+  'three/f.txt': 60,
+  'three/skip/g.txt': 70,
+}
+
+class iterate_files_TestCase(unittest.TestCase):
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.root = temp_dir.name
+    for name, size in TEST_FILES.items():
+      path = os.path.join(self.root, *name.split('/'))
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'wb') as file:
+        file.write(b'x' * size)
+
+  def walk(self, **kwargs):
+    return [os.path.relpath(path, self.root).replace(os.sep, '/')
+            for path, stat_result in treewalk.iterate_files(self.root, **kwargs)]
+
+  def test_finds_every_file(self):
+    self.assertEqual(sorted(self.walk()), sorted(TEST_FILES))
+
+  def test_ordered_threads_match_serial_order(self):
+    self.assertEqual(self.walk(jobs=4, ordered=True), self.walk())
+
+  def test_unordered_threads_find_every_file(self):
+    self.assertEqual(sorted(self.walk(jobs=4, ordered=False)), sorted(TEST_FILES))
+
+  def test_yields_stat_results(self):
+    for path, stat_result in treewalk.iterate_files(self.root, jobs=2):
+      self.assertEqual(stat_result.st_size, os.path.getsize(path))
+
+  def test_include_and_size_filters(self):
+    walk_filter = WalkFilter(include=['*.jpg'], min_size=3000, max_size=4500)
+    self.assertEqual(self.walk(walk_filter=walk_filter), ['one/d.jpg'])
+
+  def test_exclude_by_name_and_path(self):
+    walk_filter = WalkFilter(exclude=['*.jpg', 'three/skip'])
+    self.assertEqual(sorted(self.walk(jobs=3, walk_filter=walk_filter)),
+                     ['a.txt', 'one/c.txt', 'three/f.txt'])
+
+  def test_excluded_directories_are_not_read(self):
+    scanned = list()
+    scandir = os.scandir
+    def tracking_scandir(path):
+      scanned.append(os.path.basename(path))
+      return scandir(path)
+
+    with patch('os.scandir', side_effect=tracking_scandir):
+      self.walk(walk_filter=WalkFilter(exclude=['one']))
+    self.assertNotIn('one', scanned)
+    self.assertNotIn('two', scanned)
+    self.assertIn('skip', scanned)
+
+  def test_reports_errors(self):
+    errors = list()
+    missing = os.path.join(self.root, 'missing')
+    list(treewalk.iterate_files(missing, jobs=2,
+                                on_error=lambda path, error: errors.append(path)))
+    self.assertEqual(errors, [missing])
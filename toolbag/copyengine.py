@@ -0,0 +1,349 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+
+try:
+  from toolbag import stats
+  from toolbag.executor import BACKEND_THREAD, Executor
+  from toolbag.hash import (format_checksum_line, hash_file_in_chunks_to_hex_str,
+                            parse_checksum_line)
+except ImportError:
+  import stats
+  from executor import BACKEND_THREAD, Executor
+  from hash import (format_checksum_line, hash_file_in_chunks_to_hex_str,
+                    parse_checksum_line)
+
+MANIFEST_NAME = '.toolbag-manifest.sha256'
+# The manifest is renamed from this once every file has been copied.
+PARTIAL_MANIFEST_NAME = MANIFEST_NAME + '.partial'
+MANIFEST_HASH_CONSTRUCTOR = hashlib.sha256
+PARTIAL_FILE_SUFFIX = '.toolbag-partial'
+# Names the source an unfinished copy was taken from, so only a copy of
+# the same volume resumes it.
+PARTIAL_SOURCE_NAME = '.toolbag-partial-source.json'
+STATE_VERSION = 1
+# Where Linux names the volumes by UUID.
+VOLUME_UUID_DIR = '/dev/disk/by-uuid'
+
+# Files are read once, and each chunk is both hashed and written.
+COPY_MODE_STREAM = 'stream'
+# Files are copied by the kernel, then the copy is read back and hashed.
+COPY_MODE_KERNEL = 'kernel'
+COPY_MODES = [COPY_MODE_STREAM, COPY_MODE_KERNEL]
+
+DEFAULT_COPY_CHUNK_SIZE = 2**20
+KERNEL_COPY_SIZE = 2**30
+PENDING_COPIES_PER_JOB = 4
+KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF}
+
+class CopyFailed(RuntimeError):
+  """ Raised by copy_tree when files could not be copied; failures holds
+      (relative path, reason) pairs.  Copying the tree again resumes.
+  """
+  def __init__(self, failures):
+    super().__init__(f'{len(failures)} files could not be copied.')
+    self.failures = failures
+
+def copy_tree(source, destination, jobs=1, copy_mode=COPY_MODE_STREAM,
+              chunk_size=DEFAULT_COPY_CHUNK_SIZE, previous_snapshot=None,
+              previous_files=None, files=None):
+  """ Copies the tree under source to destination on jobs threads, like
+      shutil.copytree, and writes a manifest of the files' digests into
+      destination that sha256sum -c (or hash --check) verifies.
+
+      Each file is written under a temporary name, synced and renamed
+      when complete, then added to the manifest.  A copy that failed or was
+      interrupted resumes when run again from the same source volume:
+      files already in the manifest whose copy still has the source's size
+      and modification time are skipped.
+
+      For an incremental copy, previous_files maps the relative paths in
+      previous_snapshot to their (size, mtime_ns, digest).  Files whose
+      size and mtime are unchanged are hard linked from there instead of
+      copied.  The same details are stored in files, if given, for every
+      file in destination.  Returns a dict of counts.
+  """
+  os.makedirs(destination, exist_ok=True)
+  partial_manifest_path = os.path.join(destination, PARTIAL_MANIFEST_NAME)
+  partial_source_path = os.path.join(destination, PARTIAL_SOURCE_NAME)
+  source_identity = get_source_identity(source)
+  completed = dict()
+  if _read_source_identity(partial_source_path) == source_identity:
+    completed = _read_manifest(partial_manifest_path)
+  else: # Another volume's copy, or none; its manifest cannot be trusted.
+    _write_source_identity(partial_source_path, source_identity)
+  previous_files = previous_files or dict()
+  files = files if files is not None else dict()
+  counts = dict(copied=0, linked=0, resumed=0, bytes=0)
+  failures = list()
+  directories = list()
+
+  def iterate_files():
+    for directory, subdirectories, filenames in os.walk(source, followlinks=True):
+      relative_directory = os.path.relpath(directory, source)
+      os.makedirs(os.path.join(destination, relative_directory), exist_ok=True)
+      directories.append(relative_directory)
+      for filename in filenames:
+        yield os.path.normpath(os.path.join(relative_directory, filename))
+
+  def copy_job(relative_path):
+    source_path = os.path.join(source, relative_path)
+    destination_path = os.path.join(destination, relative_path)
+    stat_result = os.stat(source_path)
+    if relative_path in completed and _is_unchanged_copy(stat_result, destination_path):
+      return 'resumed', completed[relative_path], stat_result
+
+    posix_path = _to_posix_path(relative_path)
+    if previous_snapshot and posix_path in previous_files:
+      size, mtime_ns, hash_str = previous_files[posix_path]
+      if (size, mtime_ns) == (stat_result.st_size, stat_result.st_mtime_ns):
+        previous_path = os.path.join(previous_snapshot, relative_path)
+        if _link_unchanged_file(previous_path, destination_path, size, mtime_ns):
+          return 'linked', hash_str, stat_result
+
+    hash_str, size = copy_file(source_path, destination_path, copy_mode, chunk_size)
+    return 'copied', hash_str, stat_result
+
+  manifest_mode = 'a' if completed else 'w'
+  with open(partial_manifest_path, manifest_mode, errors='surrogateescape') as manifest, \
+       Executor(jobs, BACKEND_THREAD) as executor:
+    for relative_path, future in executor.map_unordered(copy_job, iterate_files(),
+                                                        jobs * PENDING_COPIES_PER_JOB):
+      try:
+        action, hash_str, stat_result = future.result()
+      except OSError as e:
+        failures.append((relative_path, e.strerror or str(e)))
+        continue
+
+      posix_path = _to_posix_path(relative_path)
+      files[posix_path] = (stat_result.st_size, stat_result.st_mtime_ns, hash_str)
+      counts[action] += 1
+      if action == 'resumed':
+        continue
+      if action == 'copied':
+        counts['bytes'] += stat_result.st_size
+      manifest.write(format_checksum_line(hash_str, posix_path) + '\n')
+      manifest.flush()
+
+  if failures:
+    raise CopyFailed(failures)
+
+  for relative_directory in reversed(directories):
+    shutil.copystat(os.path.join(source, relative_directory),
+                    os.path.join(destination, relative_directory))
+  _finish_manifest(partial_manifest_path, os.path.join(destination, MANIFEST_NAME))
+  os.remove(partial_source_path)
+  return counts
+
+def copy_file(source, destination, copy_mode=COPY_MODE_STREAM,
+              chunk_size=DEFAULT_COPY_CHUNK_SIZE):
+  """ Copies a file with its permissions and times.  Returns the hex
+      digest and size of the data copied.
+  """
+  partial_path = destination + PARTIAL_FILE_SUFFIX
+  try:
+    with stats.timed(stats.PHASE_COPY), open(source, 'rb') as source_file, \
+         open(partial_path, 'wb') as destination_file:
+      if copy_mode == COPY_MODE_KERNEL:
+        size = _copy_in_kernel(source_file, destination_file)
+      else:
+        hash_str, size = _copy_and_hash(source_file, destination_file, chunk_size)
+      source_size = os.fstat(source_file.fileno()).st_size
+      if size != source_size:
+        raise OSError(errno.EIO, f'Copied {size} of {source_size} bytes')
+      destination_file.flush()
+      os.fsync(destination_file.fileno())
+
+    if copy_mode == COPY_MODE_KERNEL:
+      hash_str = hash_file_in_chunks_to_hex_str(partial_path, MANIFEST_HASH_CONSTRUCTOR(),
+                                                chunk_size)
+    shutil.copystat(source, partial_path)
+    os.replace(partial_path, destination)
+  except BaseException:
+    if os.path.lexists(partial_path):
+      os.remove(partial_path)
+    raise
+  stats.add(stats.FILES_COPIED)
+  stats.add(stats.BYTES_COPIED, size)
+  return hash_str, size
+
+def load_snapshot_state(path):
+  """ Reads the state saved by save_snapshot_state.  Returns the snapshot
+      path and its files, or (None, {}) if there is no usable state.
+  """
+  try:
+    with open(path, 'r') as state_file:
+      state = json.load(state_file)
+  except (OSError, ValueError):
+    return None, dict()
+  if state.get('version') != STATE_VERSION or not os.path.isdir(state['snapshot']):
+    return None, dict()
+  return state['snapshot'], {relative_path: tuple(details)
+                             for relative_path, details in state['files'].items()}
+
+def save_snapshot_state(path, snapshot, files):
+  """ Saves, atomically, the (size, mtime_ns, digest) of every file in the
+      snapshot for the next incremental copy_tree.
+  """
+  temp_path = path + '.tmp'
+  with open(temp_path, 'w') as state_file:
+    json.dump({'version': STATE_VERSION, 'snapshot': os.path.abspath(snapshot),
+               'files': files}, state_file)
+  os.replace(temp_path, path)
+
+def find_incomplete_copy(destination_root, source):
+  """ Returns the most recent directory under destination_root that holds
+      an unfinished copy_tree of source, from the same volume, or None.
+  """
+  try:
+    entries = sorted(os.scandir(destination_root), key=lambda entry: entry.name,
+                     reverse=True)
+  except FileNotFoundError:
+    return None
+  source_identity = get_source_identity(source)
+  for entry in entries:
+    if entry.is_dir() and \
+       os.path.isfile(os.path.join(entry.path, PARTIAL_MANIFEST_NAME)) and \
+       _read_source_identity(os.path.join(entry.path, PARTIAL_SOURCE_NAME)) == source_identity:
+      return entry.path
+  return None
+
+def get_source_identity(source):
+  """ Returns the path, device and, where the platform names it, volume
+      UUID of the source tree.  Cards swapped in one reader share a device
+      number, so the UUID tells them apart.
+  """
+  device = os.stat(source).st_dev
+  return dict(root=os.path.abspath(source), device=device,
+              volume=_find_volume_uuid(device))
+
+def _copy_and_hash(source_file, destination_file, chunk_size):
+  hash_object = MANIFEST_HASH_CONSTRUCTOR()
+  buffer = memoryview(bytearray(chunk_size))
+  size = 0
+  while True:
+    read_size = source_file.readinto(buffer)
+    if not read_size:
+      break
+    chunk = buffer[:read_size]
+    hash_object.update(chunk)
+    destination_file.write(chunk)
+    size += read_size
+  return hash_object.hexdigest(), size
+
+def _copy_in_kernel(source_file, destination_file):
+  """ Copies with copy_file_range, which can share blocks or copy on the
+      device, falling back to sendfile, then to a buffered copy.
+  """
+  source_fd = source_file.fileno()
+  destination_fd = destination_file.fileno()
+  for kernel_copy in [getattr(os, 'copy_file_range', None), _sendfile]:
+    if kernel_copy is None:
+      continue
+    size = 0
+    try:
+      while True:
+        copied = kernel_copy(source_fd, destination_fd, KERNEL_COPY_SIZE)
+        if not copied:
+          return size
+        size += copied
+    except OSError as e:
+      if size or e.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+        raise
+
+  shutil.copyfileobj(source_file, destination_file)
+  return destination_file.tell()
+
+def _sendfile(source_fd, destination_fd, count):
+  return os.sendfile(destination_fd, source_fd, None, count)
+
+def _link_unchanged_file(previous_path, destination, size, mtime_ns):
+  """ Hard links the previous snapshot's copy of a file to destination,
+      if that copy is still as it was.  Returns False otherwise.
+  """
+  try:
+    previous_stat = os.stat(previous_path)
+  except FileNotFoundError:
+    return False
+  if (previous_stat.st_size, previous_stat.st_mtime_ns) != (size, mtime_ns):
+    return False
+
+  partial_path = destination + PARTIAL_FILE_SUFFIX
+  try:
+    os.link(previous_path, partial_path)
+    os.replace(partial_path, destination)
+  except OSError as e:
+    if os.path.lexists(partial_path):
+      os.remove(partial_path)
+    if e.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+      return False
+    raise
+  return True
+
+def _is_unchanged_copy(source_stat, copy_path):
+  """ Tells whether the copy still has the source's size and modification
+      time, which copy_file gives it.
+  """
+  try:
+    copy_stat = os.stat(copy_path)
+  except OSError:
+    return False
+  return ((copy_stat.st_size, copy_stat.st_mtime_ns) ==
+          (source_stat.st_size, source_stat.st_mtime_ns))
+
+def _find_volume_uuid(device):
+  try:
+    names = os.listdir(VOLUME_UUID_DIR)
+  except OSError:
+    return None
+  for name in names:
+    try:
+      if os.stat(os.path.join(VOLUME_UUID_DIR, name)).st_rdev == device:
+        return name
+    except OSError:
+      continue
+  return None
+
+def _read_source_identity(path):
+  try:
+    with open(path, 'r') as identity_file:
+      return json.load(identity_file)
+  except (OSError, ValueError):
+    return None
+
+def _write_source_identity(path, source_identity):
+  temp_path = path + '.tmp'
+  with open(temp_path, 'w') as identity_file:
+    json.dump(source_identity, identity_file)
+  os.replace(temp_path, path)
+
+def _read_manifest(path):
+  completed = dict()
+  if os.path.isfile(path):
+    with open(path, 'r', errors='surrogateescape') as manifest:
+      for line in manifest:
+        entry = parse_checksum_line(line)
+        if entry:
+          completed[os.path.normpath(entry[2])] = entry[1]
+  return completed
+
+def _finish_manifest(partial_path, path):
+  """ Writes the final manifest, keeping only the last entry for files
+      copied again on resuming.
+  """
+  lines_by_filename = dict()
+  with open(partial_path, 'r', errors='surrogateescape') as partial_manifest:
+    for line in partial_manifest:
+      entry = parse_checksum_line(line)
+      if entry:
+        lines_by_filename.pop(entry[2], None)
+        lines_by_filename[entry[2]] = line
+  with open(partial_path, 'w', errors='surrogateescape') as partial_manifest:
+    partial_manifest.writelines(lines_by_filename.values())
+  os.replace(partial_path, path)
+
+def _to_posix_path(path):
+  return path.replace(os.sep, '/') if os.sep != '/' else path
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+
+try:
+  from toolbag import stats
+except ImportError:
+  import stats
+
+CACHE_DIR_NAME = 'toolbag'
+CACHE_FILE_NAME = 'digests.sqlite3'
+CACHE_ENV_VAR = 'TOOLBAG_DIGEST_CACHE'
+
+SECONDS_IN_DAY = 86400
+DEFAULT_MAX_AGE_SECONDS = 90 * SECONDS_IN_DAY
+DEFAULT_MAX_ENTRIES = 10000000
+# Hits only rewrite an entry's last used time once it is this stale.
+LAST_USED_REFRESH_SECONDS = SECONDS_IN_DAY
+# Files modified this recently are not stored; a write within the same
+# timestamp tick would otherwise go unnoticed.
+RACY_MTIME_WINDOW_SECONDS = 2
+BUSY_TIMEOUT_SECONDS = 60
+
+_open_caches = dict()
+_open_caches_lock = threading.Lock()
+
+class DigestCache:
+  """ A persistent map from file identity to digest.
+
+      Entries are keyed by (device, inode, algorithm) and are only returned
+      while the file's size and mtime_ns still match, so unchanged files
+      need not be read again.  Every thread and process gets its own SQLite
+      connection; the database runs in WAL mode so pool workers can write
+      concurrently.
+  """
+  SCHEMA = ('CREATE TABLE IF NOT EXISTS digests ('
+            '  device INTEGER NOT NULL,'
+            '  inode INTEGER NOT NULL,'
+            '  algorithm TEXT NOT NULL,'
+            '  size INTEGER NOT NULL,'
+            '  mtime_ns INTEGER NOT NULL,'
+            '  digest TEXT NOT NULL,'
+            '  last_used INTEGER NOT NULL,'
+            '  PRIMARY KEY (device, inode, algorithm)'
+            ') WITHOUT ROWID;'
+            'CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used);')
+
+  def __init__(self, path):
+    self._path = path
+    self._local = threading.local()
+
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self._connection().executescript(DigestCache.SCHEMA)
+
+  def get_path(self):
+    return self._path
+
+  def lookup(self, stat_result, algorithm):
+    row = self._connection().execute(
+      'SELECT digest, last_used FROM digests WHERE device=? AND inode=? AND '
+      'algorithm=? AND size=? AND mtime_ns=?',
+      (stat_result.st_dev, stat_result.st_ino, algorithm,
+       stat_result.st_size, stat_result.st_mtime_ns)).fetchone()
+
+    if row is None:
+      stats.add(stats.CACHE_MISSES)
+      return None
+
+    stats.add(stats.CACHE_HITS)
+    digest, last_used = row
+    now = int(time.time())
+    if now - last_used > LAST_USED_REFRESH_SECONDS:
+      with self._connection() as connection:
+        connection.execute(
+          'UPDATE digests SET last_used=? WHERE device=? AND inode=? AND algorithm=?',
+          (now, stat_result.st_dev, stat_result.st_ino, algorithm))
+    return digest
+
+  def store(self, stat_result, digests_by_algorithm):
+    now = time.time()
+    if now - stat_result.st_mtime_ns / 1e9 < RACY_MTIME_WINDOW_SECONDS:
+      return
+
+    rows = [(stat_result.st_dev, stat_result.st_ino, algorithm,
+             stat_result.st_size, stat_result.st_mtime_ns, digest, int(now))
+            for algorithm, digest in digests_by_algorithm.items()]
+    with self._connection() as connection:
+      connection.executemany(
+        'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+  def evict(self, max_age_seconds=DEFAULT_MAX_AGE_SECONDS,
+            max_entries=DEFAULT_MAX_ENTRIES):
+    """ Drops entries unused for max_age_seconds, then the least recently
+        used entries beyond max_entries.  Returns the number dropped.
+    """
+    with self._connection() as connection:
+      oldest_kept = int(time.time()) - max_age_seconds
+      evicted = connection.execute(
+        'DELETE FROM digests WHERE last_used < ?', (oldest_kept,)).rowcount
+
+      entry_count = connection.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+      if entry_count > max_entries:
+        evicted += connection.execute(
+          'DELETE FROM digests WHERE (device, inode, algorithm) IN ('
+          '  SELECT device, inode, algorithm FROM digests ORDER BY last_used LIMIT ?)',
+          (entry_count - max_entries,)).rowcount
+    return evicted
+
+  def clear(self):
+    with self._connection() as connection:
+      connection.execute('DELETE FROM digests')
+
+  def close(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection:
+      connection.close()
+      self._local.connection = None
+
+  def _connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None or self._local.pid != os.getpid():
+      connection = sqlite3.connect(self._path, timeout=BUSY_TIMEOUT_SECONDS)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self._local.connection = connection
+      self._local.pid = os.getpid()
+    return connection
+
+
+def get_cache_dir():
+  cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+  return os.path.join(cache_home, CACHE_DIR_NAME)
+
+def get_default_cache_path():
+  return os.path.join(get_cache_dir(), CACHE_FILE_NAME)
+
+def get_digest_cache(path):
+  """ Returns the cache for path, opening it once per process.  Pool workers
+      are handed the path rather than the cache itself.
+  """
+  key = (os.getpid(), path)
+  with _open_caches_lock:
+    if key not in _open_caches:
+      _open_caches[key] = DigestCache(path)
+    return _open_caches[key]
+
+def add_cache_arguments(parser):
+  CACHE_ARG_HELP = ('Reuse digests of unchanged files from an on-disk cache '
+                    f'(also enabled by setting {CACHE_ENV_VAR}).')
+  NO_CACHE_ARG_HELP = 'Do not use the digest cache.'
+  REBUILD_CACHE_ARG_HELP = 'Empty the digest cache before use.'
+  CACHE_PATH_ARG_HELP = 'The digest cache file to use.'
+
+  parser.add_argument('--cache', help=CACHE_ARG_HELP, action='store_true')
+  parser.add_argument('--no-cache', help=NO_CACHE_ARG_HELP, action='store_true')
+  parser.add_argument('--rebuild-cache', help=REBUILD_CACHE_ARG_HELP,
+                      action='store_true')
+  parser.add_argument('--cache-path', help=CACHE_PATH_ARG_HELP)
+
+def get_cache_path_from_args(args):
+  """ Returns the digest cache path selected by the arguments added by
+      add_cache_arguments, or None when caching is off.
+  """
+  if args.no_cache:
+    return None
+  if args.cache or args.rebuild_cache or args.cache_path or os.environ.get(CACHE_ENV_VAR):
+    return args.cache_path or get_default_cache_path()
+  return None
+
+def open_cache_from_args(args):
+  """ Opens the selected cache in the parent process, emptying it first if
+      asked.  Returns the cache path, or None when caching is off.
+  """
+  path = get_cache_path_from_args(args)
+  if path and args.rebuild_cache:
+    get_digest_cache(path).clear()
+  return path
+
+def evict_cache(path):
+  if path:
+    get_digest_cache(path).evict()
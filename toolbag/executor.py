@@ -0,0 +1,236 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import itertools
+import math
+import multiprocessing
+import queue
+import signal
+import statistics
+import threading
+
+BACKEND_AUTO = 'auto'
+BACKEND_THREAD = 'thread'
+BACKEND_PROCESS = 'process'
+BACKEND_INLINE = 'inline'
+BACKENDS = (BACKEND_AUTO, BACKEND_THREAD, BACKEND_PROCESS, BACKEND_INLINE)
+
+# The auto backend is chosen from the sizes of this many leading files.
+SAMPLE_FILES = 256
+# Files this large spend their time in reads and hashlib, which release the
+# GIL, so threads keep up with processes without forking or pickling.
+THREAD_MEDIAN_FILE_SIZE = int(math.pow(2,18))
+# Items submitted per worker ahead of their results.
+PENDING_ITEMS_PER_JOB = 4
+# How often a feeder waiting for room checks whether the executor stopped.
+FEEDER_POLL_SECONDS = 0.1
+
+_FEED_DONE = object()
+_FEED_FAILED = object()
+
+def choose_backend(jobs, sizes):
+  """ Picks a backend for work on files of the sampled sizes.  Work runs
+      inline only on a single job.
+  """
+  if jobs <= 1:
+    return BACKEND_INLINE
+  if sizes and statistics.median(sizes) >= THREAD_MEDIAN_FILE_SIZE:
+    return BACKEND_THREAD
+  return BACKEND_PROCESS
+
+
+class Executor:
+  """ Runs functions on threads, on processes or inline, behind one
+      interface, keeping the workers warm from one phase of work to the
+      next.
+
+      The auto backend is chosen for each phase of work by resolve_from,
+      from the sizes of its first files, and the phase passes the backend
+      on to the methods that submit work; unresolved work on several
+      jobs goes to threads.  A pool is started for each backend used.
+      initializer(*initargs) runs in each worker process, or once here
+      for the other backends.  Worker processes ignore SIGINT, so on
+      Ctrl-C the parent alone is interrupted, and leaving the executor's
+      context with an exception terminates the workers instead of
+      waiting for them.
+  """
+  def __init__(self, jobs=1, backend=BACKEND_AUTO, initializer=None, initargs=()):
+    self.jobs = max(jobs, 1)
+    self.backend = backend
+    self._initializer = initializer
+    self._initargs = initargs
+    self._pools = dict()
+    self._initialized_here = False
+    self._start_lock = threading.Lock()
+    self._stopped = threading.Event()
+
+  def resolve_from(self, items, size_of):
+    """ Returns the backend for a phase of work on the items, resolving
+        the auto backend from the sizes of the leading items, and an
+        iterator over all of the items.
+    """
+    if self.backend != BACKEND_AUTO:
+      return self.backend, items
+    items = iter(items)
+    sample = list(itertools.islice(items, SAMPLE_FILES))
+    backend = choose_backend(self.jobs, [size_of(item) for item in sample])
+    return backend, itertools.chain(sample, items)
+
+  def submit(self, func, *args, backend=None):
+    """ Returns a Future for func(*args), run on backend, by default the
+        executor's.
+    """
+    backend = self._resolve(backend)
+    pool = self._start(backend)
+    future = Future()
+    if backend == BACKEND_PROCESS:
+      pool.apply_async(func, args, callback=future.set_result,
+                       error_callback=future.set_exception)
+      return future
+    if backend == BACKEND_THREAD:
+      return pool.submit(func, *args)
+
+    try:
+      future.set_result(func(*args))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  def map_unordered(self, func, items, max_pending=None, backend=None):
+    """ Yields (item, future) pairs as the futures complete, submitting items
+        from this generator, lazily, so that no more than max_pending are
+        outstanding at a time.
+    """
+    max_pending = max_pending or self.jobs * PENDING_ITEMS_PER_JOB
+    pending = dict()
+    for item in items:
+      pending[self.submit(func, item, backend=backend)] = item
+      if len(pending) >= max_pending:
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          yield pending.pop(future), future
+
+    while pending:
+      done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        yield pending.pop(future), future
+
+  def imap_unordered(self, func, items, max_pending=None, backend=None, resolve=None):
+    """ Returns an iterator of (item, future) pairs like map_unordered, but
+        the items are taken and submitted, from now on, by a thread of
+        their own.  So several streams of work can be fed at once, and the
+        items may depend on the results of another stream.  An error raised
+        by the items is raised by the iterator.
+
+        resolve, if given, is called from that thread with the items and
+        returns the backend and the items to submit, so a backend can be
+        resolved from items that are still to come.
+    """
+    if resolve is None:
+      self._start(self._resolve(backend))
+    elif self._stopped.is_set():
+      raise ValueError('The executor has been stopped.')
+    max_pending = max_pending or self.jobs * PENDING_ITEMS_PER_JOB
+    finished = queue.SimpleQueue()
+    room = threading.Semaphore(max_pending)
+
+    def feed():
+      submitted = 0
+      try:
+        feed_backend, feed_items = resolve(items) if resolve else (backend, items)
+        for item in feed_items:
+          while not room.acquire(timeout=FEEDER_POLL_SECONDS):
+            if self._stopped.is_set():
+              return
+          future = self.submit(func, item, backend=feed_backend)
+          future.add_done_callback(lambda future, item=item: finished.put((item, future)))
+          submitted += 1
+      except BaseException as e:
+        finished.put((_FEED_FAILED, e))
+        return
+      finished.put((_FEED_DONE, submitted))
+
+    threading.Thread(target=feed, daemon=True).start()
+    return self._iterate_finished(finished, room)
+
+  def close(self):
+    """ Waits for the submitted work, then stops the workers. """
+    self._stopped.set()
+    with self._start_lock:
+      pools, self._pools = self._pools, dict()
+    for backend, pool in pools.items():
+      if backend == BACKEND_PROCESS:
+        pool.close()
+        pool.join()
+      else:
+        pool.shutdown(wait=True)
+
+  def terminate(self):
+    """ Stops the workers without waiting for the submitted work.  Threads
+        finish the items they are running.
+    """
+    self._stopped.set()
+    with self._start_lock:
+      pools, self._pools = self._pools, dict()
+    for backend, pool in pools.items():
+      if backend == BACKEND_PROCESS:
+        pool.terminate()
+      else:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type:
+      self.terminate()
+    else:
+      self.close()
+
+  def _iterate_finished(self, finished, room):
+    yielded = 0
+    submitted = None
+    while submitted is None or yielded < submitted:
+      item, future = finished.get()
+      if item is _FEED_DONE:
+        submitted = future
+      elif item is _FEED_FAILED:
+        raise future
+      else:
+        room.release()
+        yielded += 1
+        yield item, future
+
+  def _resolve(self, backend):
+    backend = backend or self.backend
+    if backend == BACKEND_AUTO:
+      return BACKEND_THREAD if self.jobs > 1 else BACKEND_INLINE
+    return backend
+
+  def _start(self, backend):
+    """ Returns the pool for backend, starting it on first use, or None
+        for inline work.
+    """
+    if self._stopped.is_set():
+      raise ValueError('The executor has been stopped.')
+    pool = self._pools.get(backend)
+    if pool or (backend == BACKEND_INLINE and self._initialized_here):
+      return pool
+    with self._start_lock:
+      if self._stopped.is_set():
+        raise ValueError('The executor has been stopped.')
+      if backend == BACKEND_PROCESS and backend not in self._pools:
+        self._pools[backend] = multiprocessing.Pool(
+          processes=self.jobs, initializer=_init_process,
+          initargs=(self._initializer, self._initargs))
+      elif backend != BACKEND_PROCESS:
+        if not self._initialized_here and self._initializer:
+          self._initializer(*self._initargs)
+        self._initialized_here = True
+        if backend == BACKEND_THREAD and backend not in self._pools:
+          self._pools[backend] = ThreadPoolExecutor(max_workers=self.jobs)
+      return self._pools.get(backend)
+
+
+def _init_process(initializer, initargs):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  if initializer:
+    initializer(*initargs)
@@ -0,0 +1,120 @@
+import heapq
+import pickle
+import tempfile
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+DEFAULT_MEMORY_BUDGET = 1 << 28
+# Estimated bytes a record's tuple and its items cost, beside their contents.
+RECORD_OVERHEAD_BYTES = 160
+# Records are written to runs, and read back while merging, this many at a time.
+RUN_BLOCK_RECORDS = 256
+# At most this many runs are merged at once; more are merged in several passes.
+MAX_MERGE_WIDTH = 64
+
+class ExternalSorter:
+  """ Sorts more records than fit in memory.
+
+      Records are collected until their estimated size passes the memory
+      budget, then sorted and written to a temporary run file.  Iterating
+      merges the runs, holding only a block of records per run.  Records
+      are tuples of ints, strings, bytes and lists of those, compared as
+      tuples.
+  """
+  def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+    self._memory_budget = memory_budget
+    self._temp_dir = temp_dir
+    self._records = list()
+    self._records_bytes = 0
+    self._runs = list()
+    self._count = 0
+
+  def add(self, record):
+    self._records.append(record)
+    self._records_bytes += _estimate_record_size(record)
+    self._count += 1
+    if self._records_bytes >= self._memory_budget:
+      self._spill()
+
+  def extend(self, records):
+    for record in records:
+      self.add(record)
+
+  def get_run_count(self):
+    return len(self._runs)
+
+  def __len__(self):
+    return self._count
+
+  def __iter__(self):
+    if not self._runs:
+      self._records.sort()
+      return iter(self._records)
+
+    self._spill()
+    while len(self._runs) > MAX_MERGE_WIDTH:
+      merge_runs = self._runs[:MAX_MERGE_WIDTH]
+      del self._runs[:MAX_MERGE_WIDTH]
+      self._runs.append(self._write_run(heapq.merge(*map(_iterate_run, merge_runs))))
+      for run in merge_runs:
+        run.close()
+    return heapq.merge(*map(_iterate_run, self._runs))
+
+  def close(self):
+    self._records = list()
+    for run in self._runs:
+      run.close()
+    self._runs = list()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _spill(self):
+    if self._records:
+      self._records.sort()
+      self._runs.append(self._write_run(self._records))
+      self._records = list()
+      self._records_bytes = 0
+
+  def _write_run(self, records):
+    run = tempfile.TemporaryFile(prefix='toolbag_sort_', dir=self._temp_dir)
+    block = list()
+    for record in records:
+      block.append(record)
+      if len(block) >= RUN_BLOCK_RECORDS:
+        pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+        block = list()
+    if block:
+      pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+    run.flush()
+    return run
+
+
+def parse_size(size_str):
+  """ Parses a byte count such as 4096, 512K, 256M or 1.5G. """
+  if not size_str:
+    raise ValueError('Empty size.')
+  suffix = size_str[-1].upper()
+  if suffix in SIZE_SUFFIXES:
+    return int(float(size_str[:-1]) * SIZE_SUFFIXES[suffix])
+  return int(size_str)
+
+def _iterate_run(run):
+  run.seek(0)
+  while True:
+    try:
+      block = pickle.load(run)
+    except EOFError:
+      return
+    yield from block
+
+def _estimate_record_size(record):
+  size = RECORD_OVERHEAD_BYTES
+  for item in record:
+    if isinstance(item, (str, bytes)):
+      size += len(item)
+    elif isinstance(item, (list, tuple)):
+      size += _estimate_record_size(item)
+  return size
@@ -1,122 +1,693 @@
+from contextlib import contextmanager, redirect_stdout
 from datetime import datetime
 import hashlib
 from functools import partial
-import multiprocessing
+import math
+import mmap
+from operator import itemgetter
 import os
-import shutil
-import time
+import queue
+import sys
+import tempfile
+import threading
 
-from hash import hash_file_in_chunks_to_hex_str
+try:
+  from toolbag import (copyengine, digestcache, extsort, hashindex, mountwatch, reclaim,
+                       report, stats, telemetry, treewalk)
+  from toolbag.executor import BACKEND_AUTO, BACKENDS, Executor
+  from toolbag.hashindex import DigestIndex, HashIndexFile
+  from toolbag.mountwatch import MountWatcher
+  from toolbag.hash import hash_file_in_chunks_to_hex_str, hash_file_with_algorithms
+except ImportError:
+  import copyengine
+  import digestcache
+  import extsort
+  import hashindex
+  import mountwatch
+  import reclaim
+  import report
+  import stats
+  import telemetry
+  import treewalk
+  from executor import BACKEND_AUTO, BACKENDS, Executor
+  from hashindex import DigestIndex, HashIndexFile
+  from mountwatch import MountWatcher
+  from hash import hash_file_in_chunks_to_hex_str, hash_file_with_algorithms
 
 # Good Idea Fairy
 # - Argument to make non-recursive.
 # - Add runtime.
 
-# Replace with a progress bar class.
-files_hashed_count = 0
+# The reference digests for repr, mapped once per worker process by path.
+_reference_indexes = dict()
+_reference_indexes_lock = threading.Lock()
 
-def hash_file_to_hex_str(filename):
+# Bytes hashed from each end of a file when screening duplicate candidates.
+PARTIAL_HASH_SIZE = int(math.pow(2,12))
+# Pool tasks carry about this much file data, or this many files.
+BATCH_TARGET_BYTES = int(math.pow(2,24))
+BATCH_MAX_FILES = 256
+# Where evac --incremental keeps the files of the last snapshot by default.
+EVAC_STATE_NAME = '.toolbag-evac-state.json'
+# Pool tasks submitted ahead of their results in low memory mode.
+LOW_MEMORY_PENDING_BATCHES = 64
+# Low memory mode reads each stage's sorter while filling the next one, so
+# this many sorters hold records at once and share the memory budget.
+LOW_MEMORY_LIVE_SORTERS = 2
+
+def hash_file_to_hex_str(filename, cache_path=None):
+  if cache_path:
+    return hash_file_with_algorithms(filename, ['md5'], cache_path=cache_path)[0]
   return hash_file_in_chunks_to_hex_str(filename, hashlib.md5())
 
-def hash_file_to_hash_file_tuple(filename):
-  return (hash_file_to_hex_str(filename), filename)
+def hash_file_to_hash_file_tuple(filename, cache_path=None):
+  return (hash_file_to_hex_str(filename, cache_path), filename)
 
-def _get_file_unrepresented_in_archive(archive_hash_list, filename):
-  hash_string = hash_file_in_chunks_to_hex_str(filename, hashlib.md5())
-  if hash_string not in archive_hash_list:
-    return filename
+def hash_file_ends_to_hex_str(filename):
+  """ Hashes the first and last PARTIAL_HASH_SIZE bytes of a file.  Files no
+      larger than both ends together are hashed whole, so for them the
+      result is the same as hash_file_to_hex_str.
+  """
+  hash_object = hashlib.md5()
+  with stats.timed(stats.PHASE_HASH), open(filename, 'rb') as file:
+    head = file.read(2 * PARTIAL_HASH_SIZE + 1)
+    if len(head) <= 2 * PARTIAL_HASH_SIZE:
+      hash_object.update(head)
+    else:
+      hash_object.update(head[:PARTIAL_HASH_SIZE])
+      file.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+      hash_object.update(file.read(PARTIAL_HASH_SIZE))
+  stats.add(stats.FILES_HASHED)
+  stats.add(stats.BYTES_HASHED, min(len(head), 2 * PARTIAL_HASH_SIZE))
+  return hash_object.hexdigest()
 
-def _build_filename_list_recursively(directory):
-  filename_list = list()
-  for root, directories, filenames in os.walk(directory):
-    for filename in filenames:
-      filename_list.append(os.path.join(root, filename))
-  return filename_list
-  
-def _build_file_hash_tuples_from_files(filenames, jobs=1):
-  proc_pool = multiprocessing.Pool(processes=jobs)
-  hash_list = proc_pool.map(hash_file_to_hash_file_tuple, filenames)
-  proc_pool.close()
-  
-  return hash_list
+def hash_file_ends_to_hash_file_tuple(filename):
+  return (hash_file_ends_to_hex_str(filename), filename)
+
+def hash_file_to_digest(filename, cache_path=None):
+  return bytes.fromhex(hash_file_to_hex_str(filename, cache_path))
+
+def hash_file_ends_to_candidate_record(candidate):
+  index, size, filename, aliases = candidate
+  return (size, bytes.fromhex(hash_file_ends_to_hex_str(filename)), index, filename,
+          aliases)
+
+def hash_file_to_candidate_record(candidate, cache_path=None):
+  index, filename, aliases, size = candidate
+  return (hash_file_to_digest(filename, cache_path), index, filename, aliases, size)
+
+def hash_file_to_index_record(filename, cache_path=None):
+  return (hash_file_to_digest(filename, cache_path), os.path.getsize(filename), filename)
+
+def _init_worker(counters, stats_counters):
+  if counters:
+    telemetry.install_counters(counters)
+  stats.install_counters(stats_counters)
+
+def _create_executor(jobs, backend=BACKEND_AUTO, progress=None):
+  """ Returns an Executor that installs the progress and stats counters
+      in its workers.  One executor serves every phase of a command, so
+      its workers are started once.
+  """
+  counters = progress.counters if progress else None
+  return Executor(jobs, backend, initializer=_init_worker,
+                  initargs=(counters, stats.get_counters()))
+
+def _load_reference_index(path):
+  """ Maps the reference index file, or raw sorted digests file, at path
+      once per process, sharing its pages with the other workers.
+  """
+  with _reference_indexes_lock:
+    if path not in _reference_indexes:
+      if hashindex.is_index_file(path):
+        _reference_indexes[path] = HashIndexFile(path)
+      else:
+        with open(path, 'rb') as digests_file:
+          buffer = b'' # Empty files cannot be mapped.
+          if os.fstat(digests_file.fileno()).st_size:
+            buffer = mmap.mmap(digests_file.fileno(), 0, access=mmap.ACCESS_READ)
+        _reference_indexes[path] = DigestIndex(buffer)
+    return _reference_indexes[path]
+
+def _get_file_unrepresented_in_archive(filename, reference_path, cache_path=None):
+  """ Returns the file's (digest, size, filename) if no file in the
+      reference index at reference_path has its digest.
+  """
+  record = hash_file_to_index_record(filename, cache_path)
+  with stats.timed(stats.PHASE_COMPARE):
+    represented = record[0] in _load_reference_index(reference_path)
+  if not represented:
+    return record
+
+def _iterate_files_recursively(directory, jobs=1, ordered=True, walk_filter=None):
+  """ Yields (path, stat_result) for every regular file under the directory,
+      and accepted by walk_filter, in os.walk order unless jobs threads
+      may read directories out of order.  os.scandir supplies the entry
+      types, so only files are stat()ed, and the walk is never held in
+      memory.
+  """
+  yield from treewalk.iterate_files(directory, jobs, ordered, walk_filter,
+                                    _print_walk_error)
+
+def _iterate_files_from_args(directory, args):
+  walk_filter = treewalk.WalkFilter(args.include, args.exclude, args.min_size,
+                                    args.max_size)
+  return _iterate_files_recursively(directory, args.walk_jobs,
+                                    args.walk_jobs <= 1 or args.ordered, walk_filter)
+
+def _print_walk_error(path, error):
+  print('  Skipping ['+path+']: '+(error.strerror or str(error)))
+
+def _build_filename_list_recursively(directory, jobs=1, ordered=True, walk_filter=None):
+  return [filename for filename, stat_result in
+          _iterate_files_recursively(directory, jobs, ordered, walk_filter)]
+
+def _batch_files_by_size(file_sizes, target_bytes=BATCH_TARGET_BYTES,
+                         max_files=BATCH_MAX_FILES):
+  """ Groups (filename, size) pairs into lists holding about target_bytes
+      of data, so many small files share one pool task while large files
+      get a task each.
+  """
+  batch = list()
+  batch_bytes = 0
+  for filename, size in file_sizes:
+    batch.append((filename, size))
+    batch_bytes += size
+    if batch_bytes >= target_bytes or len(batch) >= max_files:
+      yield batch
+      batch = list()
+      batch_bytes = 0
+  if batch:
+    yield batch
+
+def _apply_to_batch(func, file_sizes):
+  """ Returns the results of func for the files of a batch, and the
+      (path, error) of those that could not be read.
+  """
+  results = list()
+  errors = list()
+  for filename, size in file_sizes:
+    try:
+      results.append(func(filename))
+    except OSError as e:
+      errors.append((e.filename or str(filename), e))
+    telemetry.count(1, size)
+  return results, errors
+
+def _imap_files_unordered(executor, func, file_sizes, max_pending=None, progress=None):
+  """ Returns an iterator of func(filename) for each (filename, size) pair,
+      in the order the executor finishes them.  Files that cannot be read,
+      such as files removed since the walk, are reported and left out.
+      The executor's auto backend is resolved for this phase alone, from
+      the sizes of its leading pairs.  A feeder thread starts taking the
+      pairs straight away; with max_pending, batches are instead submitted
+      from the iterator, at most max_pending ahead of the results.  The
+      pairs are added to the work progress shows.
+  """
+  def resolve(file_sizes):
+    backend, file_sizes = executor.resolve_from(file_sizes, itemgetter(1))
+    if progress:
+      file_sizes = progress.iterate_submitted(file_sizes)
+    return backend, _batch_files_by_size(file_sizes)
+
+  batch_job = partial(_apply_to_batch, func)
+  if max_pending:
+    backend, batches = resolve(file_sizes)
+    return _iterate_batch_results(executor.map_unordered(batch_job, batches, max_pending,
+                                                         backend))
+  return _iterate_batch_results(executor.imap_unordered(batch_job, file_sizes,
+                                                        resolve=resolve))
+
+def _iterate_batch_results(finished_batches):
+  for batch, future in finished_batches:
+    results, errors = future.result()
+    for path, error in errors:
+      _print_walk_error(path, error)
+    yield from results
+
+def _find_duplicate_files(file_stats, executor, cache_path=None, counts=None,
+                          aliases=None, file_sizes=None, progress=None):
+  """ Returns a dict of full hash to filenames, covering every file that
+      may have a duplicate.  Candidates are narrowed in stages so that most
+      files are never read: files with a unique size are dropped first, then
+      files whose ends hash uniquely, and only the rest are hashed in full.
+
+      Hard links are not duplicates: only the first path found for each
+      inode is hashed, and the others are added to its list in aliases if
+      given.  The size of each file returned is stored in file_sizes if
+      given.
+
+      The stages are streamed; ends are hashed while the walk is still
+      running.  Counts of located, linked, candidate and fully hashed files
+      are stored in counts if given.
+  """
+  counts = counts if counts is not None else dict()
+  counts.update(located=0, links=0, candidates=0, full=0)
+  walk_order = dict()
+  sizes = dict()
+
+  def iterate_size_candidates():
+    first_by_size = dict()
+    first_by_inode = dict()
+    for index, (filename, stat_result) in enumerate(file_stats):
+      counts['located'] += 1
+      if stat_result.st_nlink > 1:
+        first_path = first_by_inode.setdefault((stat_result.st_dev, stat_result.st_ino),
+                                               filename)
+        if first_path != filename:
+          counts['links'] += 1
+          if aliases is not None:
+            aliases.setdefault(first_path, []).append(filename)
+          continue
+
+      size = stat_result.st_size
+      if size not in first_by_size:
+        first_by_size[size] = (index, filename)
+        continue
+
+      first = first_by_size[size]
+      if first:
+        first_by_size[size] = None
+        yield from add_candidate(*first, size)
+      yield from add_candidate(index, filename, size)
+
+  def add_candidate(index, filename, size):
+    counts['candidates'] += 1
+    walk_order[filename] = index
+    sizes[filename] = size
+    yield filename, min(size, 2 * PARTIAL_HASH_SIZE)
+
+  full_hashes = dict()
+  full_hash_queue = queue.Queue()
+  partial_groups = dict()
+  partial_results = _imap_files_unordered(executor, hash_file_ends_to_hash_file_tuple,
+                                          iterate_size_candidates(), progress=progress)
+  # Each stream has a feeder thread of its own, so full hashes start while
+  # the walk goes on and the ends of later candidates are still hashing.
+  full_hash_job = partial(hash_file_to_hash_file_tuple, cache_path=cache_path)
+  full_results = _imap_files_unordered(executor, full_hash_job,
+                                       iter(full_hash_queue.get, None), progress=progress)
+
+  try:
+    for hash_str, filename in partial_results:
+      size = sizes.pop(filename)
+      group = partial_groups.setdefault((size, hash_str), [])
+      group.append(filename)
+      if len(group) < 2:
+        continue
+
+      new_duplicates = group if len(group) == 2 else [filename]
+      if file_sizes is not None:
+        file_sizes.update((f, size) for f in new_duplicates)
+      if size <= 2 * PARTIAL_HASH_SIZE: # Already hashed whole.
+        full_hashes.update((f, hash_str) for f in new_duplicates)
+      else:
+        for f in new_duplicates:
+          full_hash_queue.put((f, size))
+          counts['full'] += 1
+  finally:
+    full_hash_queue.put(None)
+
+  for hash_str, filename in full_results:
+    full_hashes[filename] = hash_str
+
+  hash_dict = dict()
+  for filename in sorted(full_hashes, key=walk_order.get):
+    hash_dict.setdefault(full_hashes[filename], []).append(filename)
+  return hash_dict
+
+def _find_duplicate_files_low_memory(file_stats, executor, cache_path=None, counts=None,
+                                     memory_budget=extsort.DEFAULT_MEMORY_BUDGET,
+                                     temp_dir=None, progress=None):
+  """ Finds the same duplicates as _find_duplicate_files, in the same
+      order, while holding about memory_budget bytes of records.
+
+      Each stage writes its records, with raw digests, to an external sort
+      and reads them back grouped: by size and inode, by size and end hash,
+      then by full hash.  The duplicate groups are sorted once more into
+      walk order.  Returns a sorter over (walk index, hex digest, size,
+      [(filename, aliases)]) records, which the caller iterates and closes.
+
+      Each sorter is closed before the one after next is filled, so the
+      memory budget is split between the two that hold records at once.
+  """
+  counts = counts if counts is not None else dict()
+  counts.update(located=0, links=0, candidates=0, full=0)
+  new_sorter = partial(extsort.ExternalSorter, memory_budget // LOW_MEMORY_LIVE_SORTERS,
+                       temp_dir)
+
+  with new_sorter() as by_size:
+    for index, (filename, stat_result) in enumerate(file_stats):
+      counts['located'] += 1
+      by_size.add((stat_result.st_size, stat_result.st_dev, stat_result.st_ino,
+                   index, filename))
+
+    def iterate_size_candidates():
+      for group in _group_sorted_records(by_size, 1):
+        inodes = _merge_hard_links(group)
+        counts['links'] += len(group) - len(inodes)
+        if len(inodes) < 2:
+          continue
+        for index, size, filename, aliases in inodes:
+          counts['candidates'] += 1
+          yield (index, size, filename, aliases), min(size, 2 * PARTIAL_HASH_SIZE)
+
+    with new_sorter() as by_partial_hash, new_sorter() as by_full_hash:
+      # Batches are submitted from this thread, so the stages can add to
+      # the sorters while feeding the executor.
+      by_partial_hash.extend(_imap_files_unordered(
+        executor, hash_file_ends_to_candidate_record, iterate_size_candidates(),
+        LOW_MEMORY_PENDING_BATCHES, progress))
+      by_size.close()
+
+      def iterate_full_hash_candidates():
+        for group in _group_sorted_records(by_partial_hash, 2):
+          for size, partial_digest, index, filename, aliases in group:
+            if size <= 2 * PARTIAL_HASH_SIZE: # Already hashed whole.
+              by_full_hash.add((partial_digest, index, filename, aliases, size))
+            else:
+              counts['full'] += 1
+              yield (index, filename, aliases, size), size
+
+      full_hash_job = partial(hash_file_to_candidate_record, cache_path=cache_path)
+      by_full_hash.extend(_imap_files_unordered(
+        executor, full_hash_job, iterate_full_hash_candidates(),
+        LOW_MEMORY_PENDING_BATCHES, progress))
+
+      by_partial_hash.close()
+
+      by_walk_order = new_sorter()
+      for group in _group_sorted_records(by_full_hash, 1):
+        digest, index, filename, aliases, size = group[0]
+        by_walk_order.add((index, digest.hex(), size, [
+          (filename, aliases) for digest, index, filename, aliases, size in group]))
+  return by_walk_order
+
+def _merge_hard_links(size_group):
+  """ Merges (size, device, inode, walk index, filename) records sorted by
+      inode into (walk index, size, filename, aliases), one per inode, named
+      by the path found first.
+  """
+  inodes = list()
+  for size, device, inode, index, filename in size_group:
+    if inodes and (device, inode) == last_inode:
+      inodes[-1][3].append(filename)
+      continue
+    last_inode = (device, inode)
+    inodes.append((index, size, filename, []))
+  return inodes
+
+def _group_sorted_records(records, key_length):
+  """ Yields the lists of sorted records that share their first key_length
+      items, leaving out records that have no match.
+  """
+  group = list()
+  for record in records:
+    if group and record[:key_length] != group[0][:key_length]:
+      if len(group) > 1:
+        yield group
+      group = list()
+    group.append(record)
+  if len(group) > 1:
+    yield group
   
 def _dupl_main(args):
   print('Searching for duplicates...')
-  filenames = _build_filename_list_recursively(args.dir)
-  print('  Located ['+str(len(filenames))+'] files for testing.')
-  
-  file_hash_tuple_list = _build_file_hash_tuples_from_files(filenames, args.jobs)
-  
-  print('  Hash computation complete.')
-  
-  hash_dict = dict()
-  
-  HASH = 0
-  FILENAME = 1
-  for entry in file_hash_tuple_list:
-    if entry[HASH] not in hash_dict:
-      hash_dict[entry[HASH]] = [entry[FILENAME]]
-    else:
-      hash_dict[entry[HASH]].append(entry[FILENAME])
+  cache_path = digestcache.open_cache_from_args(args)
+  counts = dict()
+  if args.low_memory:
+    _dupl_low_memory(args, cache_path, counts)
+    return
 
+  aliases = dict()
+  file_sizes = dict()
+  with telemetry.open_progress_from_args(args) as progress, \
+       _create_executor(args.jobs, args.pool, progress) as executor:
+    hash_dict = _find_duplicate_files(_iterate_files_from_args(args.dir, args),
+                                      executor, cache_path, counts, aliases, file_sizes,
+                                      progress)
+  digestcache.evict_cache(cache_path)
+
+  _print_dupl_counts(counts)
+  duplicate_groups = [(k, file_sizes[v[0]], [(f, aliases.get(f, [])) for f in v])
+                      for k,v in hash_dict.items() if len(v) > 1]
+  _report_duplicate_groups(args, duplicate_groups)
+  _reclaim_duplicates(args, [members for k, size, members in duplicate_groups])
+
+def _dupl_low_memory(args, cache_path, counts):
+  with telemetry.open_progress_from_args(args) as progress, \
+       _create_executor(args.jobs, args.pool, progress) as executor:
+    duplicate_groups = _find_duplicate_files_low_memory(
+      _iterate_files_from_args(args.dir, args), executor, cache_path, counts,
+      args.memory_budget, args.temp_dir, progress)
+  digestcache.evict_cache(cache_path)
+
+  with duplicate_groups:
+    _print_dupl_counts(counts)
+    _report_duplicate_groups(args, (group[1:] for group in duplicate_groups))
+    _reclaim_duplicates(args, (members for index, k, size, members in duplicate_groups))
+
+def _report_duplicate_groups(args, duplicate_groups):
+  """ Prints (hex digest, size, [(filename, aliases)]) groups, and streams
+      them to the report if one was asked for.
+  """
+  report_writer = _open_report_from_args(args)
   print('  Found Duplicates:')
-  for k,v in hash_dict.items():
-    if len(v) > 1:
-      print('    '+str(v))
+  for group_number, (hash_str, size, members) in enumerate(duplicate_groups):
+    with stats.timed(stats.PHASE_REPORT):
+      print('    '+str([filename for filename, aliases in members]))
+      if report_writer:
+        for filename, aliases in members:
+          report_writer.write(report.TYPE_DUPLICATE, filename, size, hash_str, group_number)
+  if report_writer:
+    report_writer.close()
+
+def _reclaim_duplicates(args, duplicate_groups):
+  if args.reflink:
+    method = reclaim.METHOD_REFLINK
+  elif args.link or args.dry_run:
+    method = reclaim.METHOD_LINK
+  else:
+    return
+
+  print()
+  print('Replacing duplicates with '+method+'s'+(' (dry run)...' if args.dry_run else '...'))
+  replaced_count = 0
+  reclaimable_bytes = 0
+  for duplicate, original, reclaimable, error in reclaim.reclaim_duplicates(
+      duplicate_groups, method, args.dry_run):
+    if error:
+      print('  Skipping ['+duplicate+']: '+error)
+      continue
+    print('  ['+duplicate+'] -> ['+original+']')
+    replaced_count += 1
+    reclaimable_bytes += reclaimable
+
+  verb = 'Would replace' if args.dry_run else 'Replaced'
+  print('  '+verb+' ['+str(replaced_count)+'] files, reclaiming ['+
+        str(reclaimable_bytes)+'] bytes.')
   
+def _open_report_from_args(args):
+  if args.report:
+    return report.open_report(args.report, args.report_format,
+                              getattr(args, 'report_stdout', None))
+  return None
+
+@contextmanager
+def _keep_stdout_for_report(args):
+  """ Sends the command's messages to stderr while its report is streamed
+      to stdout, so the report can be piped and parsed.
+  """
+  if getattr(args, 'report', None) != report.STDOUT_PATH:
+    yield
+    return
+  args.report_stdout = sys.stdout
+  with redirect_stdout(sys.stderr):
+    yield
+
+def _print_dupl_counts(counts):
+  print('  Located ['+str(counts['located'])+'] files for testing.')
+  if counts['links']:
+    print('  ['+str(counts['links'])+'] files are hard links to files already found.')
+  print('  ['+str(counts['candidates'])+'] files share their size with another file.')
+  print('  ['+str(counts['full'])+'] files needed a full hash.')
+  print('  Hash computation complete.')
+
 def _evac_main(args):
-  while True:
-    print('Waiting for data to mount.')
-    while not os.path.isdir(args.mondir):
-      time.sleep(1)
-      
-    print('Copying files.')
-    dest_path = os.path.join(args.dest, datetime.now().strftime("%Y-%m-%d %H_%M_%S"))
-    shutil.copytree(args.mondir, dest_path)
-    print('Copy complete.')
-    
-    print('Waiting for unmount.')
-    while os.path.isdir(args.mondir):
-      time.sleep(1)    
+  state_path = args.state or os.path.join(args.dest, EVAC_STATE_NAME)
+  with MountWatcher(args.mondir, args.poll_interval) as mount_watcher:
+    while True:
+      print('Waiting for data to mount.')
+      mount_watcher.wait_until_available(args.settle)
+
+      print('Copying files.')
+      dest_path = copyengine.find_incomplete_copy(args.dest, args.mondir)
+      if dest_path:
+        print('  Resuming ['+dest_path+'].')
+      else:
+        dest_path = os.path.join(args.dest, datetime.now().strftime("%Y-%m-%d %H_%M_%S"))
+      previous_snapshot, previous_files = None, dict()
+      if args.incremental:
+        previous_snapshot, previous_files = copyengine.load_snapshot_state(state_path)
+      files = dict()
+      try:
+        counts = copyengine.copy_tree(args.mondir, dest_path, args.jobs, args.copy_mode,
+                                      previous_snapshot=previous_snapshot,
+                                      previous_files=previous_files, files=files)
+        print('  Copied ['+str(counts['copied'])+'] files, ['+str(counts['bytes'])+
+              '] bytes; ['+str(counts['linked'])+'] were unchanged and ['+
+              str(counts['resumed'])+'] were already copied.')
+        if args.incremental:
+          copyengine.save_snapshot_state(state_path, dest_path, files)
+        print('Copy complete.')
+      except copyengine.CopyFailed as e:
+        for filename, error in e.failures:
+          print('  Failed ['+filename+']: '+error)
+        print('Copy incomplete; it resumes at the next mount.')
+
+      print('Waiting for unmount.')
+      mount_watcher.wait_until_gone()
   
 def _repr_main(args):
   print('Checking for representation...')
-  reference_filenames = _build_filename_list_recursively(args.refdir)
-  evaluation_filenames = _build_filename_list_recursively(args.evaldir)
-  
-  print('  Located ['+str(len(reference_filenames))+'] reference files for testing.')
-  print('  Located ['+str(len(evaluation_filenames))+'] evaluation files for testing.')
-  
-  ref_hash_proc_pool = multiprocessing.Pool(processes=args.jobs)
-  ref_hash_list = ref_hash_proc_pool.map(hash_file_to_hex_str, reference_filenames)
-  ref_hash_proc_pool.close()
-  print('  Collected ['+str(len(ref_hash_list))+'] hashes for files in the reference directory.')
-  
-  eval_proc_pool = multiprocessing.Pool(processes=args.jobs)
-  partial_func_job = partial(_get_file_unrepresented_in_archive, ref_hash_list)
-  unrepresented_file_list = eval_proc_pool.map(partial_func_job, evaluation_filenames)
-  eval_proc_pool.close()
+  cache_path = digestcache.open_cache_from_args(args)
+  with telemetry.open_progress_from_args(args) as progress, \
+       tempfile.TemporaryDirectory() as temp_dir, \
+       _create_executor(args.jobs, args.pool, progress) as executor:
+    _check_representation(args, cache_path, executor, progress, temp_dir)
+  digestcache.evict_cache(cache_path)
+
+def _check_representation(args, cache_path, executor, progress, temp_dir):
+  if hashindex.is_index_file(args.refdir):
+    with HashIndexFile(args.refdir) as ref_index_file:
+      print('  Loaded ['+str(len(ref_index_file))+'] hashes from the reference index.')
+    ref_index_path = args.refdir
+  else:
+    ref_files = _iterate_file_sizes(_iterate_files_from_args(args.refdir, args))
+    ref_hash_job = partial(hash_file_to_digest, cache_path=cache_path)
+    ref_digest_list = list(_imap_files_unordered(executor, ref_hash_job, ref_files,
+                                                 progress=progress))
+    print('  Collected ['+str(len(ref_digest_list))+'] hashes for files in the reference directory.')
+    ref_index_path = os.path.join(temp_dir, 'reference.digests')
+    with open(ref_index_path, 'wb') as ref_index_file:
+      ref_index_file.write(b''.join(sorted(set(ref_digest_list))))
+    del ref_digest_list
   
   print()
   print('Found following unrepresented files:')
-  for filename in unrepresented_file_list:
-    if filename: print('    '+filename)
+  evaluation_count = 0
+  def iterate_evaluation_files():
+    nonlocal evaluation_count
+    for file_size in _iterate_file_sizes(_iterate_files_from_args(args.evaldir, args)):
+      evaluation_count += 1
+      yield file_size
+
+  # Tasks carry the index path, and each worker maps the index once.
+  eval_job = partial(_get_file_unrepresented_in_archive, reference_path=ref_index_path,
+                     cache_path=cache_path)
+  report_writer = _open_report_from_args(args)
+  for record in _imap_files_unordered(executor, eval_job, iterate_evaluation_files(),
+                                      progress=progress):
+    if record:
+      digest, size, filename = record
+      with stats.timed(stats.PHASE_REPORT):
+        print('    '+filename)
+        if report_writer:
+          report_writer.write(report.TYPE_UNREPRESENTED, filename, size, digest.hex())
+  if report_writer:
+    report_writer.close()
+
+  print('  Evaluated ['+str(evaluation_count)+'] files.')
+
+def _index_build_main(args):
+  print('Building index...')
+  cache_path = digestcache.open_cache_from_args(args)
+  files = _iterate_file_sizes(_iterate_files_from_args(args.dir, args))
+  index_job = partial(hash_file_to_index_record, cache_path=cache_path)
+  with telemetry.open_progress_from_args(args) as progress, \
+       _create_executor(args.jobs, args.pool, progress) as executor:
+    records = list(_imap_files_unordered(executor, index_job, files, progress=progress))
+  digestcache.evict_cache(cache_path)
+
+  with stats.timed(stats.PHASE_REPORT):
+    hashindex.build_index_file(args.output, records, root=args.dir)
+  print('  Wrote ['+str(len(records))+'] records to ['+args.output+'].')
+
+def _index_merge_main(args):
+  print('Merging indexes...')
+  with stats.timed(stats.PHASE_REPORT):
+    hashindex.merge_index_files(args.output, args.indexes)
+  with HashIndexFile(args.output) as index_file:
+    print('  Wrote ['+str(len(index_file))+'] records to ['+args.output+'].')
+
+def _iterate_file_sizes(file_stats):
+  for filename, stat_result in file_stats:
+    yield filename, stat_result.st_size
   
+def _add_walk_arguments(parser):
+  WALK_JOBS_ARG_HELP = ('Number of threads reading directories, for filesystems '
+                        'where each read is slow.')
+  ORDERED_ARG_HELP = 'Keep the single threaded walk order when --walk-jobs is above 1.'
+  INCLUDE_ARG_HELP = ('Only use files matching this glob; globs with a / match the '
+                      'path under the directory, others the name.  Repeatable.')
+  EXCLUDE_ARG_HELP = ('Skip files and directories matching this glob; excluded '
+                      'directories are not read.  Repeatable.')
+  MIN_SIZE_ARG_HELP = 'Skip files smaller than this (ex. 4K).'
+  MAX_SIZE_ARG_HELP = 'Skip files larger than this (ex. 2G).'
+
+  parser.add_argument('--walk-jobs', help=WALK_JOBS_ARG_HELP, type=int, default=1)
+  parser.add_argument('--ordered', help=ORDERED_ARG_HELP, action='store_true')
+  parser.add_argument('--include', help=INCLUDE_ARG_HELP, action='append')
+  parser.add_argument('--exclude', help=EXCLUDE_ARG_HELP, action='append')
+  parser.add_argument('--min-size', help=MIN_SIZE_ARG_HELP, type=extsort.parse_size)
+  parser.add_argument('--max-size', help=MAX_SIZE_ARG_HELP, type=extsort.parse_size)
+
 def _build_argument_parser():
   ROOT_PARSER_DESC = 'File utility tool suite.'
   SUB_PARSER_HELP = 'sub-command help'
-  REPORT_ARG_HELP = 'Output the report to a file.'
-  JOBS_ARG_HELP = 'Number of job processes to run.'
+  JOBS_ARG_HELP = 'Number of jobs to run at once.'
+  POOL_ARG_HELP = ('Run jobs on threads, processes or inline.  auto picks from the '
+                   'sizes of the first files: threads for large files, whose '
+                   'hashing releases the GIL, processes for small ones.')
   REPR_PARSER_HELP = ('Check if copies of the files in a evaluation directory '
                       'are present in a reference directory.')
-  REPR_ARG_REF_HELP = 'The directory containing the files to confirm against.'
+  REPR_ARG_REF_HELP = ('The directory containing the files to confirm against, '
+                       'or an index (.idx) built from it.')
   REPR_ARG_EVAL_HELP = ('The directory containing the files to search for in '
                         'the reference directory.')
   DUPL_PARSER_HELP = 'Check for duplicate files in a directory.'
   DUPL_ARG_DIR_HELP = 'The directory containg the files to evaluate.'
+  DUPL_ARG_LOW_MEMORY_HELP = ('Sort hashes in temporary files instead of memory, '
+                              'for trees with too many files to hold at once.')
+  DUPL_ARG_MEMORY_BUDGET_HELP = ('Records held in memory before sorting to disk '
+                                 'in low memory mode (ex. 512M).')
+  DUPL_ARG_TEMP_DIR_HELP = 'The directory for low memory mode sort files.'
+  DUPL_ARG_LINK_HELP = ('Replace each duplicate, once compared byte for byte, with a '
+                        'hard link to the first copy found.')
+  DUPL_ARG_REFLINK_HELP = ('Replace each duplicate, once compared byte for byte, with a '
+                           'reflink (shared copy on write blocks) of the first copy found.')
+  DUPL_ARG_DRY_RUN_HELP = 'Compare duplicates and report the space reclaimable, changing nothing.'
   EVAC_PARSER_HELP = 'Monitor a directory, and evacuate the contents when files become available.'
   EVAC_ARG_MON_HELP = 'The directory to monitor.'
   EVAC_ARG_DEST_HELP = 'The destination to copy the files too.'
+  EVAC_ARG_JOBS_HELP = 'Number of files to copy at once.'
+  EVAC_ARG_COPY_MODE_HELP = ('How files are copied: stream reads each file once to both '
+                             'copy and hash it, kernel copies it in the kernel '
+                             '(copy_file_range) then hashes the copy.')
+  EVAC_ARG_INCREMENTAL_HELP = ('Copy only new or changed files, hard linking unchanged '
+                               'files from the previous snapshot.')
+  EVAC_ARG_STATE_HELP = ('The file recording the previous snapshot for --incremental '
+                         f'(default: {EVAC_STATE_NAME} in the destination).')
+  EVAC_ARG_SETTLE_HELP = ('Seconds the directory must stay mounted, with no other '
+                          'mount changes, before copying starts.')
+  EVAC_ARG_POLL_INTERVAL_HELP = ('Seconds between checks where mount and directory '
+                                 'events are unavailable.')
+  INDEX_PARSER_HELP = 'Build and merge portable hash index files for repr.'
+  INDEX_BUILD_PARSER_HELP = 'Hash a directory into an index file.'
+  INDEX_BUILD_ARG_DIR_HELP = 'The directory containing the files to index.'
+  INDEX_MERGE_PARSER_HELP = 'Combine index files, such as shards from several machines.'
+  INDEX_MERGE_ARG_INDEXES_HELP = 'The index files to merge.'
+  INDEX_ARG_OUTPUT_HELP = 'The index file to write.'
 
   import argparse
   parser = argparse.ArgumentParser(description=ROOT_PARSER_DESC)
@@ -126,20 +697,75 @@ def _build_argument_parser():
   repr_parser = subparsers.add_parser('repr', help=REPR_PARSER_HELP)
   repr_parser.add_argument('refdir', help=REPR_ARG_REF_HELP)
   repr_parser.add_argument('evaldir', help=REPR_ARG_EVAL_HELP)
-  repr_parser.add_argument('--report', help=REPORT_ARG_HELP)
+  report.add_report_arguments(repr_parser)
   repr_parser.add_argument('--jobs', help=JOBS_ARG_HELP, type=int, default=1)
+  repr_parser.add_argument('--pool', help=POOL_ARG_HELP, choices=BACKENDS,
+                           default=BACKEND_AUTO)
+  _add_walk_arguments(repr_parser)
+  digestcache.add_cache_arguments(repr_parser)
+  telemetry.add_progress_arguments(repr_parser)
+  stats.add_stats_arguments(repr_parser)
   repr_parser.set_defaults(func=_repr_main)
   
   dupl_parser = subparsers.add_parser('dupl', help=DUPL_PARSER_HELP)
   dupl_parser.add_argument('dir', help=DUPL_ARG_DIR_HELP)
-  dupl_parser.add_argument('--report', help=REPORT_ARG_HELP)
+  report.add_report_arguments(dupl_parser)
   dupl_parser.add_argument('--jobs', help=JOBS_ARG_HELP, type=int, default=1)
+  dupl_parser.add_argument('--pool', help=POOL_ARG_HELP, choices=BACKENDS,
+                           default=BACKEND_AUTO)
+  dupl_parser.add_argument('--low-memory', help=DUPL_ARG_LOW_MEMORY_HELP,
+                           action='store_true')
+  dupl_parser.add_argument('--memory-budget', help=DUPL_ARG_MEMORY_BUDGET_HELP,
+                           type=extsort.parse_size, default=extsort.DEFAULT_MEMORY_BUDGET)
+  dupl_parser.add_argument('--temp-dir', help=DUPL_ARG_TEMP_DIR_HELP)
+  dupl_link_group = dupl_parser.add_mutually_exclusive_group()
+  dupl_link_group.add_argument('--link', help=DUPL_ARG_LINK_HELP, action='store_true')
+  dupl_link_group.add_argument('--reflink', help=DUPL_ARG_REFLINK_HELP, action='store_true')
+  dupl_parser.add_argument('--dry-run', help=DUPL_ARG_DRY_RUN_HELP, action='store_true')
+  _add_walk_arguments(dupl_parser)
+  digestcache.add_cache_arguments(dupl_parser)
+  telemetry.add_progress_arguments(dupl_parser)
+  stats.add_stats_arguments(dupl_parser)
   dupl_parser.set_defaults(func=_dupl_main)
   
   evac_parser = subparsers.add_parser('evac', help=EVAC_PARSER_HELP)
   evac_parser.add_argument('mondir', help=EVAC_ARG_MON_HELP)
   evac_parser.add_argument('dest', help=EVAC_ARG_DEST_HELP)
+  evac_parser.add_argument('--jobs', help=EVAC_ARG_JOBS_HELP, type=int, default=4)
+  evac_parser.add_argument('--copy-mode', help=EVAC_ARG_COPY_MODE_HELP,
+                           choices=copyengine.COPY_MODES, default=copyengine.COPY_MODE_STREAM)
+  evac_parser.add_argument('--incremental', help=EVAC_ARG_INCREMENTAL_HELP,
+                           action='store_true')
+  evac_parser.add_argument('--state', help=EVAC_ARG_STATE_HELP)
+  evac_parser.add_argument('--settle', help=EVAC_ARG_SETTLE_HELP, type=float,
+                           default=mountwatch.DEFAULT_SETTLE_SECONDS)
+  evac_parser.add_argument('--poll-interval', help=EVAC_ARG_POLL_INTERVAL_HELP,
+                           type=float, default=mountwatch.DEFAULT_POLL_INTERVAL_SECONDS)
+  stats.add_stats_arguments(evac_parser)
   evac_parser.set_defaults(func=_evac_main)
+
+  index_parser = subparsers.add_parser('index', help=INDEX_PARSER_HELP)
+  index_subparsers = index_parser.add_subparsers(help=SUB_PARSER_HELP)
+
+  index_build_parser = index_subparsers.add_parser('build', help=INDEX_BUILD_PARSER_HELP)
+  index_build_parser.add_argument('dir', help=INDEX_BUILD_ARG_DIR_HELP)
+  index_build_parser.add_argument('-o', '--output', help=INDEX_ARG_OUTPUT_HELP,
+                                  required=True)
+  index_build_parser.add_argument('--jobs', help=JOBS_ARG_HELP, type=int, default=1)
+  index_build_parser.add_argument('--pool', help=POOL_ARG_HELP, choices=BACKENDS,
+                                  default=BACKEND_AUTO)
+  _add_walk_arguments(index_build_parser)
+  digestcache.add_cache_arguments(index_build_parser)
+  telemetry.add_progress_arguments(index_build_parser)
+  stats.add_stats_arguments(index_build_parser)
+  index_build_parser.set_defaults(func=_index_build_main)
+
+  index_merge_parser = index_subparsers.add_parser('merge', help=INDEX_MERGE_PARSER_HELP)
+  index_merge_parser.add_argument('indexes', help=INDEX_MERGE_ARG_INDEXES_HELP, nargs='+')
+  index_merge_parser.add_argument('-o', '--output', help=INDEX_ARG_OUTPUT_HELP,
+                                  required=True)
+  stats.add_stats_arguments(index_merge_parser)
+  index_merge_parser.set_defaults(func=_index_merge_main)
   
   return parser
   
@@ -148,7 +774,11 @@ if __name__ == '__main__':
   args = parser.parse_args()
   
   if args.func:
-    args.func(args)
+    try:
+      with stats.open_stats_from_args(args), _keep_stdout_for_report(args):
+        args.func(args)
+    except KeyboardInterrupt: # The executors have stopped their workers.
+      sys.exit('Interrupted.')
   else:
     parser.print_help()
   
\ No newline at end of file
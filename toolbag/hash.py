@@ -1,28 +1,706 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import hashlib
+from itertools import islice
+import json
 import math
-import os.path
+import mmap
+import os
+import re
+import stat
 import sys
+import threading
 
-DEFAULT_HASHING_CHUNK_SIZE = int(math.pow(2,16))
+try:
+  from toolbag import digestcache, stats
+  from toolbag.executor import BACKEND_AUTO, BACKENDS, Executor
+except ImportError:
+  import digestcache
+  import stats
+  from executor import BACKEND_AUTO, BACKENDS, Executor
+
+TUNING_FILE_NAME = 'hash_tuning.json'
+TUNING_ENV_VAR = 'TOOLBAG_HASH_TUNING'
+
+def get_tuning_path():
+  return os.environ.get(TUNING_ENV_VAR) or os.path.join(digestcache.get_cache_dir(),
+                                                        TUNING_FILE_NAME)
+
+def load_tuned_chunk_size(path=None):
+  """ Returns the chunk size saved by the benchmark suite's --tune option
+      for this machine, or None if there is none.
+  """
+  try:
+    with open(path or get_tuning_path(), 'r') as tuning_file:
+      chunk_size = int(json.load(tuning_file)['chunk_size'])
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+  return chunk_size if chunk_size > 0 else None
+
+DEFAULT_HASHING_CHUNK_SIZE = load_tuned_chunk_size() or int(math.pow(2,16))
+
+READ_MODE_AUTO = 'auto'
+READ_MODE_BUFFERED = 'buffered'
+READ_MODE_MMAP = 'mmap'
+READ_MODES = (READ_MODE_AUTO, READ_MODE_BUFFERED, READ_MODE_MMAP)
+# Chunks of a file whose digests are updated in turn before threads take
+# over; on small files thread hand-offs cost more than they save.
+PARALLEL_DIGEST_MIN_CHUNKS = 16
+# The threads, shared by every file, that update digests of larger files.
+_digest_pools = dict()
+_digest_pools_lock = threading.Lock()
+
+STDIN_PATH = '-'
+
+CHECK_OK = 'OK'
+CHECK_FAILED = 'FAILED'
+CHECK_MISSING = 'MISSING'
+CHECK_STATUSES = (CHECK_OK, CHECK_FAILED, CHECK_MISSING)
+
+DEFAULT_TREE_LEAF_SIZE = int(math.pow(2,22))
+# Tree digests of other leaf sizes are named with the size, as in
+# tree-sha256-1M, so their labels and cache entries differ.
+TREE_LEAF_SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+TREE_LEAF_PREFIX = b'\x00'
+TREE_NODE_PREFIX = b'\x01'
+TREE_LEAVES_MAGIC = b'TOOLBAG-TREE-LEAVES 1\n'
+
+DEFAULT_DIRECTORY_HASH = 'sha256'
+DIRECTORY_ROOT = '.'
+ENTRY_KIND_FILE = b'file'
+ENTRY_KIND_DIRECTORY = b'dir'
+ENTRY_KIND_LINK = b'link'
+ENTRY_KIND_OTHER = b'other'
+
+def iterate_file_chunks(filename, chunk_size=DEFAULT_HASHING_CHUNK_SIZE,
+                        read_mode=READ_MODE_AUTO, buffer_count=1):
+  """ Yields the contents of a file as memoryview chunks.
+
+      Buffered mode reads into preallocated buffers, so no new bytes object
+      is created per chunk.  A chunk is only valid until the generator has
+      advanced buffer_count more times.  Holes in sparse files are yielded
+      as zeros without being read, and the kernel is told the access is
+      sequential where the platform supports it.
+
+      Auto mode reads buffered.  Mmap mode is only used when asked for: a
+      file truncated by another process while mapped, such as a rotated
+      log or a file on a network share, crashes the interpreter with
+      SIGBUS, and mapping is no faster for hashing.
+  """
+  if read_mode not in READ_MODES:
+    raise ValueError(f'Unknown read mode \'{read_mode}\'.')
+
+  with open(filename, 'rb', buffering=0) as file:
+    stat_result = os.fstat(file.fileno())
+    size = stat_result.st_size
+    _advise_sequential_access(file.fileno())
+
+    if not stat.S_ISREG(stat_result.st_mode):
+      # Pipes and devices cannot seek or be mapped, and have no holes.
+      yield from _iterate_buffered_chunks(file, None, chunk_size, buffer_count)
+    elif read_mode == READ_MODE_MMAP and size > 0:
+      yield from _iterate_mmap_chunks(file, chunk_size)
+    else:
+      yield from _iterate_buffered_chunks(file, size, chunk_size, buffer_count)
 
 def hash_file_in_chunks_to_hex_str(filename, hash_object, 
-                        chunk_size=DEFAULT_HASHING_CHUNK_SIZE):
-  with open(filename, 'rb') as file:
-    chunk = file.read(chunk_size)
-    while chunk:
+                        chunk_size=DEFAULT_HASHING_CHUNK_SIZE,
+                        read_mode=READ_MODE_AUTO):
+  size = 0
+  with stats.timed(stats.PHASE_HASH):
+    for chunk in iterate_file_chunks(filename, chunk_size, read_mode):
       hash_object.update(chunk)
-      chunk = file.read(chunk_size)
+      size += len(chunk)
+  stats.add(stats.FILES_HASHED)
+  stats.add(stats.BYTES_HASHED, size)
   return hash_object.hexdigest()
 
+def hash_file_in_chunks_to_hex_strs(filename, hash_objects,
+                        chunk_size=DEFAULT_HASHING_CHUNK_SIZE,
+                        read_mode=READ_MODE_AUTO):
+  """ Reads the file once and feeds every chunk to all of the hash objects.
+
+      The first PARALLEL_DIGEST_MIN_CHUNKS chunks update the hash objects in
+      turn, so small files never wait on threads.  Later chunks update each
+      hash object on a thread of a pool shared by every file; hashlib
+      releases the GIL while updating, so the digests run concurrently, and
+      the next chunk is read into a second buffer while the current one is
+      being hashed.
+  """
+  hash_objects = list(hash_objects)
+  if len(hash_objects) == 1:
+    return [hash_file_in_chunks_to_hex_str(filename, hash_objects[0],
+                                           chunk_size, read_mode)]
+
+  size = 0
+  chunks = iterate_file_chunks(filename, chunk_size, read_mode, buffer_count=2)
+  with stats.timed(stats.PHASE_HASH):
+    for chunk in islice(chunks, PARALLEL_DIGEST_MIN_CHUNKS):
+      for hash_object in hash_objects:
+        hash_object.update(chunk)
+      size += len(chunk)
+
+    chunk = next(chunks, None)
+    executor = _get_digest_pool() if chunk is not None else None
+    while chunk is not None:
+      updates = [executor.submit(h.update, chunk) for h in hash_objects]
+      size += len(chunk)
+      chunk = next(chunks, None)
+      for update in updates:
+        update.result()
+  stats.add(stats.FILES_HASHED)
+  stats.add(stats.BYTES_HASHED, size)
+  return [h.hexdigest() for h in hash_objects]
+
+def _get_digest_pool():
+  """ Returns the digest update threads, started once per process. """
+  with _digest_pools_lock:
+    pool = _digest_pools.get(os.getpid())
+    if pool is None:
+      pool = _digest_pools[os.getpid()] = ThreadPoolExecutor(
+        max_workers=os.cpu_count() or len(_Application.SUPPORTED_HASHES),
+        thread_name_prefix='toolbag-digest')
+    return pool
+
+def hash_file_with_algorithms(filename, algs,
+                        chunk_size=DEFAULT_HASHING_CHUNK_SIZE,
+                        read_mode=READ_MODE_AUTO, cache_path=None):
+  """ Returns the hex digests of the file for each named algorithm in
+      _Application.SUPPORTED_HASHES, reading the file once.
+
+      With a cache_path, digests of files unchanged since they were last
+      hashed come from the digest cache and the file is not read.
+  """
+  if cache_path is None:
+    return _hash_file_with_algorithms(filename, algs, chunk_size, read_mode)
+
+  cache = digestcache.get_digest_cache(cache_path)
+  with stats.timed(stats.PHASE_STAT):
+    stat_result = os.stat(filename)
+  hash_strs = {alg: cache.lookup(stat_result, alg) for alg in algs}
+  missing_algs = [alg for alg in algs if hash_strs[alg] is None]
+  if missing_algs:
+    computed = dict(zip(missing_algs, _hash_file_with_algorithms(
+      filename, missing_algs, chunk_size, read_mode)))
+    hash_strs.update(computed)
+    if _is_same_file_version(stat_result, os.stat(filename)):
+      cache.store(stat_result, computed)
+  return [hash_strs[alg] for alg in algs]
+
+def iterate_filenames_recursively(paths):
+  """ Yields the regular files named by paths, descending into directories.
+      A path of '-' reads a NUL separated list of paths from stdin.
+  """
+  for path in paths:
+    if path == STDIN_PATH:
+      yield from iterate_filenames_recursively(_iterate_nul_separated_stdin())
+    elif os.path.isdir(path):
+      for root, directories, filenames in os.walk(path):
+        directories.sort()
+        for filename in sorted(filenames):
+          yield os.path.join(root, filename)
+    else:
+      yield path
+
+def format_checksum_line(hash_str, filename, label=None):
+  """ Formats a line that coreutils' *sum -c can verify.  The tagged (BSD)
+      form is used when a label is given.
+  """
+  prefix = ''
+  if '\\' in filename or '\n' in filename:
+    prefix = '\\'
+    filename = filename.replace('\\', '\\\\').replace('\n', '\\n')
+
+  if label:
+    return f'{prefix}{label} ({filename}) = {hash_str}'
+  else:
+    return f'{prefix}{hash_str}  {filename}'
+
+def parse_checksum_line(line, default_alg=None):
+  """ Parses a line written by format_checksum_line or coreutils' *sum into
+      an (algorithm, hash string, filename) tuple.  Untagged lines use
+      default_alg, or the algorithm whose digest length matches.  Returns
+      None for lines that cannot be parsed.
+  """
+  TAGGED_LINE_REGEX = r'^([\w-]+) \((.*)\) = ([0-9a-fA-F]+)$'
+  UNTAGGED_LINE_REGEX = r'^([0-9a-fA-F]+) [ *](.*)$'
+
+  line = line.rstrip('\r\n')
+  escaped = line.startswith('\\')
+  if escaped:
+    line = line[1:]
+
+  match = re.match(TAGGED_LINE_REGEX, line)
+  if match:
+    alg = _find_algorithm_by_label(match.group(1))
+    filename, hash_str = match.group(2), match.group(3)
+  else:
+    match = re.match(UNTAGGED_LINE_REGEX, line)
+    if not match:
+      return None
+    hash_str, filename = match.group(1), match.group(2)
+    alg = default_alg or _find_algorithm_by_hex_length(len(hash_str))
+
+  if alg is None:
+    return None
+  if escaped:
+    filename = _unescape_checksum_filename(filename)
+  return alg, hash_str.lower(), filename
+
+def format_tree_algorithm(alg, leaf_size):
+  """ Names the tree algorithm alg, such as tree-sha256, with leaf_size
+      unless it is the default.
+  """
+  if leaf_size <= 0:
+    raise ValueError(f'Invalid tree leaf size {leaf_size}.')
+  if leaf_size == DEFAULT_TREE_LEAF_SIZE:
+    return alg
+  for unit, unit_size in sorted(TREE_LEAF_SIZE_UNITS.items(), key=lambda item: -item[1]):
+    if leaf_size % unit_size == 0:
+      return f'{alg}-{leaf_size // unit_size}{unit}'
+
+def is_tree_algorithm(alg):
+  return _split_tree_algorithm(alg) is not None
+
+def get_tree_leaf_size(alg):
+  return _split_tree_algorithm(alg)[1]
+
+def verify_checksum(alg, hash_str, filename):
+  """ Returns CHECK_OK, CHECK_FAILED or CHECK_MISSING for one manifest entry. """
+  try:
+    if is_tree_algorithm(alg):
+      actual = hash_file_tree_to_hex_str(filename, _Application.get_hash_constructor(alg),
+                                         get_tree_leaf_size(alg))
+    else:
+      actual = hash_file_in_chunks_to_hex_str(filename,
+                                              _Application.get_hash_constructor(alg)())
+  except OSError:
+    return CHECK_MISSING
+  return CHECK_OK if actual == hash_str else CHECK_FAILED
+
+def hash_file_tree_to_hex_str(filename, hash_constructor,
+                        leaf_size=DEFAULT_TREE_LEAF_SIZE, jobs=1,
+                        leaves_path=None, changed_ranges=None):
+  """ Computes a Merkle tree digest of the file, hashing its leaves on a
+      pool of jobs threads.  See TreeHash for the leaf store options.
+  """
+  tree_hash = TreeHash(hash_constructor, leaf_size)
+  if leaves_path and os.path.isfile(leaves_path):
+    tree_hash.load_leaves(leaves_path)
+  with stats.timed(stats.PHASE_HASH):
+    tree_hash.hash_file(filename, jobs, changed_ranges)
+  stats.add(stats.FILES_HASHED)
+  if leaves_path:
+    tree_hash.save_leaves(leaves_path)
+  return tree_hash.hexdigest()
+
+def hash_directory_tree(directory, alg=DEFAULT_DIRECTORY_HASH, jobs=1,
+                        pool=BACKEND_AUTO, cache_path=None):
+  """ Computes a digest for the directory and each of its subdirectories.
+      Returns a dict keyed by '/' separated path relative to the directory,
+      with DIRECTORY_ROOT for the directory itself.
+
+      A directory's digest covers the sorted names, kinds, permission bits
+      and digests of its entries; files contribute their content hash,
+      subdirectories their own digest and symlinks the hash of their target,
+      which is not followed.  Files are hashed in parallel, and the result
+      does not depend on the job count or the enumeration order.
+  """
+  hash_constructor = _Application.get_hash_constructor(alg)
+  entries = dict()
+  file_entries = dict()
+
+  def raise_error(error):
+    raise error
+
+  for root, directories, filenames in os.walk(directory, onerror=raise_error):
+    relative_root = _relative_posix_path(root, directory)
+    entries[relative_root] = list()
+    for name in directories + filenames:
+      path = os.path.join(root, name)
+      stat_result = os.lstat(path)
+      entry = [os.fsencode(name), None, stat.S_IMODE(stat_result.st_mode), None]
+      if stat.S_ISDIR(stat_result.st_mode):
+        entry[1] = ENTRY_KIND_DIRECTORY
+      elif stat.S_ISLNK(stat_result.st_mode):
+        entry[1] = ENTRY_KIND_LINK
+        entry[3] = hash_constructor(os.fsencode(os.readlink(path))).hexdigest()
+      elif stat.S_ISREG(stat_result.st_mode):
+        entry[1] = ENTRY_KIND_FILE
+        file_entries[path] = entry
+      else:
+        entry[1] = ENTRY_KIND_OTHER
+        entry[3] = hash_constructor().hexdigest()
+      entries[relative_root].append(entry)
+
+  job = partial(hash_file_with_algorithms, algs=[alg], cache_path=cache_path)
+  with build_executor(jobs, pool) as executor:
+    backend, paths = executor.resolve_from(file_entries, _get_file_size)
+    for path, future in executor.map_unordered(job, paths, backend=backend):
+      file_entries[path][3] = future.result()[0]
+
+  digests = dict()
+  for relative_root in sorted(entries, key=_posix_path_depth, reverse=True):
+    directory_hash = hash_constructor()
+    for name, kind, mode, digest in sorted(entries[relative_root]):
+      if kind == ENTRY_KIND_DIRECTORY:
+        digest = digests[_join_posix_path(relative_root, os.fsdecode(name))]
+      directory_hash.update(b'%s %o %s %s\0' % (kind, mode, digest.encode(), name))
+    digests[relative_root] = directory_hash.hexdigest()
+  return digests
+
+def parse_byte_ranges(ranges_str):
+  """ Parses 'START:END,START:END' byte ranges (END exclusive). """
+  ranges = list()
+  for range_str in ranges_str.split(','):
+    start, end = range_str.split(':')
+    ranges.append((int(start), int(end)))
+  return ranges
+
+
+class TreeHash:
+  """ A Merkle tree digest over fixed size leaves of a file.
+
+      Leaves are hashed independently with os.pread, so large files can use
+      every core.  Leaf and interior node inputs carry distinct prefixes, so
+      the root cannot be confused with the digest of a leaf.  An odd node at
+      the end of a level is carried up unchanged.
+
+      Leaf digests can be saved and loaded.  Loaded leaves are reused in
+      full while the file's size and mtime are unchanged; after an in-place
+      modification, only leaves overlapping the given changed byte ranges
+      (and the leaves around the old and new ends of the file) are rehashed.
+  """
+  def __init__(self, hash_constructor, leaf_size=DEFAULT_TREE_LEAF_SIZE):
+    self._hash_constructor = hash_constructor
+    self._leaf_size = leaf_size
+    self._hash_name = hash_constructor().name
+    self._leaf_digests = list()
+    self._file_size = None
+    self._mtime_ns = None
+
+  def get_leaf_digests(self):
+    return list(self._leaf_digests)
+
+  def hash_file(self, filename, jobs=1, changed_ranges=None):
+    with open(filename, 'rb', buffering=0) as file:
+      stat_result = os.fstat(file.fileno())
+      stale_leaves = self._find_stale_leaves(stat_result, changed_ranges)
+      leaf_count = max(1, -(-stat_result.st_size // self._leaf_size))
+      digests = self._leaf_digests[:leaf_count]
+      digests += [None] * (leaf_count - len(digests))
+
+      def hash_leaf(index):
+        return index, self._hash_leaf(file.fileno(), index)
+
+      with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for index, digest in executor.map(hash_leaf, sorted(stale_leaves)):
+          digests[index] = digest
+
+    self._leaf_digests = digests
+    self._file_size = stat_result.st_size
+    self._mtime_ns = stat_result.st_mtime_ns
+
+  def digest(self):
+    level = self._leaf_digests
+    while len(level) > 1:
+      next_level = list()
+      for i in range(0, len(level) - 1, 2):
+        node = self._hash_constructor(TREE_NODE_PREFIX)
+        node.update(level[i])
+        node.update(level[i + 1])
+        next_level.append(node.digest())
+      if len(level) % 2:
+        next_level.append(level[-1])
+      level = next_level
+    return level[0]
+
+  def hexdigest(self):
+    return self.digest().hex()
+
+  def save_leaves(self, path):
+    header = {'hash': self._hash_name, 'leaf_size': self._leaf_size,
+              'file_size': self._file_size, 'mtime_ns': self._mtime_ns}
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+      file.write(TREE_LEAVES_MAGIC)
+      file.write(json.dumps(header).encode() + b'\n')
+      file.write(b''.join(self._leaf_digests))
+    os.replace(temp_path, path)
+
+  def load_leaves(self, path):
+    """ Loads saved leaf digests.  Returns False, keeping no leaves, if they
+        were made with a different hash or leaf size.
+    """
+    with open(path, 'rb') as file:
+      if file.readline() != TREE_LEAVES_MAGIC:
+        return False
+      header = json.loads(file.readline())
+      data = file.read()
+
+    if header['hash'] != self._hash_name or header['leaf_size'] != self._leaf_size:
+      return False
+
+    digest_size = self._hash_constructor().digest_size
+    self._leaf_digests = [data[i:i + digest_size]
+                          for i in range(0, len(data), digest_size)]
+    self._file_size = header['file_size']
+    self._mtime_ns = header['mtime_ns']
+    return True
+
+  def _find_stale_leaves(self, stat_result, changed_ranges):
+    leaf_count = max(1, -(-stat_result.st_size // self._leaf_size))
+    if not self._leaf_digests:
+      return set(range(leaf_count))
+
+    # Without ranges only the size and time tell whether the file changed;
+    # given ranges are rehashed even if they match, as after touch -r.
+    if changed_ranges is None:
+      unchanged = (stat_result.st_size == self._file_size and
+                   stat_result.st_mtime_ns == self._mtime_ns)
+      return set() if unchanged else set(range(leaf_count))
+
+    stale = set()
+    for start, end in changed_ranges:
+      stale.update(range(start // self._leaf_size,
+                         -(-end // self._leaf_size)))
+    # The old last leaf may have grown, the new last leaf may be partial, and
+    # anything past the old end has never been hashed.
+    old_last_leaf = max(0, -(-self._file_size // self._leaf_size) - 1)
+    new_last_leaf = leaf_count - 1
+    if stat_result.st_size != self._file_size:
+      stale.update(range(min(old_last_leaf, new_last_leaf), leaf_count))
+    stale.update(range(len(self._leaf_digests), leaf_count))
+    return {index for index in stale if index < leaf_count}
+
+  def _hash_leaf(self, fd, index):
+    leaf = self._hash_constructor(TREE_LEAF_PREFIX)
+    offset = index * self._leaf_size
+    end = offset + self._leaf_size
+    buffer = memoryview(bytearray(min(DEFAULT_HASHING_CHUNK_SIZE, self._leaf_size)))
+    while offset < end:
+      request = min(len(buffer), end - offset)
+      if hasattr(os, 'preadv'):
+        read = os.preadv(fd, [buffer[:request]], offset)
+        chunk = buffer[:read]
+      else:
+        chunk = os.pread(fd, request, offset)
+        read = len(chunk)
+      if not read:
+        break
+      leaf.update(chunk)
+      offset += read
+    return leaf.digest()
+
+
+def build_executor(jobs=1, pool=BACKEND_AUTO):
+  """ Returns an Executor whose workers record to this run's stats. """
+  return Executor(jobs, pool, stats.install_counters, (stats.get_counters(),))
+
+def _get_file_size(path):
+  """ Returns the size of the file, or 0 if it cannot be read, for
+      choosing a pool backend.
+  """
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+def _is_stream(path):
+  """ Tells whether path is a pipe or character device, such as /dev/stdin
+      or a <(command) substitution, which can be hashed as it is read.
+  """
+  try:
+    mode = os.stat(path).st_mode
+  except OSError:
+    return False
+  return stat.S_ISFIFO(mode) or stat.S_ISCHR(mode)
+
+def _iterate_nul_separated_stdin():
+  remainder = b''
+  for block in iter(partial(sys.stdin.buffer.read, DEFAULT_HASHING_CHUNK_SIZE), b''):
+    entries = (remainder + block).split(b'\0')
+    remainder = entries.pop()
+    for entry in entries:
+      if entry:
+        yield os.fsdecode(entry)
+  if remainder.strip(b'\n'):
+    yield os.fsdecode(remainder.strip(b'\n'))
+
+def _hash_file_with_algorithms(filename, algs, chunk_size, read_mode):
+  hash_strs = dict()
+  stream_algs = [alg for alg in algs if not is_tree_algorithm(alg)]
+  if stream_algs:
+    hash_objs = [_Application.get_hash_constructor(alg)() for alg in stream_algs]
+    hash_strs.update(zip(stream_algs, hash_file_in_chunks_to_hex_strs(
+      filename, hash_objs, chunk_size, read_mode)))
+
+  for alg in algs:
+    if is_tree_algorithm(alg):
+      hash_strs[alg] = hash_file_tree_to_hex_str(filename,
+                                                 _Application.get_hash_constructor(alg),
+                                                 get_tree_leaf_size(alg))
+  return [hash_strs[alg] for alg in algs]
+
+def _is_same_file_version(stat_a, stat_b):
+  return ((stat_a.st_dev, stat_a.st_ino, stat_a.st_size, stat_a.st_mtime_ns) ==
+          (stat_b.st_dev, stat_b.st_ino, stat_b.st_size, stat_b.st_mtime_ns))
+
+def _verify_checksum_entry(entry):
+  return verify_checksum(*entry)
+
+def _find_algorithm_by_label(label):
+  for alg, hash_alg in _Application.SUPPORTED_HASHES.items():
+    if hash_alg[_Application.LABEL] == label.upper():
+      return alg
+  return _parse_tree_algorithm(label)
+
+def _split_tree_algorithm(alg):
+  """ Returns the tree algorithm and leaf size named by alg, such as
+      ('tree-sha256', 1048576) for tree-sha256-1M, or None.
+  """
+  TREE_ALGORITHM_REGEX = r'^([a-z0-9-]+?)(?:-(\d+)([kmg]?))?$'
+
+  match = re.match(TREE_ALGORITHM_REGEX, alg.lower())
+  if not match or match.group(1) not in _Application.TREE_HASHES:
+    return None
+  if match.group(2) is None:
+    return match.group(1), DEFAULT_TREE_LEAF_SIZE
+  leaf_size = int(match.group(2)) * TREE_LEAF_SIZE_UNITS[match.group(3).upper()]
+  return (match.group(1), leaf_size) if leaf_size > 0 else None
+
+def _parse_tree_algorithm(alg):
+  """ Returns the canonical name of the tree algorithm alg, or None. """
+  split = _split_tree_algorithm(alg)
+  return format_tree_algorithm(*split) if split else None
+
+def _find_algorithm_by_hex_length(length):
+  for alg, hash_alg in _Application.SUPPORTED_HASHES.items():
+    if hash_alg[_Application.HASH_OBJECT_CONSTRUCTOR]().digest_size * 2 == length:
+      return alg
+  return None
+
+def _relative_posix_path(path, start):
+  relative_path = os.path.relpath(path, start)
+  return relative_path.replace(os.sep, '/') if os.sep != '/' else relative_path
+
+def _posix_path_depth(path):
+  return 0 if path == DIRECTORY_ROOT else path.count('/') + 1
+
+def _join_posix_path(parent, name):
+  return name if parent == DIRECTORY_ROOT else f'{parent}/{name}'
+
+def _unescape_checksum_filename(filename):
+  return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                filename)
+
+def _advise_sequential_access(fd):
+  if hasattr(os, 'posix_fadvise'):
+    try:
+      os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+      pass
+
+def _find_file_holes(fd, file_size):
+  """ Returns the (start, end) offsets of the holes in a sparse file, or an
+      empty list when the platform or filesystem cannot report them.
+  """
+  holes = list()
+  if not hasattr(os, 'SEEK_HOLE'):
+    return holes
+
+  offset = 0
+  try:
+    while offset < file_size:
+      hole_start = os.lseek(fd, offset, os.SEEK_HOLE)
+      if hole_start >= file_size:
+        break
+      try:
+        hole_end = os.lseek(fd, hole_start, os.SEEK_DATA)
+      except OSError: # No data after the hole.
+        hole_end = file_size
+      holes.append((hole_start, hole_end))
+      offset = hole_end
+  except OSError:
+    return list()
+  return holes
+
+def _iterate_buffered_chunks(file, file_size, chunk_size, buffer_count):
+  """ Reads the file sequentially, skipping its holes unless file_size is
+      None, for files that cannot seek.
+  """
+  views = [memoryview(bytearray(chunk_size)) for i in range(buffer_count)]
+  zeros = None
+  next_view = 0
+
+  def read_chunks(length=None):
+    nonlocal next_view
+    while length is None or length > 0:
+      request = chunk_size if length is None else min(chunk_size, length)
+      view = views[next_view]
+      next_view = (next_view + 1) % buffer_count
+      read = file.readinto(view[:request])
+      if not read:
+        return
+      if length is not None:
+        length -= read
+      yield view[:read]
+
+  if file_size is None:
+    yield from read_chunks()
+    return
+
+  position = 0
+  for hole_start, hole_end in _find_file_holes(file.fileno(), file_size):
+    file.seek(position)
+    yield from read_chunks(hole_start - position)
+
+    if zeros is None:
+      zeros = memoryview(bytes(chunk_size))
+    for offset in range(hole_start, hole_end, chunk_size):
+      yield zeros[:min(chunk_size, hole_end - offset)]
+    position = hole_end
+
+  # Read to the end of the file rather than to the size reported by fstat, in
+  # case the file is still growing.
+  file.seek(position)
+  yield from read_chunks()
+
+def _iterate_mmap_chunks(file, chunk_size):
+  mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  if hasattr(mmap, 'MADV_SEQUENTIAL'):
+    mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+  view = memoryview(mapped)
+  for offset in range(0, len(view), chunk_size):
+    yield view[offset:offset + chunk_size]
+
+  # Chunks still held by the caller keep the mapping alive until released.
+  del view
+  try:
+    mapped.close()
+  except BufferError:
+    pass
+
   
 class _FileHash:
+  LABEL_WIDTH = 10
+
   def __init__(self, hash_name, hash_object, filename):
     self.hash_name = hash_name
     self.hash_str = hash_file_in_chunks_to_hex_str(filename, hash_object)
+
+  @classmethod
+  def from_hash_str(cls, hash_name, hash_str):
+    file_hash = cls.__new__(cls)
+    file_hash.hash_name = hash_name
+    file_hash.hash_str = hash_str
+    return file_hash
     
   def __str__(self):
-    return f'{self.hash_name:<10}{self.hash_str}'
+    width = max(_FileHash.LABEL_WIDTH, len(self.hash_name) + 1)
+    return f'{self.hash_name:<{width}}{self.hash_str}'
 
     
 class _Application:
@@ -35,14 +713,50 @@ class _Application:
     'sha1': ('SHA1', hashlib.sha1),
     'sha256': ('SHA256', hashlib.sha256),
   }
+  # Merkle tree digests (see TreeHash), only computed when selected.
+  TREE_HASHES = {
+    'tree-sha256': ('TREE-SHA256', hashlib.sha256),
+  }
 
   def __init__(self):
     arg_parser = self.build_argument_parser()
     self.args = arg_parser.parse_args()
-    self.filename = self.args.file
+    if not self.args.file and not self.args.check:
+      arg_parser.error('a file or --check MANIFEST is required')
+    self.paths = self.args.file
+    self.filename = self.paths[0] if self.paths else None
+    if (self.args.tree_leaves or self.args.tree_changed) and \
+       (self.args.check or self.args.dir_digest or self.is_batch_mode()):
+      arg_parser.error('--tree-leaves and --tree-changed only apply to a single file')
     self.selected_algs = self.get_selected_algorithms()
+    self.cache_path = None
     
   def run(self):
+    self.cache_path = digestcache.open_cache_from_args(self.args)
+    try:
+      with stats.open_stats_from_args(self.args):
+        self._run_selected_mode()
+    except KeyboardInterrupt: # The executors have stopped their workers.
+      sys.exit('Interrupted.')
+    finally:
+      digestcache.evict_cache(self.cache_path)
+
+  def _run_selected_mode(self):
+    if self.args.check:
+      counts = self.run_check()
+      if counts[CHECK_FAILED] or counts[CHECK_MISSING]:
+        sys.exit(1)
+      return
+
+    if self.args.dir_digest:
+      self.run_directory_digest()
+      return
+
+    if self.is_batch_mode():
+      if self.run_batch():
+        sys.exit(1)
+      return
+
     self.exit_if_no_file_exists()
     self.hashes = self.compute_hashes()
     
@@ -50,41 +764,206 @@ class _Application:
       print(hash)
   
   def build_argument_parser(self):
-    ARG_FILE_HELP = 'The file to hash.'
+    ARG_FILE_HELP = ('The file to hash.  Several files, directories (hashed '
+                     'recursively) or - for a NUL separated list on stdin '
+                     'print sum-style lines instead.')
     ARG_ALGS_HELP = 'choose hashing algorithms to use (ex. --algs=md5,sha256)'
+    ARG_JOBS_HELP = 'Number of files to hash at once in batch mode.'
+    ARG_POOL_HELP = ('Use worker threads, processes or neither in batch mode.  auto '
+                     'picks from the sizes of the first files.')
+    ARG_CHECK_HELP = ('Verify the files listed in a *sum style manifest '
+                      '(- for stdin).  Untagged lines use the single --algs '
+                      'choice, or are matched by digest length.')
+    ARG_FAIL_FAST_HELP = 'Stop checking at the first failed or missing file.'
+    ARG_DIR_DIGEST_HELP = ('Print one digest for each directory argument, built '
+                           'from its sorted paths, modes and file hashes (uses '
+                           f'a single --algs choice, default {DEFAULT_DIRECTORY_HASH}).')
+    ARG_SUBDIR_DIGESTS_HELP = 'With --dir-digest, also print every subdirectory\'s digest.'
+    ARG_LEAF_SIZE_HELP = ('Leaf size in bytes for tree hashes.  Other than the default, it is '
+                          'part of the algorithm label, as in TREE-SHA256-1M.')
+    ARG_LEAVES_HELP = ('Load and save the leaf digests of a single file\'s tree '
+                       'hash here, so later runs rehash only changed leaves.')
+    ARG_CHANGED_HELP = ('Byte ranges (START:END,...) modified in place since '
+                        'the leaves were saved.')
     description = _Application.get_description()
     
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('file', help=ARG_FILE_HELP)
+    parser.add_argument('file', help=ARG_FILE_HELP, nargs='*')
+    parser.add_argument('--check', help=ARG_CHECK_HELP, metavar='MANIFEST')
+    parser.add_argument('--fail-fast', help=ARG_FAIL_FAST_HELP, action='store_true')
     parser.add_argument('--algs', help=ARG_ALGS_HELP, type=str)
+    parser.add_argument('--jobs', help=ARG_JOBS_HELP, type=int, default=1)
+    parser.add_argument('--pool', help=ARG_POOL_HELP, choices=BACKENDS,
+                        default=BACKEND_AUTO)
+    parser.add_argument('--dir-digest', help=ARG_DIR_DIGEST_HELP, action='store_true')
+    parser.add_argument('--subdir-digests', help=ARG_SUBDIR_DIGESTS_HELP,
+                        action='store_true')
+    parser.add_argument('--tree-leaf-size', help=ARG_LEAF_SIZE_HELP, type=int,
+                        default=DEFAULT_TREE_LEAF_SIZE)
+    parser.add_argument('--tree-leaves', help=ARG_LEAVES_HELP, metavar='PATH')
+    parser.add_argument('--tree-changed', help=ARG_CHANGED_HELP, type=parse_byte_ranges,
+                        metavar='RANGES')
+    digestcache.add_cache_arguments(parser)
+    stats.add_stats_arguments(parser)
     return parser
+
+  def is_batch_mode(self):
+    return (len(self.paths) > 1 or
+            self.filename == STDIN_PATH or
+            os.path.isdir(self.filename))
+
+  def run_batch(self):
+    """ Hashes every file named by the paths, printing results as they
+        finish.  Returns the number of files that could not be hashed.
+    """
+    algs = list(self.selected_algs)
+    labels = [_Application.get_hash_alg(alg)[_Application.LABEL] for alg in algs]
+    if len(labels) == 1: # Plain sha256sum style output.
+      labels = [None]
+
+    filenames = iterate_filenames_recursively(self.paths)
+    job = partial(hash_file_with_algorithms, algs=algs, cache_path=self.cache_path)
+    failures = 0
+    with build_executor(self.args.jobs, self.args.pool) as executor:
+      backend, filenames = executor.resolve_from(filenames, _get_file_size)
+      for filename, future in executor.map_unordered(job, filenames, backend=backend):
+        try:
+          hash_strs = future.result()
+        except OSError as e:
+          failures += 1
+          print(f'{filename}: {e.strerror}', file=sys.stderr)
+          continue
+
+        with stats.timed(stats.PHASE_REPORT):
+          for label, hash_str in zip(labels, hash_strs):
+            print(format_checksum_line(hash_str, filename, label))
+    return failures
+
+  def run_directory_digest(self):
+    alg = DEFAULT_DIRECTORY_HASH
+    if self.args.algs:
+      if len(self.selected_algs) != 1:
+        sys.exit('--dir-digest takes a single algorithm.')
+      alg = self.selected_algs[0]
+
+    for directory in self.paths:
+      if not os.path.isdir(directory):
+        sys.exit('Could not locate directory: \''+directory+'\'')
+
+      digests = hash_directory_tree(directory, alg, self.args.jobs,
+                                    self.args.pool, self.cache_path)
+      if self.args.subdir_digests:
+        relative_dirs = sorted(digests)
+      else:
+        relative_dirs = [DIRECTORY_ROOT]
+      for relative_dir in relative_dirs:
+        path = directory if relative_dir == DIRECTORY_ROOT else os.path.join(directory, relative_dir)
+        print(format_checksum_line(digests[relative_dir], path.rstrip('/') + '/'))
+
+  def run_check(self):
+    """ Verifies the manifest entries in parallel, streaming the manifest and
+        the results.  Returns a dict of counts keyed by check status.
+    """
+    default_alg = None
+    if self.args.algs and len(self.selected_algs) == 1:
+      default_alg = self.selected_algs[0]
+
+    counts = dict.fromkeys(CHECK_STATUSES, 0)
+    malformed_count = 0
+
+    def iterate_entries(manifest):
+      nonlocal malformed_count
+      for line in manifest:
+        entry = parse_checksum_line(line, default_alg)
+        if entry:
+          yield entry
+        elif line.strip():
+          malformed_count += 1
+
+    with _open_manifest(self.args.check) as manifest, \
+         build_executor(self.args.jobs, self.args.pool) as executor:
+      backend, entries = executor.resolve_from(iterate_entries(manifest),
+                                               lambda entry: _get_file_size(entry[2]))
+      for entry, future in executor.map_unordered(_verify_checksum_entry, entries,
+                                                  backend=backend):
+        status = future.result()
+        counts[status] += 1
+        with stats.timed(stats.PHASE_REPORT):
+          print(f'{entry[2]}: {status}')
+
+        if self.args.fail_fast and status != CHECK_OK:
+          executor.terminate()
+          break
+
+    summary = '  '.join(f'{status}: {counts[status]}' for status in CHECK_STATUSES)
+    if malformed_count:
+      summary += f'  MALFORMED: {malformed_count}'
+    print(summary)
+    return counts
   
   def exit_if_no_file_exists(self):
-    if not os.path.isfile(self.filename):
+    if not os.path.isfile(self.filename) and not _is_stream(self.filename):
       sys.exit('Could not locate file: \''+self.filename+'\'')
   
   def get_selected_algorithms(self):
+    """ Returns the selected algorithms, naming tree hashes with the
+        --tree-leaf-size they use unless it is the default.
+    """
     algorithm_args = self.args.algs
-    if algorithm_args:
-      return algorithm_args.split(',')
-    else:
+    if not algorithm_args:
       return _Application.get_all_supported_algorithms()
+
+    if self.args.tree_leaf_size <= 0:
+      sys.exit('--tree-leaf-size must be positive.')
+    algs = list()
+    for alg in algorithm_args.split(','):
+      if alg in _Application.TREE_HASHES:
+        alg = format_tree_algorithm(alg, self.args.tree_leaf_size)
+      elif is_tree_algorithm(alg):
+        alg = _parse_tree_algorithm(alg)
+      algs.append(alg)
+    return algs
   
   def compute_hashes(self):
-    hashes = list()
+    labels = list()
     for alg in self.selected_algs:
-      hash_alg = _Application.SUPPORTED_HASHES[alg]
-      label = hash_alg[_Application.LABEL]
-      hash_obj = hash_alg[_Application.HASH_OBJECT_CONSTRUCTOR]()
-      
-      hashes.append(_FileHash(label, hash_obj, self.filename))
+      labels.append(_Application.get_hash_alg(alg)[_Application.LABEL])
+
+    stream_algs = [alg for alg in self.selected_algs if not is_tree_algorithm(alg)]
+    hash_strs = dict(zip(stream_algs, hash_file_with_algorithms(
+      self.filename, stream_algs, cache_path=self.cache_path)))
+    for alg in self.selected_algs:
+      if is_tree_algorithm(alg):
+        hash_strs[alg] = hash_file_tree_to_hex_str(
+          self.filename, _Application.get_hash_constructor(alg),
+          get_tree_leaf_size(alg), self.args.jobs, self.args.tree_leaves,
+          self.args.tree_changed)
+    hash_strs = [hash_strs[alg] for alg in self.selected_algs]
+
+    hashes = list()
+    for label, hash_str in zip(labels, hash_strs):
+      hashes.append(_FileHash.from_hash_str(label, hash_str))
       
     return hashes
 
   @staticmethod
   def get_description():
     algorithm_list = _Application.get_supported_hashes_str()
-    return f'Compute the hash of a file. Supports: {algorithm_list}'
+    tree_list = ' '.join(_Application.TREE_HASHES)
+    return (f'Compute the hash of a file. Supports: {algorithm_list} '
+            f'(tree: {tree_list})')
+
+  @staticmethod
+  def get_hash_alg(alg):
+    if is_tree_algorithm(alg):
+      base_alg = _split_tree_algorithm(alg)[0]
+      label, hash_constructor = _Application.TREE_HASHES[base_alg]
+      return (label + alg[len(base_alg):].upper(), hash_constructor)
+    return _Application.SUPPORTED_HASHES[alg]
+
+  @staticmethod
+  def get_hash_constructor(alg):
+    return _Application.get_hash_alg(alg)[_Application.HASH_OBJECT_CONSTRUCTOR]
   
   @staticmethod
   def get_all_supported_algorithms():
@@ -101,6 +980,12 @@ class _Application:
     return hashes_list_str
 
 
+def _open_manifest(path):
+  if path == STDIN_PATH:
+    return open(sys.stdin.fileno(), 'r', errors='surrogateescape', closefd=False)
+  return open(path, 'r', errors='surrogateescape')
+
+
 if __name__ == '__main__':
   app = _Application()
   app.run()
@@ -0,0 +1,224 @@
+from bisect import bisect_left
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+MD5_DIGEST_SIZE = 16
+
+INDEX_FILE_EXTENSION = '.idx'
+INDEX_MAGIC = b'TBHASHIX'
+INDEX_VERSION = 1
+# magic, version, digest size, reserved, record count, path table offset
+INDEX_HEADER = struct.Struct('<8sHHIQQ')
+
+class InvalidIndexFile(RuntimeError):
+  pass
+
+class DigestIndex:
+  """ A set of fixed size raw digests, stored as one sorted bytes-like
+      buffer and searched by binary search.
+
+      Each digest costs only its own size in memory, and the whole index
+      pickles as a single buffer, so it is cheap to hand to pool workers.
+      The buffer may also be a memoryview over larger fixed size records
+      that start with the digest, such as the records of a HashIndexFile.
+  """
+  def __init__(self, buffer=b'', digest_size=MD5_DIGEST_SIZE, record_size=None):
+    self._record_size = record_size or digest_size
+    if len(buffer) % self._record_size:
+      raise ValueError('Index buffer is not a whole number of digests.')
+    self._buffer = buffer
+    self._digest_size = digest_size
+
+  def get_digest_size(self):
+    return self._digest_size
+
+  def __len__(self):
+    return len(self._buffer) // self._record_size
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('Digest index out of range.')
+    start = index * self._record_size
+    return bytes(self._buffer[start:start + self._digest_size])
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def __contains__(self, digest):
+    return self.find(digest) is not None
+
+  def find(self, digest):
+    """ Returns the position of the first record with the digest, or None. """
+    index = bisect_left(self, digest)
+    if index < len(self) and self[index] == digest:
+      return index
+    return None
+
+
+class HashIndexFile:
+  """ A read only, memory mapped index of (digest, size, path) records.
+
+      The file holds a header, the records sorted by digest as fixed size
+      (digest, size, path offset) entries, and a table of NUL terminated
+      paths.  Lookups binary search the mapped records, so only the pages
+      touched are read, and processes opening the same file share them
+      through the page cache.
+
+      Paths are stored relative to the indexed directory, with / between
+      names.  find() joins them onto root, the directory's location here,
+      if given.
+  """
+  def __init__(self, path, root=None):
+    self._path = path
+    self._root = root
+    with open(path, 'rb') as file:
+      if os.fstat(file.fileno()).st_size < INDEX_HEADER.size: # Empty files cannot be mapped.
+        raise InvalidIndexFile(f'\'{path}\' is too short to be an index.')
+      self._mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+      self._read_header()
+    except InvalidIndexFile:
+      self._mapped.close()
+      raise
+
+    records_end = INDEX_HEADER.size + self._record_count * self._record.size
+    self._records_view = memoryview(self._mapped)[INDEX_HEADER.size:records_end]
+    self._digest_index = DigestIndex(self._records_view, self._digest_size,
+                                     self._record.size)
+
+  def get_path(self):
+    return self._path
+
+  def get_digest_size(self):
+    return self._digest_size
+
+  def __len__(self):
+    return self._record_count
+
+  def __contains__(self, digest):
+    return digest in self._digest_index
+
+  def find(self, digest):
+    """ Returns the (size, path) of every record with the digest. """
+    matches = list()
+    index = self._digest_index.find(digest)
+    while index is not None and index < self._record_count:
+      record_digest, size, path = self._read_record(index)
+      if record_digest != digest:
+        break
+      if self._root is not None:
+        path = os.path.join(self._root, *path.split('/'))
+      matches.append((size, path))
+      index += 1
+    return matches
+
+  def iterate_records(self):
+    for index in range(self._record_count):
+      yield self._read_record(index)
+
+  def close(self):
+    self._digest_index = None
+    self._records_view.release()
+    self._mapped.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _read_header(self):
+    path = self._path
+    if len(self._mapped) < INDEX_HEADER.size:
+      raise InvalidIndexFile(f'\'{path}\' is too short to be an index.')
+    (magic, version, self._digest_size, reserved, self._record_count,
+     self._paths_offset) = INDEX_HEADER.unpack_from(self._mapped)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+      raise InvalidIndexFile(f'\'{path}\' is not a version {INDEX_VERSION} index.')
+
+    self._record = _build_record_struct(self._digest_size)
+    records_end = INDEX_HEADER.size + self._record_count * self._record.size
+    if records_end != self._paths_offset or records_end > len(self._mapped):
+      raise InvalidIndexFile(f'\'{path}\' is truncated.')
+
+  def _read_record(self, index):
+    digest, size, path_offset = self._record.unpack_from(self._records_view,
+                                                         index * self._record.size)
+    path_start = self._paths_offset + path_offset
+    path_end = self._mapped.find(b'\0', path_start)
+    return digest, size, os.fsdecode(self._mapped[path_start:path_end])
+
+
+def write_index_file(path, records, record_count, digest_size=MD5_DIGEST_SIZE):
+  """ Writes (digest, size, path) records, which must already be sorted, to
+      an index file.  The file is replaced atomically.
+  """
+  record_struct = _build_record_struct(digest_size)
+  paths_offset = INDEX_HEADER.size + record_count * record_struct.size
+  temp_path = path + '.tmp'
+
+  written_count = 0
+  with open(temp_path, 'wb') as index_file, tempfile.TemporaryFile() as paths_file:
+    index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, digest_size, 0,
+                                       record_count, paths_offset))
+    path_offset = 0
+    for digest, size, filename in records:
+      encoded_path = os.fsencode(filename) + b'\0'
+      index_file.write(record_struct.pack(digest, size, path_offset))
+      paths_file.write(encoded_path)
+      path_offset += len(encoded_path)
+      written_count += 1
+
+    if written_count != record_count:
+      raise ValueError(f'Expected {record_count} index records, got {written_count}.')
+    paths_file.seek(0)
+    shutil.copyfileobj(paths_file, index_file)
+  os.replace(temp_path, path)
+
+def build_index_file(path, records, digest_size=MD5_DIGEST_SIZE, root=None):
+  """ Writes (digest, size, path) records to an index file.  With a root,
+      the directory indexed, paths are stored relative to it, so indexes
+      built from other working directories or mount points of the same
+      tree match and merge.
+  """
+  if root is not None:
+    records = [(digest, size, _relative_posix_path(filename, root))
+               for digest, size, filename in records]
+  records = sorted(records)
+  write_index_file(path, records, len(records), digest_size)
+
+def merge_index_files(path, input_paths):
+  """ Merges index shards, which may have been built on different machines,
+      into one index without loading them into memory.
+  """
+  inputs = [HashIndexFile(input_path) for input_path in input_paths]
+  try:
+    digest_sizes = {index_file.get_digest_size() for index_file in inputs}
+    if len(digest_sizes) > 1:
+      raise InvalidIndexFile('Cannot merge indexes with different digest sizes.')
+
+    record_count = sum(len(index_file) for index_file in inputs)
+    merged = heapq.merge(*[index_file.iterate_records() for index_file in inputs])
+    write_index_file(path, merged, record_count, digest_sizes.pop() if inputs
+                     else MD5_DIGEST_SIZE)
+  finally:
+    for index_file in inputs:
+      index_file.close()
+
+def is_index_file(path):
+  return path.endswith(INDEX_FILE_EXTENSION) and os.path.isfile(path)
+
+def _relative_posix_path(path, start):
+  relative_path = os.path.relpath(path, start)
+  return relative_path.replace(os.sep, '/') if os.sep != '/' else relative_path
+
+def _build_record_struct(digest_size):
+  return struct.Struct(f'<{digest_size}sQQ')
@@ -1,18 +1,32 @@
 import argparse
+import json
 import os.path
 import shutil
+import sys
+
+try:
+  from toolbag import stats
+except ImportError:
+  import stats
 
 
 class Log:
   BYTES_IN_MEGABYTE = 1000000
   DEFAULT_CLONE_EXTENSION = '.prev'
+  CHECKPOINT_VERSION = 1
+  COUNT_CHUNK_SIZE = 1 << 20
 
-  def __init__(self, file_path):
+  def __init__(self, file_path, checkpoint_path=None):
+    """ With a checkpoint_path, line counts are saved there, so the next
+        count of the same file only reads the lines appended since.
+    """
     Log._raise_if_not_a_file(file_path)
 
-    self._size = os.path.getsize(file_path)
-    self._line_count = Log._count_lines_in_file(file_path)
+    with stats.timed(stats.PHASE_STAT):
+      self._size = os.path.getsize(file_path)
+    self._line_count = None
     self._file_path = file_path
+    self._checkpoint_path = checkpoint_path
 
   def get_file_size_in_bytes(self):
     return self._size
@@ -20,31 +34,117 @@ class Log:
   def get_file_size_in_megabytes(self):
     return float(self._size / Log.BYTES_IN_MEGABYTE)
 
-  def get_line_count(self):
-    return self._line_count
+  def get_line_count(self, limit=None):
+    """ Counts the lines on first use.  With a limit, counting stops once
+        past it, and any count over the limit may be returned.
+    """
+    if self._line_count is not None:
+      return self._line_count
+    if self._checkpoint_path:
+      return self._count_lines_from_checkpoint(limit)
+    with stats.timed(stats.PHASE_COUNT):
+      line_count = Log._count_lines_in_file(self._file_path, limit)
+    if limit is None or line_count <= limit:
+      self._line_count = line_count
+    return line_count
 
   def clear_original_file(self):
     Log._clear_file_contents(self._file_path)
+    if self._checkpoint_path:
+      Log._save_checkpoint(self._checkpoint_path, os.stat(self._file_path), 0, 0, 0)
     
   def clone_to_a_backup(self, user_defined_path=None):
-    if user_defined_path:
-      shutil.copy2(self._file_path, user_defined_path)
-    else:
-      shutil.copy2(self._file_path, self._file_path + Log.DEFAULT_CLONE_EXTENSION)
+    with stats.timed(stats.PHASE_COPY):
+      if user_defined_path:
+        shutil.copy2(self._file_path, user_defined_path)
+      else:
+        shutil.copy2(self._file_path, self._file_path + Log.DEFAULT_CLONE_EXTENSION)
+    stats.add(stats.FILES_COPIED)
+    stats.add(stats.BYTES_COPIED, self._size)
 
   def get_file_path(self):
     return self._file_path
-      
-  @staticmethod
-  def _count_lines_in_file(file_path):
-    line_count = 0
-  
-    with open(file_path, 'r') as log_file:
-      for line in log_file:
-        line_count += 1
-        
+
+  def _count_lines_from_checkpoint(self, limit):
+    """ Counts from the end of the last complete line the checkpoint
+        saw, or from the start if the file was replaced or truncated since.
+    """
+    with stats.timed(stats.PHASE_STAT):
+      stat_result = os.stat(self._file_path)
+    offset, newline_count = Log._load_checkpoint(self._checkpoint_path, stat_result)
+    with stats.timed(stats.PHASE_COUNT):
+      line_count, scan = Log._scan_lines(self._file_path, limit, offset, newline_count)
+    if scan is None:
+      return line_count
+    Log._save_checkpoint(self._checkpoint_path, stat_result, *scan)
+    self._line_count = line_count
     return line_count
 
+  @staticmethod
+  def _count_lines_in_file(file_path, limit=None):
+    return Log._scan_lines(file_path, limit)[0]
+
+  @staticmethod
+  def _scan_lines(file_path, limit=None, offset=0, newline_count=0):
+    """ Counts newlines from offset in binary chunks, plus an unterminated
+        last line, stopping early once the count is past limit.  Returns the
+        count and (size, offset, newline count) for a checkpoint, where
+        offset is the end of the last complete line, or None if stopped.
+    """
+    last_byte = b'\n'
+    line_end = offset
+
+    with open(file_path, 'rb') as log_file:
+      log_file.seek(offset)
+      for chunk in iter(lambda: log_file.read(Log.COUNT_CHUNK_SIZE), b''):
+        stats.add(stats.BYTES_COUNTED, len(chunk))
+        chunk_newline_count = chunk.count(b'\n')
+        if chunk_newline_count:
+          newline_count += chunk_newline_count
+          line_end = offset + chunk.rindex(b'\n') + 1
+        offset += len(chunk)
+        last_byte = chunk[-1:]
+        if limit is not None and newline_count > limit:
+          return newline_count, None
+
+    return newline_count + (last_byte != b'\n'), (offset, line_end, newline_count)
+
+  @staticmethod
+  def _load_checkpoint(checkpoint_path, stat_result):
+    """ Returns the (offset, newline count) saved for the file, or (0, 0)
+        if there is none or the file is not the one that was counted.
+    """
+    try:
+      with open(checkpoint_path, 'r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+      size, offset, newline_count = (checkpoint['size'], checkpoint['offset'],
+                                     checkpoint['lines'])
+      if checkpoint['version'] != Log.CHECKPOINT_VERSION or \
+         checkpoint['device'] != stat_result.st_dev or \
+         checkpoint['inode'] != stat_result.st_ino or \
+         not all(isinstance(value, int) for value in (size, offset, newline_count)) or \
+         not 0 <= offset <= size <= stat_result.st_size or newline_count < 0:
+        return 0, 0
+    except (OSError, ValueError, KeyError, TypeError): # Missing or malformed.
+      return 0, 0
+    return offset, newline_count
+
+  @staticmethod
+  def _save_checkpoint(checkpoint_path, stat_result, size, offset, newline_count):
+    """ Saves the checkpoint if it can; without one the next count reads
+        the whole file.
+    """
+    temp_path = checkpoint_path + '.tmp'
+    try:
+      with open(temp_path, 'w') as checkpoint_file:
+        json.dump({'version': Log.CHECKPOINT_VERSION, 'device': stat_result.st_dev,
+                   'inode': stat_result.st_ino, 'size': size, 'offset': offset,
+                   'lines': newline_count}, checkpoint_file)
+      os.replace(temp_path, checkpoint_path)
+    except OSError as e:
+      print(f'Warning: could not save the line count to \'{checkpoint_path}\': '
+            f'{e.strerror or e}', file=sys.stderr)
+
   @staticmethod
   def _clear_file_contents(file_path):
     if os.path.isfile(file_path):
@@ -64,6 +164,7 @@ class _Application:
                  'The application will check the defined theshold, copy the '
                  'existing log to a backup, and then clear out the primary '
                  'log.  Existing backups will be overwritten with the latest.')
+  DEFAULT_CHECKPOINT_EXTENSION = '.lines'
 
   def __init__(self):
     arg_parser = _Application._build_arg_parser()
@@ -71,13 +172,17 @@ class _Application:
     
     self._line_limit = args.line_limit
     self._size_limit_mb = args.size_limit
-    
+    checkpoint_path = args.checkpoint_path
+    if args.checkpoint and not checkpoint_path:
+      checkpoint_path = args.log_file + _Application.DEFAULT_CHECKPOINT_EXTENSION
+
+    self._run_stats = stats.open_stats_from_args(args)
+    self._run_stats.start()
     try:
-      self._work_log = Log(args.log_file)
-    except PermissionError as e:
-      raise RuntimeError(f'Insufficient permissions to access file: {args.log_file}')
-    except FileNotFoundError as e:
-      raise RuntimeError(f'Could not locate a file at: {args.log_file}')
+      self._work_log = _Application._open_log(args.log_file, checkpoint_path)
+    except BaseException: # run() will not be called to stop them.
+      self._run_stats.stop()
+      raise
 
   def run(self):
     try:
@@ -88,10 +193,21 @@ class _Application:
       raise RuntimeError(f'Insufficient permissions to access file: {self._work_log.get_file_path()}')
     except FileNotFoundError as e:
       raise RuntimeError(f'Could not locate a file at: {self._work_log.get_file_path()}')
+    finally:
+      self._run_stats.stop()
+
+  @staticmethod
+  def _open_log(log_file, checkpoint_path):
+    try:
+      return Log(log_file, checkpoint_path)
+    except PermissionError as e:
+      raise RuntimeError(f'Insufficient permissions to access file: {log_file}')
+    except FileNotFoundError as e:
+      raise RuntimeError(f'Could not locate a file at: {log_file}')
 
   def _is_past_line_threshold(self):
     if self._line_limit is not None:
-      return self._work_log.get_line_count() > self._line_limit
+      return self._work_log.get_line_count(self._line_limit) > self._line_limit
     else:
       return False
 
@@ -106,11 +222,18 @@ class _Application:
     ARG_FILE_HELP = 'The target log file.' 
     ARG_LINE_HELP = 'The maximum number of lines the log may have before backup.'
     ARG_SIZE_HELP = 'The maximum size (MB) the log may be before backup.'
+    ARG_CHECKPOINT_HELP = ('Save the line count beside the log file, as the log file + '
+                           f'{_Application.DEFAULT_CHECKPOINT_EXTENSION}, so the next '
+                           'run only counts appended lines.')
+    ARG_CHECKPOINT_PATH_HELP = 'Save the line count here instead (implies --checkpoint).'
     
     parser = argparse.ArgumentParser(description=_Application.DESCRIPTION)
     parser.add_argument('--size_limit', help=ARG_LINE_HELP, type=float)
     parser.add_argument('--line_limit', help=ARG_SIZE_HELP, type=int)
+    parser.add_argument('--checkpoint', help=ARG_CHECKPOINT_HELP, action='store_true')
+    parser.add_argument('--checkpoint_path', help=ARG_CHECKPOINT_PATH_HELP)
     parser.add_argument('log_file', help=ARG_FILE_HELP)
+    stats.add_stats_arguments(parser)
     return parser
 
 def main():
@@ -0,0 +1,142 @@
+import ctypes
+import os
+import select
+import time
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_DIRECTORY_CHANGES = (0x00000040 | # IN_MOVED_FROM
+                        0x00000080 | # IN_MOVED_TO
+                        0x00000100 | # IN_CREATE
+                        0x00000200 | # IN_DELETE
+                        0x00000400 | # IN_DELETE_SELF
+                        0x00000800)  # IN_MOVE_SELF
+INOTIFY_READ_SIZE = 2**16
+
+class MountWatcher:
+  """ Waits for a directory to appear or disappear without busy polling.
+
+      Where the platform allows, it sleeps on the mount table
+      (/proc/self/mountinfo signals every mount and unmount to poll()) and
+      on an inotify watch of the directory's parent, which sees it created,
+      removed or renamed.  When neither is available, it falls back to
+      checking every poll_interval seconds.
+  """
+  def __init__(self, path, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS):
+    self._path = os.path.abspath(path)
+    self._poll_interval = poll_interval
+    self._poller = select.poll() if hasattr(select, 'poll') else None
+    self._mountinfo = None
+    self._inotify_fd = None
+    if self._poller:
+      self._watch_mountinfo()
+      self._watch_parent_directory()
+
+  def is_available(self):
+    return os.path.isdir(self._path)
+
+  def is_event_driven(self):
+    return self._inotify_fd is not None
+
+  def wait_until_available(self, settle_seconds=DEFAULT_SETTLE_SECONDS):
+    """ Returns once the directory exists and nothing has been mounted,
+        unmounted or changed beside it for settle_seconds.
+    """
+    while True:
+      while not self.is_available():
+        self._wait_for_event()
+      if self._is_settled(settle_seconds):
+        return
+
+  def wait_until_gone(self):
+    while self.is_available():
+      self._wait_for_event()
+
+  def close(self):
+    if self._mountinfo:
+      self._mountinfo.close()
+      self._mountinfo = None
+    if self._inotify_fd is not None:
+      os.close(self._inotify_fd)
+      self._inotify_fd = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _is_settled(self, settle_seconds):
+    settle_end = time.monotonic() + settle_seconds
+    while True:
+      remaining = settle_end - time.monotonic()
+      if remaining <= 0:
+        return self.is_available()
+      if self._wait_for_event(remaining):
+        if not self.is_available():
+          return False
+        settle_end = time.monotonic() + settle_seconds
+
+  def _wait_for_event(self, timeout=None):
+    """ Sleeps until a mount or directory event, or the timeout.  Without an
+        inotify watch, it also wakes each poll interval, as the directory
+        may appear unannounced.  Returns True if an event arrived.
+    """
+    if not self.is_event_driven():
+      timeout = min(timeout or self._poll_interval, self._poll_interval)
+    if not self._poller or not (self._mountinfo or self.is_event_driven()):
+      time.sleep(timeout)
+      return False
+
+    events = self._poller.poll(None if timeout is None else timeout * 1000)
+    if self._inotify_fd is not None:
+      self._drain_inotify()
+    return bool(events)
+
+  def _watch_mountinfo(self):
+    try:
+      self._mountinfo = open(MOUNTINFO_PATH, 'rb')
+    except OSError:
+      return
+    self._poller.register(self._mountinfo.fileno(), select.POLLPRI | select.POLLERR)
+
+  def _watch_parent_directory(self):
+    libc = _load_libc()
+    if libc is None:
+      return
+    inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if inotify_fd < 0:
+      return
+    parent = os.fsencode(os.path.dirname(self._path))
+    if libc.inotify_add_watch(inotify_fd, parent, IN_DIRECTORY_CHANGES) < 0:
+      os.close(inotify_fd)
+      return
+    self._inotify_fd = inotify_fd
+    self._poller.register(inotify_fd, select.POLLIN)
+
+  def _drain_inotify(self):
+    try:
+      while os.read(self._inotify_fd, INOTIFY_READ_SIZE):
+        pass
+    except BlockingIOError:
+      pass
+
+    # The watch ends with the parent directory; fall back to polling.
+    if not os.path.isdir(os.path.dirname(self._path)):
+      self._poller.unregister(self._inotify_fd)
+      os.close(self._inotify_fd)
+      self._inotify_fd = None
+
+
+def _load_libc():
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+  except OSError:
+    return None
+  if not hasattr(libc, 'inotify_init1'):
+    return None
+  return libc
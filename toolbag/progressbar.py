@@ -5,13 +5,19 @@ class ProgressBar():
   BAR_LEFT_BORDER = '['
   BAR_RIGHT_BORDER = ']'
   
-  def __init__(self, width=60):
+  def __init__(self, width=60, stream=None):
     self.width = width
+    self.stream = stream
+    self._last_status_length = 0
     
-  def render(self, progress):
+  def render(self, progress, status=''):
+    """ Redraws the bar, followed by an optional status such as rates. """
+    stream = self.stream or sys.stdout
+    padding = ' ' * max(self._last_status_length - len(status), 0)
+    self._last_status_length = len(status)
     text = self._build_progress_bar_string(progress)
-    sys.stdout.write(text)
-    sys.stdout.flush()
+    stream.write(text + status + padding)
+    stream.flush()
     
   def _get_bar_field_width(self):
     return (self.width - 
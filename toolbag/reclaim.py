@@ -0,0 +1,126 @@
+import errno
+import os
+import secrets
+import shutil
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  from toolbag import stats
+except ImportError:
+  import stats
+
+METHOD_LINK = 'link'
+METHOD_REFLINK = 'reflink'
+METHODS = [METHOD_LINK, METHOD_REFLINK]
+
+# The Linux ioctl that shares one file's extents with another (btrfs, XFS).
+FICLONE = 0x40049409
+COMPARE_CHUNK_SIZE = 2**20
+TEMP_SUFFIX = '.toolbag-reclaim'
+# Random temporary names tried before giving up on a directory.
+TEMP_NAME_ATTEMPTS = 100
+
+def files_have_same_contents(filename, other_filename, chunk_size=COMPARE_CHUNK_SIZE):
+  with stats.timed(stats.PHASE_COMPARE), open(filename, 'rb') as file, \
+       open(other_filename, 'rb') as other_file:
+    if os.fstat(file.fileno()).st_size != os.fstat(other_file.fileno()).st_size:
+      return False
+    while True:
+      chunk = file.read(chunk_size)
+      if chunk != other_file.read(chunk_size):
+        return False
+      if not chunk:
+        return True
+      stats.add(stats.BYTES_COMPARED, 2 * len(chunk))
+
+def reflink_file(source, destination):
+  """ Creates destination sharing source's data blocks.  Raises OSError with
+      EOPNOTSUPP, EXDEV or EINVAL where the filesystem cannot do it.
+  """
+  if fcntl is None:
+    raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+  with open(source, 'rb') as source_file, open(destination, 'xb') as destination_file:
+    try:
+      fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except BaseException:
+      os.remove(destination)
+      raise
+
+def replace_with_copy_of(original, path, method):
+  """ Atomically replaces path with a hard link or reflink to original.  A
+      reflinked file keeps path's permissions and times.
+  """
+  temp_path = _create_temp_copy_of(original, path, method)
+  try:
+    if method == METHOD_REFLINK:
+      shutil.copystat(path, temp_path)
+    os.replace(temp_path, path)
+  except BaseException:
+    os.remove(temp_path)
+    raise
+
+def _create_temp_copy_of(original, path, method):
+  """ Links or reflinks original to an unused name beside path, never
+      touching a file that is already there.  Returns the name.
+  """
+  for attempt in range(TEMP_NAME_ATTEMPTS):
+    temp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) +
+                             '.' + secrets.token_hex(4) + TEMP_SUFFIX)
+    try:
+      if method == METHOD_LINK:
+        os.link(original, temp_path)
+      else:
+        reflink_file(original, temp_path)
+      return temp_path
+    except FileExistsError:
+      continue
+  raise FileExistsError(errno.EEXIST, 'No unused temporary name', path)
+
+def reclaim_duplicates(groups, method=None, dry_run=False):
+  """ Replaces duplicate files with links to the first file of their group.
+
+      groups yields lists of (filename, aliases) pairs, where aliases are
+      further hard links to the same file; they are replaced too, since the
+      space only comes back once every link is gone.  Each duplicate is
+      compared byte for byte with the original first.  With no method, or
+      with dry_run, nothing is changed.
+
+      Yields (duplicate, original, reclaimable bytes, error) for every
+      duplicate, where error is None or the reason it was skipped.
+  """
+  for group in groups:
+    original = group[0][0]
+    try:
+      original_stat = os.stat(original)
+    except OSError as e:
+      for duplicate, aliases in group[1:]:
+        yield duplicate, original, 0, e.strerror
+      continue
+
+    for duplicate, aliases in group[1:]:
+      yield _reclaim_duplicate(original, original_stat, duplicate, aliases,
+                               method, dry_run)
+
+def _reclaim_duplicate(original, original_stat, duplicate, aliases, method, dry_run):
+  try:
+    duplicate_stat = os.stat(duplicate)
+    if os.path.samestat(original_stat, duplicate_stat):
+      return duplicate, original, 0, 'already linked'
+    if not files_have_same_contents(original, duplicate):
+      return duplicate, original, 0, 'contents differ'
+
+    # Links outside the tree keep the data alive.
+    reclaimable = 0
+    if duplicate_stat.st_nlink <= 1 + len(aliases):
+      reclaimable = duplicate_stat.st_size
+
+    if method and not dry_run:
+      for path in [duplicate] + aliases:
+        replace_with_copy_of(original, path, method)
+    return duplicate, original, reclaimable, None
+  except OSError as e:
+    return duplicate, original, 0, e.strerror
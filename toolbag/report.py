@@ -0,0 +1,166 @@
+import csv
+from functools import partial
+import json
+import os
+import struct
+import sys
+import threading
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+FORMAT_BINARY = 'binary'
+FORMATS = [FORMAT_JSONL, FORMAT_CSV, FORMAT_BINARY]
+FORMAT_EXTENSIONS = {'.jsonl': FORMAT_JSONL, '.json': FORMAT_JSONL, '.csv': FORMAT_CSV,
+                     '.bin': FORMAT_BINARY}
+STDOUT_PATH = '-'
+
+TYPE_UNREPRESENTED = 'unrepresented'
+TYPE_DUPLICATE = 'duplicate'
+RECORD_TYPES = [TYPE_UNREPRESENTED, TYPE_DUPLICATE]
+FIELDS = ['type', 'group', 'path', 'size', 'digest']
+
+# Records are flushed once this many are buffered, or this long after the
+# first of them was written, whichever comes first.
+FLUSH_RECORDS = 256
+FLUSH_SECONDS = 1.0
+
+BINARY_MAGIC = b'TBREPORT'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sH')
+# type, group, size, digest length, path length
+BINARY_RECORD = struct.Struct('<BIQBI')
+BINARY_NO_GROUP = 0xFFFFFFFF
+
+class ReportWriter:
+  """ Streams result records to a file as they are produced.
+
+      Writes are buffered, but never for more than FLUSH_RECORDS records or
+      FLUSH_SECONDS, so the report can be followed with tail -f.  Records
+      are dicts of the FIELDS; digests are hex strings.  write_record(record)
+      writes one in the report's format.
+  """
+  def __init__(self, file, write_record, close_file=True):
+    self._file = file
+    self._write_record = write_record
+    self._close_file = close_file
+    self._lock = threading.Lock()
+    self._pending_count = 0
+    self._flush_timer = None
+    self.record_count = 0
+
+  def write(self, record_type, path, size=None, digest=None, group=None):
+    record = dict(type=record_type, group=group, path=path, size=size, digest=digest)
+    with self._lock:
+      self._write_record(record)
+      self.record_count += 1
+      self._pending_count += 1
+      if self._pending_count >= FLUSH_RECORDS:
+        self._flush()
+      elif not self._flush_timer:
+        self._flush_timer = threading.Timer(FLUSH_SECONDS, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def close(self):
+    self.flush()
+    if self._close_file:
+      self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _flush(self):
+    if self._flush_timer:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+    self._pending_count = 0
+    if not self._file.closed:
+      self._file.flush()
+
+
+def open_report(path, report_format=None, stdout=None):
+  """ Opens a report writer for path, or for stdout, by default
+      sys.stdout, if path is '-'.  The format defaults to the one named by
+      path's extension, or JSON Lines.
+  """
+  if not report_format:
+    extension = os.path.splitext(path)[1].lower()
+    report_format = FORMAT_EXTENSIONS.get(extension, FORMAT_JSONL)
+
+  binary = report_format == FORMAT_BINARY
+  if path == STDOUT_PATH:
+    stdout = stdout or sys.stdout
+    file = stdout.buffer if binary else stdout
+    close_file = False
+  else:
+    file = open(path, 'wb') if binary else open(path, 'w', newline='',
+                                                 errors='surrogateescape')
+    close_file = True
+
+  record_writers = {FORMAT_JSONL: _start_jsonl_report, FORMAT_CSV: _start_csv_report,
+                    FORMAT_BINARY: _start_binary_report}
+  return ReportWriter(file, record_writers[report_format](file), close_file)
+
+def read_binary_report(file):
+  """ Yields the records of a binary report as dicts, like the other formats. """
+  magic, version = BINARY_HEADER.unpack(_read_exactly(file, BINARY_HEADER.size))
+  if magic != BINARY_MAGIC or version != BINARY_VERSION:
+    raise ValueError(f'Not a version {BINARY_VERSION} binary report.')
+
+  while True:
+    header = file.read(BINARY_RECORD.size)
+    if not header:
+      return
+    type_index, group, size, digest_length, path_length = BINARY_RECORD.unpack(
+      header + _read_exactly(file, BINARY_RECORD.size - len(header)))
+    digest = _read_exactly(file, digest_length)
+    path = _read_exactly(file, path_length)
+    yield dict(type=RECORD_TYPES[type_index],
+               group=None if group == BINARY_NO_GROUP else group,
+               path=os.fsdecode(path), size=size, digest=digest.hex() or None)
+
+def add_report_arguments(parser):
+  REPORT_ARG_HELP = ('Stream the results to a file as they are found, or to stdout '
+                     f'with {STDOUT_PATH}, moving the other output to stderr.')
+  REPORT_FORMAT_ARG_HELP = ('The report format (default: from the file extension, '
+                            f'else {FORMAT_JSONL}).')
+
+  parser.add_argument('--report', help=REPORT_ARG_HELP)
+  parser.add_argument('--report-format', help=REPORT_FORMAT_ARG_HELP, choices=FORMATS)
+
+def _start_jsonl_report(file):
+  return lambda record: file.write(json.dumps(record) + '\n')
+
+def _start_csv_report(file):
+  csv_writer = csv.DictWriter(file, FIELDS)
+  csv_writer.writeheader()
+  return csv_writer.writerow
+
+def _start_binary_report(file):
+  """ Writes a header; each record follows as a BINARY_RECORD, the raw
+      digest and the path's bytes.  read_binary_report reads it back.
+  """
+  file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION))
+  return partial(_write_binary_record, file)
+
+def _write_binary_record(file, record):
+  digest = bytes.fromhex(record['digest']) if record['digest'] else b''
+  path = os.fsencode(record['path'])
+  group = BINARY_NO_GROUP if record['group'] is None else record['group']
+  file.write(BINARY_RECORD.pack(RECORD_TYPES.index(record['type']), group,
+                                record['size'] or 0, len(digest), len(path)))
+  file.write(digest)
+  file.write(path)
+
+def _read_exactly(file, size):
+  data = file.read(size)
+  if len(data) != size:
+    raise ValueError('Binary report is truncated.')
+  return data
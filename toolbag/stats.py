@@ -0,0 +1,275 @@
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError: # Not on Windows; peak RSS is left out.
+  resource = None
+
+try:
+  from toolbag.telemetry import SlotCounters
+except ImportError:
+  from telemetry import SlotCounters
+
+PHASE_WALK = 'walk'
+PHASE_STAT = 'stat'
+PHASE_HASH = 'hash'
+PHASE_COMPARE = 'compare'
+PHASE_COPY = 'copy'
+PHASE_COUNT = 'count'
+PHASE_REPORT = 'report'
+PHASES = (PHASE_WALK, PHASE_STAT, PHASE_HASH, PHASE_COMPARE, PHASE_COPY,
+          PHASE_COUNT, PHASE_REPORT)
+
+FILES_WALKED = 'files_walked'
+DIRECTORIES_WALKED = 'directories_walked'
+FILES_HASHED = 'files_hashed'
+BYTES_HASHED = 'bytes_hashed'
+BYTES_COMPARED = 'bytes_compared'
+FILES_COPIED = 'files_copied'
+BYTES_COPIED = 'bytes_copied'
+BYTES_COUNTED = 'bytes_counted'
+CACHE_HITS = 'cache_hits'
+CACHE_MISSES = 'cache_misses'
+COUNTERS = (FILES_WALKED, DIRECTORIES_WALKED, FILES_HASHED, BYTES_HASHED,
+            BYTES_COMPARED, FILES_COPIED, BYTES_COPIED, BYTES_COUNTED,
+            CACHE_HITS, CACHE_MISSES)
+
+# Each phase counts nanoseconds and calls, then come the counters.
+_PHASE_INDEXES = {phase: index * 2 for index, phase in enumerate(PHASES)}
+_COUNTER_INDEXES = {counter: 2 * len(PHASES) + index
+                    for index, counter in enumerate(COUNTERS)}
+NANOSECONDS_IN_SECOND = 1e9
+BYTES_IN_MEGABYTE = 1000000
+# ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+STDOUT_PATH = '-'
+
+# The counters installed in this process by install_counters; None while
+# stats are off, so timing and counting do nothing.
+_counters = None
+_local = threading.local()
+
+class _PhaseTimer:
+  """ Charges the time spent in a phase to it.  Phases nest: time in an
+      inner phase is not charged to the outer one, so the phase times of
+      a thread add up to its busy time.
+  """
+  __slots__ = ('_index',)
+
+  def __init__(self, index):
+    self._index = index
+
+  def __enter__(self):
+    now = time.perf_counter_ns()
+    stack = _get_phase_stack()
+    if stack:
+      _charge(stack[-1], now, 0)
+    stack.append([self._index, now])
+
+  def __exit__(self, *args):
+    now = time.perf_counter_ns()
+    stack = _get_phase_stack()
+    if stack:
+      _charge(stack.pop(), now, 1)
+    if stack:
+      stack[-1][1] = now
+
+
+class _NoTimer:
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *args):
+    pass
+
+_NO_TIMER = _NoTimer()
+_PHASE_TIMERS = {phase: _PhaseTimer(index) for phase, index in _PHASE_INDEXES.items()}
+
+def timed(phase):
+  """ Returns a context manager charging the time spent in it to phase. """
+  if _counters is None:
+    return _NO_TIMER
+  return _PHASE_TIMERS[phase]
+
+def add(counter, value=1):
+  if _counters is not None:
+    _counters.add_counts(value, start=_COUNTER_INDEXES[counter])
+
+def install_counters(counters):
+  """ Makes timed() and add() record to counters in this process,
+      typically a pool worker, or stops them with None.
+  """
+  global _counters
+  _counters = counters
+
+def get_counters():
+  """ Returns the counters installed in this process, to hand to workers. """
+  return _counters
+
+
+class RunStats:
+  """ Phase times, file and byte counts, digest cache hit rates and peak
+      memory for one run, collected from every thread and worker process.
+
+      While started, the stats are installed in this process; workers
+      install counters, through their pool initializer.  Times are the
+      busy time of every thread and worker, summed, so a phase can take
+      longer than the run on several jobs.  Nothing is collected unless
+      the table or JSON output was asked for.
+  """
+  def __init__(self, table=False, json_path=None, stream=None):
+    self._table = table
+    self._json_path = json_path
+    self._stream = stream or sys.stderr
+    self.counters = None
+    if table or json_path:
+      self.counters = SlotCounters(2 * len(PHASES) + len(COUNTERS))
+    self._started = None
+    self._start_times = None
+    self._summary = None
+
+  def start(self):
+    if self.counters is None:
+      return
+    self._started = time.monotonic()
+    self._start_times = os.times()
+    install_counters(self.counters)
+
+  def stop(self):
+    if self._started is None:
+      return
+    install_counters(None)
+    self._summary = self.get_summary()
+    self._started = None
+    if self._table:
+      self._stream.write(format_table(self._summary))
+      self._stream.flush()
+    if self._json_path:
+      _write_json(self._json_path, self._summary)
+
+  def get_summary(self):
+    """ Returns the stats as a dict that serializes to JSON. """
+    if self._started is None:
+      return self._summary
+    times = os.times()
+    totals = self.counters.get_count_totals()
+    counters = {counter: totals[index] for counter, index in _COUNTER_INDEXES.items()}
+    lookups = counters[CACHE_HITS] + counters[CACHE_MISSES]
+    return dict(
+      wall_seconds=time.monotonic() - self._started,
+      cpu_seconds=dict(
+        user=times.user - self._start_times.user,
+        system=times.system - self._start_times.system,
+        workers_user=times.children_user - self._start_times.children_user,
+        workers_system=times.children_system - self._start_times.children_system),
+      phases={phase: dict(seconds=totals[index] / NANOSECONDS_IN_SECOND,
+                          calls=totals[index + 1])
+              for phase, index in _PHASE_INDEXES.items()},
+      counters=counters,
+      cache_hit_rate=counters[CACHE_HITS] / lookups if lookups else None,
+      peak_rss_bytes=_get_peak_rss())
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+def format_table(summary):
+  """ Formats a summary from RunStats.get_summary as a table of phases
+      and a few lines of totals.
+  """
+  wall_seconds = summary['wall_seconds']
+  lines = ['', f'{"Phase":<10}{"Busy s":>10}{"Calls":>10}{"% wall":>9}']
+  for phase, phase_stats in summary['phases'].items():
+    if phase_stats['calls']:
+      share = 100 * phase_stats['seconds'] / wall_seconds if wall_seconds else 0
+      lines.append(f'{phase:<10}{phase_stats["seconds"]:>10.3f}'
+                   f'{phase_stats["calls"]:>10}{share:>8.1f}%')
+
+  cpu = summary['cpu_seconds']
+  lines.append(f'Wall {wall_seconds:.3f} s; CPU {cpu["user"]:.3f} s user, '
+               f'{cpu["system"]:.3f} s system; workers {cpu["workers_user"]:.3f} s '
+               f'user, {cpu["workers_system"]:.3f} s system')
+  counters = summary['counters']
+  if counters[FILES_WALKED] or counters[DIRECTORIES_WALKED]:
+    lines.append(f'Walked {counters[FILES_WALKED]} files in '
+                 f'{counters[DIRECTORIES_WALKED]} directories')
+  hash_seconds = summary['phases'][PHASE_HASH]['seconds']
+  if counters[FILES_HASHED]:
+    lines.append(f'Hashed {counters[FILES_HASHED]} files, '
+                 f'{_format_megabytes(counters[BYTES_HASHED])}'
+                 f'{_format_rate(counters[BYTES_HASHED], hash_seconds)}')
+  copy_seconds = summary['phases'][PHASE_COPY]['seconds']
+  if counters[FILES_COPIED]:
+    lines.append(f'Copied {counters[FILES_COPIED]} files, '
+                 f'{_format_megabytes(counters[BYTES_COPIED])}'
+                 f'{_format_rate(counters[BYTES_COPIED], copy_seconds)}')
+  if counters[BYTES_COMPARED]:
+    lines.append(f'Compared {_format_megabytes(counters[BYTES_COMPARED])}')
+  if counters[BYTES_COUNTED]:
+    lines.append(f'Counted lines in {_format_megabytes(counters[BYTES_COUNTED])}')
+  if summary['cache_hit_rate'] is not None:
+    lines.append(f'Digest cache {counters[CACHE_HITS]} hits, {counters[CACHE_MISSES]} '
+                 f'misses ({100 * summary["cache_hit_rate"]:.1f}% hit rate)')
+  peak_rss = summary['peak_rss_bytes']
+  if peak_rss:
+    lines.append(f'Peak RSS {_format_megabytes(peak_rss["main"])}, workers '
+                 f'{_format_megabytes(peak_rss["workers"])}')
+  return '\n'.join(lines) + '\n'
+
+def add_stats_arguments(parser):
+  STATS_ARG_HELP = ('Print the time spent walking, stat()ing, hashing, comparing, '
+                    'copying and reporting, with file, byte and cache counts and '
+                    'peak memory, to stderr at the end.')
+  STATS_JSON_ARG_HELP = 'Write the same statistics as JSON to a file (- for stdout).'
+
+  parser.add_argument('--stats', help=STATS_ARG_HELP, action='store_true')
+  parser.add_argument('--stats-json', help=STATS_JSON_ARG_HELP, metavar='PATH')
+
+def open_stats_from_args(args):
+  return RunStats(args.stats, args.stats_json)
+
+def _get_phase_stack():
+  if getattr(_local, 'pid', None) != os.getpid(): # Forked with a phase open.
+    _local.pid = os.getpid()
+    _local.phases = list()
+  return _local.phases
+
+def _charge(entry, now, calls):
+  index, started = entry
+  counters = _counters
+  if counters is not None:
+    counters.add_counts(now - started, calls, start=index)
+  entry[1] = now
+
+def _get_peak_rss():
+  if resource is None:
+    return None
+  return dict(
+    main=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT,
+    workers=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * MAXRSS_UNIT)
+
+def _write_json(path, summary):
+  if path == STDOUT_PATH:
+    json.dump(summary, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    return
+  with open(path, 'w') as json_file:
+    json.dump(summary, json_file, indent=2)
+    json_file.write('\n')
+
+def _format_megabytes(size):
+  return f'{size / BYTES_IN_MEGABYTE:.1f} MB'
+
+def _format_rate(size, seconds):
+  return f' ({size / BYTES_IN_MEGABYTE / seconds:.1f} MB/s busy)' if seconds else ''
@@ -0,0 +1,192 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+try:
+  from toolbag.progressbar import ProgressBar
+except ImportError:
+  from progressbar import ProgressBar
+
+# Worker processes and threads claim a counter slot each; any beyond this
+# share the first slot under a lock.
+MAX_COUNTER_SLOTS = 256
+COUNTS_PER_SLOT = 2
+REFRESH_SECONDS = 0.5
+BYTES_IN_MEGABYTE = 1000000
+
+# The counters installed in this process by install_counters.
+_counters = None
+
+class SlotCounters:
+  """ A fixed number of integers, counted in shared memory.
+
+      Each process, and each thread in it, claims a slot of its own the
+      first time it counts, so workers increment plain shared integers,
+      with no lock and no message to the parent per file.  The parent sums
+      the slots when it reports.  Pass the counters to pool workers through
+      the pool initializer.
+  """
+  def __init__(self, counts_per_slot):
+    self._counts_per_slot = counts_per_slot
+    self._counts = multiprocessing.RawArray('Q', MAX_COUNTER_SLOTS * counts_per_slot)
+    self._next_slot = multiprocessing.Value('i', 1)
+    self._local = threading.local()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_local']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state, _local=threading.local())
+
+  def add_counts(self, *counts, start=0):
+    """ Adds counts to the integers from index start on. """
+    if getattr(self._local, 'pid', None) != os.getpid():
+      self._claim_slot()
+    if self._local.slot:
+      offset = self._local.slot * self._counts_per_slot + start
+      for index, count in enumerate(counts, offset):
+        self._counts[index] += count
+    else:
+      with self._next_slot.get_lock():
+        for index, count in enumerate(counts, start):
+          self._counts[index] += count
+
+  def get_count_totals(self):
+    """ Returns the list of integers summed over every process. """
+    return [sum(self._counts[index::self._counts_per_slot])
+            for index in range(self._counts_per_slot)]
+
+  def _claim_slot(self):
+    with self._next_slot.get_lock():
+      slot = self._next_slot.value
+      self._next_slot.value += 1
+    self._local.slot = slot if slot < MAX_COUNTER_SLOTS else 0
+    self._local.pid = os.getpid()
+
+
+class ProgressCounters(SlotCounters):
+  """ Files and bytes processed, counted in shared memory. """
+  def __init__(self):
+    super().__init__(COUNTS_PER_SLOT)
+
+  def add(self, files, size):
+    self.add_counts(files, size)
+
+  def get_totals(self):
+    """ Returns the (files, bytes) counted by every process. """
+    return tuple(self.get_count_totals())
+
+
+class ProgressReporter:
+  """ Renders the progress of pool work on a ProgressBar, with files/s,
+      MB/s and, once all of the work has been submitted, an ETA.
+
+      Work is counted as submitted by the parent, through iterate_submitted,
+      and as done by workers, through count.  Nothing is drawn unless the
+      reporter is enabled, but the counting still works.
+  """
+  def __init__(self, enabled=True, stream=None):
+    self.counters = ProgressCounters()
+    self._enabled = enabled
+    self._stream = stream or sys.stderr
+    self._progress_bar = ProgressBar(stream=self._stream)
+    self._submitted = [0, 0]
+    self._active_submitters = 0
+    self._submitted_lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread = None
+    self._started = None
+
+  def iterate_submitted(self, file_sizes):
+    """ Passes (item, size) pairs through, adding them to the work to do. """
+    with self._submitted_lock:
+      self._active_submitters += 1
+    try:
+      for item, size in file_sizes:
+        with self._submitted_lock:
+          self._submitted[0] += 1
+          self._submitted[1] += size
+        yield item, size
+    finally:
+      with self._submitted_lock:
+        self._active_submitters -= 1
+
+  def get_status(self):
+    """ Returns (fraction done, status text). """
+    files_done, bytes_done = self.counters.get_totals()
+    with self._submitted_lock:
+      files_submitted, bytes_submitted = self._submitted
+      all_submitted = not self._active_submitters
+
+    elapsed = max(time.monotonic() - self._started, 1e-9) if self._started else 1e-9
+    file_rate = files_done / elapsed
+    byte_rate = bytes_done / elapsed
+    if bytes_submitted:
+      fraction = min(bytes_done / bytes_submitted, 1.0)
+    else:
+      fraction = min(files_done / files_submitted, 1.0) if files_submitted else 0.0
+
+    eta = '?'
+    if all_submitted and byte_rate:
+      eta = _format_seconds(max(bytes_submitted - bytes_done, 0) / byte_rate)
+    return fraction, (f' {files_done}/{files_submitted} files {file_rate:.0f}/s '
+                      f'{byte_rate / BYTES_IN_MEGABYTE:.1f} MB/s ETA {eta}')
+
+  def start(self):
+    self._started = time.monotonic()
+    if self._enabled:
+      self._thread = threading.Thread(target=self._render_until_stopped, daemon=True)
+      self._thread.start()
+
+  def stop(self):
+    if self._thread:
+      self._stopped.set()
+      self._thread.join()
+      self._thread = None
+      self._render()
+      self._stream.write('\n')
+      self._stream.flush()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _render_until_stopped(self):
+    while not self._stopped.wait(REFRESH_SECONDS):
+      self._render()
+
+  def _render(self):
+    self._progress_bar.render(*self.get_status())
+
+
+def install_counters(counters):
+  """ Makes count() add to counters in this process, typically a pool worker. """
+  global _counters
+  _counters = counters
+
+def count(files, size):
+  if _counters:
+    _counters.add(files, size)
+
+def add_progress_arguments(parser):
+  NO_PROGRESS_ARG_HELP = 'Do not show progress, which is shown when stderr is a terminal.'
+  PROGRESS_ARG_HELP = 'Show progress even when stderr is not a terminal.'
+
+  parser.add_argument('--progress', help=PROGRESS_ARG_HELP, action='store_true')
+  parser.add_argument('--no-progress', help=NO_PROGRESS_ARG_HELP, action='store_true')
+
+def open_progress_from_args(args):
+  enabled = args.progress or (sys.stderr.isatty() and not args.no_progress)
+  return ProgressReporter(enabled)
+
+def _format_seconds(seconds):
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return f'{hours}:{minutes:02}:{seconds:02}'
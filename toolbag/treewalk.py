@@ -0,0 +1,135 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fnmatch
+import os
+
+try:
+  from toolbag import stats
+except ImportError:
+  import stats
+
+class WalkFilter:
+  """ Selects the files a walk yields, as it scans.
+
+      Globs containing a '/' match the path relative to the root of the
+      walk, others match the name alone.  Excluded directories are pruned,
+      so they are never read.  Files must match an include glob, if any
+      are given, and be within the size limits.
+  """
+  def __init__(self, include=None, exclude=None, min_size=None, max_size=None):
+    self.include = include or list()
+    self.exclude = exclude or list()
+    self.min_size = min_size
+    self.max_size = max_size
+
+  def is_filtering_files(self):
+    return bool(self.include or self.exclude or self.min_size is not None or
+                self.max_size is not None)
+
+  def accepts_directory(self, relative_path, name):
+    return not _matches_any(self.exclude, relative_path, name)
+
+  def accepts_file(self, relative_path, name, size):
+    if _matches_any(self.exclude, relative_path, name):
+      return False
+    if self.include and not _matches_any(self.include, relative_path, name):
+      return False
+    if self.min_size is not None and size < self.min_size:
+      return False
+    if self.max_size is not None and size > self.max_size:
+      return False
+    return True
+
+
+def iterate_files(directory, jobs=1, ordered=True, walk_filter=None, on_error=None):
+  """ Yields (path, stat_result) for every regular file under directory.
+
+      With jobs above 1, directories are read on that many threads, which
+      hides the latency of network filesystems.  In order, the files come
+      as a single threaded walk yields them: each directory's files, then
+      its subdirectories, depth first.  Otherwise they come as soon as
+      their directory has been read.  Errors reading an entry or a
+      directory are passed to on_error(path, error) and skipped.
+  """
+  walk_filter = walk_filter or WalkFilter()
+  on_error = on_error or _ignore_error
+  if jobs <= 1:
+    yield from _iterate_files_serially(directory, walk_filter, on_error)
+    return
+
+  scan = lambda path: _scan_directory(directory, path, walk_filter)
+  executor = ThreadPoolExecutor(max_workers=jobs)
+  try:
+    if ordered:
+      pending = [executor.submit(scan, directory)]
+      while pending:
+        files, subdirectories, errors = pending.pop().result()
+        _report_errors(errors, on_error)
+        yield from files
+        pending.extend(reversed([executor.submit(scan, path) for path in subdirectories]))
+    else:
+      pending = {executor.submit(scan, directory)}
+      while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          files, subdirectories, errors = future.result()
+          _report_errors(errors, on_error)
+          pending.update(executor.submit(scan, path) for path in subdirectories)
+          yield from files
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+
+def _iterate_files_serially(directory, walk_filter, on_error):
+  directories = [directory]
+  while directories:
+    files, subdirectories, errors = _scan_directory(directory, directories.pop(),
+                                                    walk_filter)
+    _report_errors(errors, on_error)
+    yield from files
+    directories.extend(reversed(subdirectories))
+
+def _scan_directory(root, directory, walk_filter):
+  """ Reads one directory.  Returns its accepted (path, stat_result) files,
+      the subdirectories to walk, and (path, error) pairs for failures.
+  """
+  files = list()
+  subdirectories = list()
+  errors = list()
+  filtering = walk_filter.is_filtering_files()
+  try:
+    with stats.timed(stats.PHASE_WALK), os.scandir(directory) as entries:
+      for entry in entries:
+        try:
+          relative_path = _relative_posix_path(entry.path, root) if filtering else None
+          if entry.is_dir(follow_symlinks=False):
+            if not filtering or walk_filter.accepts_directory(relative_path, entry.name):
+              subdirectories.append(entry.path)
+          elif entry.is_file():
+            with stats.timed(stats.PHASE_STAT):
+              stat_result = entry.stat()
+            if not filtering or walk_filter.accepts_file(relative_path, entry.name,
+                                                         stat_result.st_size):
+              files.append((entry.path, stat_result))
+        except OSError as e:
+          errors.append((entry.path, e))
+  except OSError as e:
+    errors.append((directory, e))
+  stats.add(stats.DIRECTORIES_WALKED)
+  stats.add(stats.FILES_WALKED, len(files))
+  return files, subdirectories, errors
+
+def _report_errors(errors, on_error):
+  for path, error in errors:
+    on_error(path, error)
+
+def _ignore_error(path, error):
+  pass
+
+def _matches_any(patterns, relative_path, name):
+  for pattern in patterns:
+    if fnmatch.fnmatchcase(relative_path if '/' in pattern else name, pattern):
+      return True
+  return False
+
+def _relative_posix_path(path, start):
+  relative_path = os.path.relpath(path, start)
+  return relative_path.replace(os.sep, '/') if os.sep != '/' else relative_path